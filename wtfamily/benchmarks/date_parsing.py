@@ -0,0 +1,108 @@
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+"""
+Micro-benchmark of Gramps date parsing: `dateutil` (as used before) vs the
+specialized memoized `parse_gramps_date()`, both for bare values and for
+the `DateRepresenter` properties used on list pages::
+
+    $ python benchmarks/date_parsing.py --count 100000
+"""
+import contextlib
+import datetime
+import os
+import random
+import sys
+import timeit
+
+import argh
+from dateutil.parser import parse as parse_date
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import models
+from models import DateRepresenter, parse_gramps_date
+
+
+def _make_values(count, distinct):
+    rnd = random.Random(0)
+    choices = []
+    for _ in range(distinct):
+        year = rnd.randint(1700, 1950)
+        precision = rnd.random()
+        if precision < .5:
+            choices.append(str(year))
+        elif precision < .7:
+            choices.append('{}-{:02d}'.format(year, rnd.randint(1, 12)))
+        else:
+            choices.append('{}-{:02d}-{:02d}'.format(
+                year, rnd.randint(1, 12), rnd.randint(1, 28)))
+    return [rnd.choice(choices) for _ in range(count)]
+
+
+def _dateutil_parse(value):
+    return parse_date(value, default=datetime.datetime(1,1,1))
+
+
+def _time(func, values):
+    return min(timeit.repeat(lambda: [func(x) for x in values],
+                             number=1, repeat=3))
+
+
+def _time_representers(values):
+    dates = [DateRepresenter(x) for x in values]
+    return min(timeit.repeat(
+        lambda: [(d.year, d.century, d.earliest_datetime) for d in dates],
+        number=1, repeat=3))
+
+
+@contextlib.contextmanager
+def _patched_parser(func):
+    "Makes `DateRepresenter` use given parse function"
+    orig = models.parse_gramps_date
+    models.parse_gramps_date = func
+    try:
+        yield
+    finally:
+        models.parse_gramps_date = orig
+
+
+def _report(title, before, after):
+    print('{}: {:.3f}s → {:.3f}s ({:.0f}x)'.format(
+        title, before, after, before / after))
+
+
+def main(count=100000, distinct=5000):
+    values = _make_values(count, distinct)
+
+    uncached = parse_gramps_date.__wrapped__
+    _report('parse, {} values'.format(count),
+            _time(_dateutil_parse, values), _time(uncached, values))
+    parse_gramps_date.cache_clear()
+    _report('parse, {} values ({} distinct), memoized'.format(count, distinct),
+            _time(_dateutil_parse, values), _time(parse_gramps_date, values))
+
+    with _patched_parser(_dateutil_parse):
+        before = _time_representers(values)
+    parse_gramps_date.cache_clear()
+    _report('DateRepresenter year/century/earliest_datetime',
+            before, _time_representers(values))
+
+
+if __name__ == '__main__':
+    argh.dispatch_command(main)
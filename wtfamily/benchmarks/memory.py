@@ -0,0 +1,101 @@
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+"""
+Memory footprint of model instances for a synthetic tree.
+
+Compares the slotted `Person` and `DateRepresenter` with equivalent
+`__dict__`-based layouts (as they were before `__slots__` were introduced)::
+
+    $ python benchmarks/memory.py --people 100000
+
+No database is needed; documents are generated in memory and only the
+instances (not the documents they wrap) are measured.
+"""
+import gc
+import os
+import sys
+import tracemalloc
+
+import argh
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from models import DateRepresenter, Entity, Person
+
+
+class DictPerson(Person):
+    "Person with an instance `__dict__` and eagerly created caches"
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.__dict__['_prefetched'] = {}
+        self.__dict__['_cache'] = {}
+
+
+class DictDateRepresenter(DateRepresenter):
+    "DateRepresenter with an instance `__dict__`"
+
+
+def _make_documents(count):
+    return [
+        {
+            'id': 'I{:06d}'.format(i),
+            'name': [{'type': 'Birth Name', 'first': 'John',
+                      'surname': ['Doe']}],
+            'gender': 'M' if i % 2 else 'F',
+        }
+        for i in range(count)
+    ]
+
+
+def _measure(factory, items):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    instances = [factory(x) for x in items]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # the list itself is the same for both layouts
+    list_size = sys.getsizeof(instances)
+    return (after - before - list_size) / len(instances)
+
+
+def _report(title, count, before, after):
+    print('{}: {:.0f} → {:.0f} bytes per object '
+          '({:.1f} MiB saved for {} objects)'.format(
+              title, before, after,
+              (before - after) * count / 2**20, count))
+
+
+def main(people=100000):
+    Entity.configure_read_validation(Entity.READ_VALIDATION_TRUST)
+
+    documents = _make_documents(people)
+    _report('Person', people,
+            _measure(DictPerson, documents),
+            _measure(Person, documents))
+
+    dates = [{'value': str(1800 + i % 200)} for i in range(people)]
+    _report('DateRepresenter', people,
+            _measure(lambda x: DictDateRepresenter(**x), dates),
+            _measure(lambda x: DateRepresenter(**x), dates))
+
+
+if __name__ == '__main__':
+    argh.dispatch_command(main)
@@ -0,0 +1,107 @@
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+"""
+Serialization of people as done by the list views: sorting by group name
+and building the public data.  Compares `Person` (names parsed once per
+instance, formatted variants memoized) with a variant that re-parses and
+re-formats the name nodes on every access, as before::
+
+    $ python benchmarks/person_serialization.py --people 50000
+
+No database is needed: documents are generated in memory, events are not
+loaded and the name map is replaced with a fixed dict.
+"""
+import os
+import random
+import sys
+import timeit
+
+import argh
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from models import Entity, NameMap, Person
+
+
+NAME_ATTRS = ('names', 'name', 'first_and_last_names', 'first_name',
+              'initials', 'group_names', 'group_name')
+
+ALIASES = {'Petrova': 'Petrov', 'Ivanova': 'Ivanov'}
+
+
+class UncachedPerson(Person):
+    "Computes the name properties on every access"
+
+
+for _attr in NAME_ATTRS:
+    _func = Person.__dict__[_attr].func
+    setattr(UncachedPerson, _attr, property(_func))
+UncachedPerson.parsed_names = property(Person.parsed_names.func)
+
+
+def _make_documents(count):
+    rnd = random.Random(0)
+    surnames = ['Petrov', 'Petrova', 'Ivanov', 'Ivanova', 'Sidorov']
+    firsts = ['Ivan', 'Maria', 'Pyotr', 'Anna', 'Olga']
+    return [
+        {
+            'id': 'I{:06d}'.format(i),
+            'name': [{
+                'type': 'Birth Name',
+                'first': rnd.choice(firsts),
+                'surname': [
+                    {'text': rnd.choice(surnames)},
+                    {'text': 'Ivanovich', 'derivation': 'Patronymic'},
+                ],
+            }],
+            'gender': rnd.choice('MF'),
+        }
+        for i in range(count)
+    ]
+
+
+def _serialize(model, documents):
+    people = [model(x) for x in documents]
+    for person in people:
+        # don't hit the database for birth/death
+        person._cache = {'events': []}
+    people = sorted(people, key=lambda p: p.group_name)
+    return [dict(p.get_public_data(), id=p.id) for p in people]
+
+
+def _time(model, documents):
+    return min(timeit.repeat(lambda: _serialize(model, documents),
+                             number=1, repeat=3))
+
+
+def main(people=50000):
+    Entity.configure_read_validation(Entity.READ_VALIDATION_TRUST)
+    NameMap.get_group_as_map = classmethod(lambda cls: ALIASES)
+
+    documents = _make_documents(people)
+    assert _serialize(Person, documents) == _serialize(UncachedPerson, documents)
+
+    before = _time(UncachedPerson, documents)
+    after = _time(Person, documents)
+    print('Serialize {} people: {:.3f}s → {:.3f}s ({:.1f}x)'.format(
+        people, before, after, before / after))
+
+
+if __name__ == '__main__':
+    argh.dispatch_command(main)
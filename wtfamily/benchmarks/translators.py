@@ -0,0 +1,237 @@
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+"""
+Throughput of the Gramps XML translators on synthetic people and events,
+both ways (XML → data on import, data → XML on export).  Compares the
+compiled dispatch tables of `TagTranslator` with the per-element lookups
+(local names, sorting of `ATTRS` and `TAGS`, a translator instance per
+nested tag) as done before::
+
+    $ python benchmarks/translators.py --records 20000
+
+No database is needed; the records are generated in memory.
+"""
+import contextlib
+import os
+import random
+import sys
+import timeit
+
+import argh
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import etl.translators as s
+from etl.translators.generic import (AbstractTagCardinality, TagTranslator,
+                                     _debug, normalize_attr_value,
+                                     serialize_attr_value)
+
+
+NS = 'http://gramps-project.org/xml/1.7.1/'
+
+
+def _qn(tag):
+    return '{{{}}}{}'.format(NS, tag)
+
+
+def _make_elements(count):
+    rnd = random.Random(0)
+    surnames = ['Petrov', 'Ivanov', 'Sidorov', 'Smirnov']
+    firsts = ['Ivan', 'Maria', 'Pyotr', 'Anna', 'Olga']
+    handle_to_id = {}
+    elements = []
+    for i in range(count):
+        event_handle, person_handle = '_e{}'.format(i), '_i{}'.format(i)
+        handle_to_id[event_handle] = 'E{:06d}'.format(i)
+        handle_to_id[person_handle] = 'I{:06d}'.format(i)
+
+        event = etree.Element(_qn('event'), handle=event_handle,
+                              change='1500000000', id=handle_to_id[event_handle])
+        etree.SubElement(event, _qn('type')).text = 'Birth'
+        etree.SubElement(event, _qn('dateval'), val='{}-{:02d}-{:02d}'.format(
+            rnd.randint(1700, 1950), rnd.randint(1, 12), rnd.randint(1, 28)))
+        etree.SubElement(event, _qn('description')).text = 'Birth'
+        elements.append((s.EventTranslator, event))
+
+        person = etree.Element(_qn('person'), handle=person_handle,
+                               change='1500000000', id=handle_to_id[person_handle])
+        etree.SubElement(person, _qn('gender')).text = rnd.choice('MF')
+        name = etree.SubElement(person, _qn('name'), type='Birth Name')
+        etree.SubElement(name, _qn('first')).text = rnd.choice(firsts)
+        etree.SubElement(name, _qn('surname')).text = rnd.choice(surnames)
+        etree.SubElement(person, _qn('eventref'), hlink=event_handle,
+                         role='Primary')
+        elements.append((s.PersonTranslator, person))
+
+    return elements, handle_to_id
+
+
+def _uncompiled_from_xml(self, el, handle_to_id=None):
+    "`TagTranslator.from_xml()` without the compiled tables"
+    data = {}
+    attrs = {}
+
+    for attr in el.attrib:
+        if attr not in self.ATTRS:
+            _debug('{}: unexpected attr {}'.format(el.tag, attr))
+            continue
+
+        target_type = None
+        if isinstance(self.ATTRS, dict):
+            target_type = self.ATTRS[attr]
+
+        attrs[attr] = normalize_attr_value(el.get(attr), target_type)
+
+    data.update(self.post_normalize_attrs(attrs, handle_to_id))
+
+    if self.AS_TEXT:
+        return el.text
+
+    if self.TEXT_UNDER_KEY:
+        data[self.TEXT_UNDER_KEY] = el.text
+
+    for nested_el in el:
+        nested_tag = etree.QName(nested_el.tag).localname
+
+        if nested_tag not in self.TAGS:
+            if nested_tag not in self.expected_tag_names:
+                _debug('{}: nested tag {} not in expected {}'
+                       .format(el.tag, nested_tag, self.expected_tag_names))
+            continue
+
+        Translator = self.TAGS[nested_tag]
+        translator = Translator()
+
+        is_list = True
+        if isinstance(Translator, AbstractTagCardinality):
+            if Translator.SINGLE_VALUE:
+                is_list = False
+
+        value = translator.from_xml(nested_el, handle_to_id=handle_to_id)
+
+        if is_list:
+            data.setdefault(nested_tag, []).append(value)
+        else:
+            data[nested_tag] = value
+
+    for Contributor in self.CONTRIBUTORS:
+        data.update(Contributor.from_xml(el))
+
+    return data
+
+
+def _uncompiled_to_xml(self, tag, data, id_to_handle):
+    "`TagTranslator.to_xml()` without the compiled tables"
+    el = etree.Element(tag)
+
+    attrs = self.pre_serialize_attrs(data, id_to_handle)
+
+    for attr in sorted(attrs):
+        value = attrs[attr]
+        if value is not None:
+            el.set(attr, serialize_attr_value(value))
+
+    for nested_tag in sorted(self.TAGS):
+        Translator = self.TAGS[nested_tag]
+
+        values = data.get(nested_tag)
+        if values is None:
+            values = []
+        elif not isinstance(values, list):
+            values = [values]
+
+        if isinstance(Translator, AbstractTagCardinality):
+            Translator.validate_values(values)
+
+        for value in values:
+            translator = Translator()
+            el.append(translator.to_xml(nested_tag, value, id_to_handle))
+
+    if self.AS_TEXT:
+        text_value = self._make_text_value(data)
+    elif self.TEXT_UNDER_KEY:
+        text_value = self._make_text_value(data.get(self.TEXT_UNDER_KEY))
+    else:
+        text_value = None
+
+    for Contributor in self.CONTRIBUTORS:
+        for contributed_el in Contributor.to_xml(data):
+            if contributed_el is not None:
+                el.append(contributed_el)
+
+    if text_value:
+        el.text = text_value
+
+    return el
+
+
+@contextlib.contextmanager
+def _uncompiled():
+    "Makes `TagTranslator` ignore the compiled tables"
+    orig = TagTranslator.from_xml, TagTranslator.to_xml
+    TagTranslator.from_xml = _uncompiled_from_xml
+    TagTranslator.to_xml = _uncompiled_to_xml
+    try:
+        yield
+    finally:
+        TagTranslator.from_xml, TagTranslator.to_xml = orig
+
+
+def _import(elements, handle_to_id):
+    return [(Translator, Translator().from_xml(el, handle_to_id=handle_to_id))
+            for Translator, el in elements]
+
+
+def _export(records, id_to_handle):
+    return [Translator().to_xml('item', data, id_to_handle)
+            for Translator, data in records]
+
+
+def _time(func, *args):
+    return min(timeit.repeat(lambda: func(*args), number=1, repeat=3))
+
+
+def _report(title, count, before, after):
+    print('{}: {:.0f} → {:.0f} records/s ({:.1f}x)'.format(
+        title, count / before, count / after, before / after))
+
+
+def main(records=20000):
+    elements, handle_to_id = _make_elements(records // 2)
+    id_to_handle = dict((v, k) for k, v in handle_to_id.items())
+
+    imported = _import(elements, handle_to_id)
+    exported = [etree.tostring(x) for x in _export(imported, id_to_handle)]
+    with _uncompiled():
+        assert _import(elements, handle_to_id) == imported
+        assert [etree.tostring(x)
+                for x in _export(imported, id_to_handle)] == exported
+
+        import_before = _time(_import, elements, handle_to_id)
+        export_before = _time(_export, imported, id_to_handle)
+
+    _report('Import {} records'.format(len(elements)), len(elements),
+            import_before, _time(_import, elements, handle_to_id))
+    _report('Export {} records'.format(len(elements)), len(elements),
+            export_before, _time(_export, imported, id_to_handle))
+
+
+if __name__ == '__main__':
+    argh.dispatch_command(main)
@@ -0,0 +1,65 @@
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+"""
+Process-wide caches of data derived from the database (the kinship graph,
+name maps, etc.), tied to the *data generation*: a number stored in the
+database and bumped on each import (see `models.bump_data_generation()`).
+A cached value is reused until the generation changes, so a running server
+picks up a new import without a restart.
+"""
+import threading
+
+
+class GenerationalCache:
+    """
+    A thread-safe mapping of keys to values computed by a loader, each
+    valid for one data generation.  Usage::
+
+        graphs = GenerationalCache()
+        graph = graphs.get(collection.full_name, generation,
+                           lambda: build_graph(collection))
+
+    Values are built completely before they are published, so concurrent
+    readers either see the previous value or the new one, never a partially
+    filled one.  Only one thread builds a value at a time.
+    """
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, generation, loader):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == generation:
+            return entry[1]
+
+        with self._lock:
+            # another thread may have loaded it while we were waiting
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == generation:
+                return entry[1]
+            value = loader()
+            self._entries[key] = generation, value
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -20,8 +20,11 @@ import argh
 from confu import Configurable
 from pymongo import MongoClient
 
+from models import (Entity, build_derived_fields, build_place_closure,
+                    build_search_index, build_sort_keys, ensure_indexes,
+                    find_unindexed_queries)
 from .mongo_to_gramps_xml import export_to_xml
-from .gramps_xml_to_mongo import import_from_xml
+from .gramps_xml_to_mongo import LOAD_BATCH_SIZE, import_from_xml
 
 
 MONGO_DB_NAME = 'wtfamily-from-grampsxml'
@@ -34,7 +37,15 @@ class WTFamilyETL(Configurable):
     }
 
     def import_gramps_xml(self, path=None, db_name=MONGO_DB_NAME,
-                          replace=False):
+                          replace=False, in_memory=False,
+                          batch_size=LOAD_BATCH_SIZE, workers=0):
+        """
+        Imports given Gramps XML file (plain or gzipped).  The file is
+        streamed unless `in_memory` is true (then it is parsed as a whole,
+        which takes a lot of memory for big trees).  Documents are inserted
+        in batches of `batch_size`.  If `workers` is given, the records of
+        a streamed file are translated in as many processes.
+        """
 
         if db_name in self.mongo_client.database_names():
             if replace or argh.confirm('DROP and replace existing DB "{}"'
@@ -48,7 +59,8 @@ class WTFamilyETL(Configurable):
 
         db = self.mongo_client[db_name]
 
-        return import_from_xml(path or self.gramps_xml_path, db)
+        return import_from_xml(path or self.gramps_xml_path, db, in_memory,
+                               batch_size, workers)
 
     def export_gramps_xml(self, path=None, db_name=MONGO_DB_NAME,
                           replace=False):
@@ -58,9 +70,76 @@ class WTFamilyETL(Configurable):
         #       or remove the `path` and `replace` args
         return export_to_xml(db)
 
+    def create_indexes(self, db_name=MONGO_DB_NAME):
+        """
+        Creates MongoDB indexes derived from the model declarations.
+        """
+        self._use_database(db_name)
+
+        return ensure_indexes()
+
+    def rebuild_search_index(self, db_name=MONGO_DB_NAME):
+        """
+        Rebuilds the search index (normally done on import).
+        """
+        self._use_database(db_name)
+
+        return build_search_index()
+
+    def rebuild_place_closure(self, db_name=MONGO_DB_NAME):
+        """
+        Rebuilds the place hierarchy closure (normally done on import).
+        """
+        self._use_database(db_name)
+
+        return build_place_closure()
+
+    def rebuild_sort_keys(self, db_name=MONGO_DB_NAME):
+        """
+        Recomputes stored sort keys (normally done on import).
+        """
+        self._use_database(db_name)
+
+        return build_sort_keys()
+
+    def rebuild_derived_fields(self, db_name=MONGO_DB_NAME):
+        """
+        Recomputes fields derived from the data for querying, such as
+        `date_bounds` and `location` (normally done on save and import).
+        """
+        self._use_database(db_name)
+
+        return build_derived_fields()
+
+    def report_unindexed_queries(self, db_name=MONGO_DB_NAME):
+        """
+        Lists model queries which would require a full collection scan.
+        """
+        self._use_database(db_name)
+
+        found = False
+        for model, conditions, stages in find_unindexed_queries():
+            found = True
+            yield '{}: {} → {}'.format(model.entity_name, conditions,
+                                       ' < '.join(stages))
+        if not found:
+            yield 'All known queries are indexed.'
+
+    def _use_database(self, db_name):
+        db = self.mongo_client[db_name]
+
+        # monkey-patch to avoid the Flask app context/globals nonsense
+        Entity._get_database = lambda: db
+
     @property
     def commands(self):
         return [
             self.import_gramps_xml,
-            self.export_gramps_xml
+            self.export_gramps_xml,
+            self.create_indexes,
+            self.rebuild_search_index,
+            self.rebuild_place_closure,
+            self.rebuild_sort_keys,
+            self.rebuild_derived_fields,
+            self.report_unindexed_queries,
         ]
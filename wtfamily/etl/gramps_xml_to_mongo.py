@@ -22,16 +22,23 @@
 Converter of (un)compressed Gramps XML to WTFamily MongoDB.
 """
 import binascii
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import datetime
 import gzip
 # NOTE: not bundled with Python but separate library; it can pretty-print.
 from lxml import etree
 import pprint
+from pymongo.errors import BulkWriteError
+import time
 
 from models import (Entity, Person, Family, Event, Citation, Source, Place,
                     Repository, MediaObject, Note, Bookmark, NameMap,
-                    NameFormat)
+                    NameFormat, build_derived_fields, build_place_closure,
+                    build_search_index, build_sort_keys,
+                    bump_data_generation, ensure_indexes)
 
+from etl.handles import HandleTable
 import etl.translators as s
 
 
@@ -41,23 +48,103 @@ GRAMPS_XML_VERSION = '.'.join(str(i) for i in GRAMPS_XML_VERSION_TUPLE)
 GRAMPS_URL_HOMEPAGE = "http://gramps-project.org/"
 
 
-def extract(path):
-    print('Extracting from {} ...'.format(path))
+# NOTE: this largerly mirrors/copies the import code; can we unify them?
+MODEL_TO_TAG = {
+    Person: ('people', 'person', s.PersonTranslator),
+    Family: ('families', 'family', s.FamilyTranslator),
+    Event: ('events', 'event', s.EventTranslator),
+    Source: ('sources', 'source', s.SourceTranslator),
+    Place: ('places', 'placeobj', s.PlaceTranslator),
+    MediaObject: ('objects', 'object', s.MediaObjectTranslator),
+    Repository: ('repositories', 'repository', s.RepositoryTranslator),
+    Note: ('notes', 'note', s.NoteTranslator),
+    # TODO: Tag: ('tags', 'tag', s.TagTranslator),
+    Citation: ('citations', 'citation', s.CitationTranslator),
+    Bookmark: ('bookmarks', 'bookmark', s.BookmarkTranslator),
+    NameMap: ('namemaps', 'map', s.NameMapTranslator),
+    NameFormat: ('name-formats', 'format', s.NameFormatTranslator),
+}
+MODELS = (Person, Family, NameFormat, Event, Citation, Source, Place,
+          Repository, MediaObject, Note, Bookmark, NameMap)
+
+# `(group tag, item tag)` → model
+TAGS_TO_MODEL = dict(((group_tag, item_tag), model) for model, (group_tag,
+                     item_tag, _) in MODEL_TO_TAG.items())
 
+
+def _open(path):
     if _is_gzip_file(path):
-        opener = gzip.open
+        return gzip.open(path)
     elif _is_plain_xml_file(path):
-        opener = lambda x: open(x, 'rb')
+        return open(path, 'rb')
     else:
         raise ValueError('File {} is neither a plain nor a gzipped XML file'
                          .format(path))
 
-    with opener(path) as f:
+
+def extract(path):
+    print('Extracting from {} ...'.format(path))
+
+    with _open(path) as f:
         xml_root_el = etree.fromstring(f.read())
 
     return xml_root_el
 
 
+def iter_records(path):
+    """
+    Yields ``(model, element)`` for each record (a person, an event, etc.)
+    in given file, in the document order.  The file is parsed incrementally
+    and each element is discarded as soon as the consumer asks for the next
+    one, so the memory is bounded by the largest record rather than by the
+    whole file.
+    """
+    for group_tag, el in _iter_record_elements(path):
+        item_tag = etree.QName(el.tag).localname
+        model = TAGS_TO_MODEL.get((group_tag, item_tag))
+        if model:
+            yield model, el
+
+
+def _iter_record_elements(path):
+    "Yields ``(group tag, element)`` for each record, mapped or not."
+    with _open(path) as f:
+        # root > group (e.g. `people`) > record (e.g. `person`)
+        depth = 0
+        group_tag = None
+        for event, el in etree.iterparse(f, events=('start', 'end'),
+                                         huge_tree=True):
+            if event == 'start':
+                depth += 1
+                if depth == 2:
+                    group_tag = etree.QName(el.tag).localname
+                continue
+
+            if depth == 3:
+                yield group_tag, el
+            if depth in (2, 3):
+                # drop the element and whatever was skipped before it
+                el.clear(keep_tail=True)
+                while el.getprevious() is not None:
+                    del el.getparent()[0]
+            depth -= 1
+
+
+def collect_handles(elems):
+    """
+    Returns a `HandleTable` with the mapping of internal Gramps IDs
+    ("handles") to "public" IDs of given record elements.  Records without
+    an ID (e.g. tags) are not included, so refs to them fail on lookup.
+    """
+    table = HandleTable()
+    for el in elems:
+        handle = el.get('handle')
+        item_id = el.get('id')
+        if handle and item_id:
+            table.add(handle, item_id)
+    return table.freeze()
+
+
 def _is_gzip_file(path):
     with open(path, 'rb') as f:
         return binascii.hexlify(f.read(2)) == b'1f8b'
@@ -68,79 +155,256 @@ def _is_plain_xml_file(path):
         return f.read(5) == '<?xml'
 
 
-def transform(xml_root_el):
-    # NOTE: this largerly mirrors/copies the import code; can we unify them?
-    model_to_tag = {
-        Person: ('people', 'person', s.PersonTranslator),
-        Family: ('families', 'family', s.FamilyTranslator),
-        Event: ('events', 'event', s.EventTranslator),
-        Source: ('sources', 'source', s.SourceTranslator),
-        Place: ('places', 'placeobj', s.PlaceTranslator),
-        MediaObject: ('objects', 'object', s.MediaObjectTranslator),
-        Repository: ('repositories', 'repository', s.RepositoryTranslator),
-        Note: ('notes', 'note', s.NoteTranslator),
-        # TODO: Tag: ('tags', 'tag', s.TagTranslator),
-        Citation: ('citations', 'citation', s.CitationTranslator),
-        Bookmark: ('bookmarks', 'bookmark', s.BookmarkTranslator),
-        NameMap: ('namemaps', 'map', s.NameMapTranslator),
-        NameFormat: ('name-formats', 'format', s.NameFormatTranslator),
-    }
-    models = (Person, Family, NameFormat, Event, Citation, Source, Place,
-              Repository, MediaObject, Note, Bookmark, NameMap)
+# records per task in `_translate_in_parallel()`
+TRANSFORM_CHUNK_SIZE = 500
 
-    # Gather the mappings of internal Gramps IDs ("handles") to "public" IDs.
-    handle_to_id = {}
-    for el in xml_root_el.findall('.//*[@handle]'):
-        item_handle = el.get('handle')
-        item_id = el.get('id')
 
-        handle_to_id[item_handle] = item_id
+def transform(xml_root_el):
+    # Gather the mappings of internal Gramps IDs ("handles") to "public" IDs.
+    # Only the records (root > group > record) have handles worth mapping,
+    # so there's no need to scan every element in the tree.
+    handle_to_id = collect_handles(el for group_el in xml_root_el
+                                   for el in group_el)
 
     def _qn(name):
         return etree.QName(xml_root_el, name).text
 
     # Now that we have the full mapping, proceed to extract and transform tags
-    for model in models:
+    for model in MODELS:
         print('  * {}'.format(model.__name__))
-        group_tag, item_tag, ItemTranslator = model_to_tag[model]
+        group_tag, item_tag, _ = MODEL_TO_TAG[model]
         search_expr = '{}/{}'.format(_qn(group_tag), _qn(item_tag))
         elems = xml_root_el.findall(search_expr)
 
         for elem in elems:
-            translator = ItemTranslator()
-            try:
-                data = translator.from_xml(elem, handle_to_id=handle_to_id)
-            except Exception as e:
-                tag_ln = etree.QName(elem.tag).localname
-                print('=====================================================')
-                print()
-                print('ERROR transforming (deserializing) {} tag:'.format(tag_ln))
-                print(etree.tostring(elem, encoding='unicode', pretty_print=True))
+            yield elem, model, _translate(model, elem, handle_to_id)
 
-                raise e
 
-            yield elem, model, data
+def transform_stream(path, workers=None, chunk_size=TRANSFORM_CHUNK_SIZE):
+    """
+    Same as `transform()` but reads the records from given file with
+    `iter_records()` instead of a parsed tree.  The file is read twice: the
+    first pass only collects the handles.
 
+    If `workers` is given, the records are translated in as many processes
+    and the documents are also prepared for saving there (see
+    `_translate_in_parallel()`); they must be loaded with ``prepared=True``.
+    """
+    print('Extracting from {} (streaming) ...'.format(path))
+
+    handle_to_id = collect_handles(el for _, el in
+                                   _iter_record_elements(path))
+    records = iter_records(path)
+
+    if workers:
+        yield from _translate_in_parallel(records, handle_to_id, workers,
+                                          chunk_size)
+        return
+
+    for model, elem in records:
+        yield elem, model, _translate(model, elem, handle_to_id)
+
+
+def _translate_in_parallel(records, handle_to_id, workers, chunk_size):
+    """
+    Translates given ``(model, element)`` pairs and prepares the resulting
+    documents for saving (see `_prepare()`) in a pool of `workers`
+    processes.  The elements are serialized and sent in chunks of
+    `chunk_size`; the results are yielded in the original order, and only a
+    few chunks per worker are in flight at any time, so the memory stays
+    bounded.
+
+    The yielded elements are shallow copies (the tag and its attributes,
+    enough to tell which record failed to load): the streamed ones are
+    discarded by the time their chunk is translated.
+    """
+    print('  (translating in {} processes)'.format(workers))
+
+    with ProcessPoolExecutor(workers, initializer=_init_translate_worker,
+                             initargs=(handle_to_id,)) as executor:
+        pending = deque()
+        for chunk in _iter_chunks(records, chunk_size):
+            shells = [(model, shell) for model, shell, _ in chunk]
+            serialized = [(model, xml) for model, _, xml in chunk]
+            pending.append((shells, executor.submit(_translate_chunk,
+                                                    serialized)))
+            if len(pending) >= workers * 2:
+                yield from _iter_translated(*pending.popleft())
+
+        while pending:
+            yield from _iter_translated(*pending.popleft())
+
+
+def _iter_chunks(records, chunk_size):
+    "Yields lists of ``(model, element shell, serialized element)``"
+    chunk = []
+    for model, elem in records:
+        shell = etree.Element(elem.tag, elem.attrib)
+        chunk.append((model, shell, etree.tostring(elem, with_tail=False)))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _iter_translated(shells, future):
+    for (model, shell), data in zip(shells, future.result()):
+        yield shell, model, data
 
-def load(items, db):
-    for elem, model, data in items:
-        # TODO: can we avoid repeating this?
-        model._get_database = lambda: db
 
+# handle → ID mapping in a `_translate_in_parallel()` worker process
+_worker_handle_to_id = None
+
+
+def _init_translate_worker(handle_to_id):
+    global _worker_handle_to_id
+    _worker_handle_to_id = handle_to_id
+
+
+def _translate_chunk(serialized):
+    docs = []
+    for model, xml in serialized:
+        elem = etree.fromstring(xml)
+        data = _translate(model, elem, _worker_handle_to_id)
+        docs.append(_prepare(model, elem, data))
+    return docs
+
+
+def _translate(model, elem, handle_to_id):
+    _, _, ItemTranslator = MODEL_TO_TAG[model]
+    translator = ItemTranslator()
+    try:
+        return translator.from_xml(elem, handle_to_id=handle_to_id)
+    except Exception as e:
+        tag_ln = etree.QName(elem.tag).localname
+        print('=====================================================')
+        print()
+        print('ERROR transforming (deserializing) {} tag:'.format(tag_ln))
+        print(etree.tostring(elem, encoding='unicode', pretty_print=True))
+
+        raise e
+
+
+# documents per `insert_many()` call in `load()`
+LOAD_BATCH_SIZE = 1000
+
+
+def load(items, db, batch_size=LOAD_BATCH_SIZE, prepared=False):
+    """
+    Validates the documents one by one and inserts them in unordered
+    batches of up to `batch_size` documents per collection.  Prints the
+    number of records and the rate per collection.
+
+    If `prepared` is true, the documents are expected to be validated
+    already (see `_prepare()`).
+    """
+    # TODO: can we avoid repeating this?
+    Entity._get_database = lambda: db
+
+    batches = dict((model, []) for model in MODELS)
+    counts = dict((model, 0) for model in MODELS)
+    durations = dict((model, 0) for model in MODELS)
+
+    def _flush(model):
+        started = time.time()
+        batch = batches[model]
         try:
-            model(data).save()
-        except Exception as e:
-            tag_ln = etree.QName(elem.tag).localname
+            model._get_collection().insert_many([x for x, _ in batch],
+                                                ordered=False)
+        except BulkWriteError as e:
+            # the elements are gone (if streaming), point to them by IDs
             print('=====================================================')
             print()
-            print('ERROR loading (validating and saving) {} tag:'.format(tag_ln))
-            print(etree.tostring(elem, encoding='unicode', pretty_print=True))
-            pprint.pprint(data)
-
+            for error in e.details['writeErrors']:
+                doc, label = batch[error['index']]
+                print('ERROR loading (saving) {}: {}'.format(label,
+                                                             error['errmsg']))
+                pprint.pprint(doc)
             raise e
+        counts[model] += len(batch)
+        durations[model] += time.time() - started
+        del batch[:]
+
+    for elem, model, data in items:
+        started = time.time()
+        doc = data if prepared else _prepare(model, elem, data)
+        batches[model].append((doc, _describe_element(elem)))
+        durations[model] += time.time() - started
+
+        if len(batches[model]) >= batch_size:
+            _flush(model)
+
+    for model in MODELS:
+        if batches[model]:
+            _flush(model)
+
+    for model in MODELS:
+        if counts[model]:
+            print('  * {}: {} records, {:.0f}/s'.format(
+                model.entity_name, counts[model],
+                counts[model] / max(durations[model], 1e-6)))
+
+
+def _prepare(model, elem, data):
+    "Returns the document for given data as it is to be saved"
+    try:
+        return model(data).prepare_to_save()
+    except Exception as e:
+        tag_ln = etree.QName(elem.tag).localname
+        print('=====================================================')
+        print()
+        print('ERROR loading (validating) {} tag:'.format(tag_ln))
+        print(etree.tostring(elem, encoding='unicode', pretty_print=True))
+        pprint.pprint(data)
+
+        raise e
+
+
+def _describe_element(elem):
+    "Returns a short reference to given record for error messages"
+    attrs = ' '.join('{}="{}"'.format(k, elem.get(k))
+                     for k in ('id', 'handle', 'key') if elem.get(k))
+    return '<{} {}>'.format(etree.QName(elem.tag).localname, attrs)
+
+
+def import_from_xml(path, db, in_memory=False, batch_size=LOAD_BATCH_SIZE,
+                    workers=None):
+    if in_memory:
+        if workers:
+            raise ValueError('Parallel transform requires streaming import')
+        transformed = transform(extract(path))
+    else:
+        transformed = transform_stream(path, workers)
+
+    print('Loading...')
+    load(transformed, db, batch_size, prepared=bool(workers))
+
+    print('Creating indexes...')
+    for line in ensure_indexes():
+        print('  * {}'.format(line))
+
+    # e.g. the bounds of people's events: the events may be loaded after
+    # the people who refer to them
+    print('Building derived fields...')
+    for line in build_derived_fields(related_only=True):
+        print('  * {}'.format(line))
+
+    print('Building place hierarchy...')
+    for line in build_place_closure():
+        print('  * {}'.format(line))
+
+    # derived in-memory indices (in all processes) are stale now
+    generation = bump_data_generation()
+    print('Data generation is now {}'.format(generation))
 
+    # The search index and the sort keys include group names, so they are
+    # built after the bump, so that the name aliases are not taken from
+    # the cache (e.g. loaded by the web app from the previous import).
+    print('Building search index...')
+    for line in build_search_index():
+        print('  * {}'.format(line))
 
-def import_from_xml(path, db):
-    extracted = extract(path)
-    transformed = transform(extracted)
-    loaded = load(transformed, db)
+    print('Building sort keys...')
+    for line in build_sort_keys():
+        print('  * {}'.format(line))
@@ -0,0 +1,127 @@
+#
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+"""
+Extract, Transform, Load: Handle Table
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Gramps XML refers to records by internal IDs ("handles") while WTFamily
+uses the "public" IDs.  The import needs the whole mapping before the first
+record can be translated, so it must fit in memory even for a large file
+read in the streaming mode.
+
+A `dict` of a million handles to IDs takes a few hundred megabytes (two
+`str` objects and a hash table slot per entry).  `HandleTable` keeps a
+64-bit hash of each handle in a sorted `array` and all IDs in a single
+`bytes` blob, which is around 30 bytes per entry, and looks the IDs up
+with a binary search.
+"""
+from array import array
+from bisect import bisect_left
+import hashlib
+
+import numpy as np
+
+
+def _hash(handle):
+    digest = hashlib.blake2b(handle.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class HandleTable:
+    """
+    A read-only mapping of handles to IDs, filled with `add()` and then
+    `freeze()`::
+
+        table = HandleTable()
+        table.add('_f1a2b3', 'I0001')
+        table.freeze()
+        table['_f1a2b3']    # → 'I0001'
+
+    Only the hashes of the handles are kept, so the table cannot tell a
+    missing handle from another one with the same hash; `freeze()` refuses
+    to proceed if two handles share a hash (including a duplicate handle),
+    so that a ref is never silently resolved to a wrong record.
+    """
+    def __init__(self):
+        self._hashes = array('Q')
+        self._offsets = array('Q')
+        self._ends = None
+        self._blob = bytearray()
+        self._frozen = False
+
+    def add(self, handle, pk):
+        if self._frozen:
+            raise RuntimeError('Cannot add to a frozen HandleTable')
+        self._hashes.append(_hash(handle))
+        self._offsets.append(len(self._blob))
+        self._blob += pk.encode()
+
+    def freeze(self):
+        "Sorts the table for lookups.  Returns the table itself."
+        if self._frozen:
+            return self
+        hashes = np.frombuffer(self._hashes, dtype=np.uint64)
+        starts = np.frombuffer(self._offsets, dtype=np.uint64)
+        ends = np.append(starts[1:], np.uint64(len(self._blob)))
+
+        order = np.argsort(hashes, kind='stable')
+        hashes = hashes[order]
+        if np.any(hashes[1:] == hashes[:-1]):
+            dupes = hashes[1:][hashes[1:] == hashes[:-1]]
+            raise ValueError('Duplicate handles or hash collision: {} '
+                             'entries'.format(len(dupes)))
+
+        self._hashes = array('Q', hashes.tobytes())
+        self._offsets = array('Q', starts[order].tobytes())
+        self._ends = array('Q', ends[order].tobytes())
+        self._blob = bytes(self._blob)
+        self._frozen = True
+        return self
+
+    def _find(self, handle):
+        if not self._frozen:
+            raise RuntimeError('HandleTable must be frozen before lookups')
+        key = _hash(handle)
+        i = bisect_left(self._hashes, key)
+        if i < len(self._hashes) and self._hashes[i] == key:
+            return i
+        return None
+
+    def __getitem__(self, handle):
+        i = self._find(handle)
+        if i is None:
+            raise KeyError(handle)
+        return self._blob[self._offsets[i]:self._ends[i]].decode()
+
+    def get(self, handle, default=None):
+        try:
+            return self[handle]
+        except KeyError:
+            return default
+
+    def __contains__(self, handle):
+        return self._find(handle) is not None
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __repr__(self):
+        return '<HandleTable: {} handles, {}>'.format(
+            len(self), 'frozen' if self._frozen else 'filling')
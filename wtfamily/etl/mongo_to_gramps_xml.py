@@ -106,10 +106,9 @@ def build_xml(db):
     # before we try exporting them.
     id_to_handle = {}
     for model in models:
-        collection = model._get_collection()
-        for item in collection.find({}, projection=['id', 'handle']):
-            item_handle = item.get('handle')
-            item_id = item.get('id')
+        for item in model.find(projection=['id', 'handle']):
+            item_handle = item._data.get('handle')
+            item_id = item._data.get('id')
             if item_handle and item_id:
                 id_to_handle[item_id] = item_handle
 
@@ -42,15 +42,19 @@ from .generic import (
 
     # functions
     tag_translator_factory,
-    _debug
+    _debug,
+    _get_local_name,
 )
 
 
-def _get_child(el, wanted_child_tag):
-    for child_el in el.getchildren():
-        child_tag = etree.QName(child_el.tag).localname
-        if child_tag == wanted_child_tag:
-            return child_el
+def _get_children(el, wanted_child_tags):
+    "Returns the first child per each of given tags, in a single pass."
+    found = {}
+    for child_el in el:
+        child_tag = _get_local_name(child_el.tag)
+        if child_tag in wanted_child_tags and child_tag not in found:
+            found[child_tag] = child_el
+    return found
 
 
 def _dict_from_keys(src_data, verbatim_keys, renamed_keys=None):
@@ -123,10 +127,11 @@ class DateContributor(TagTranslatorContributor):
 
     @classmethod
     def from_xml(cls, el):
-        datestr_el = _get_child(el, 'datestr')
-        dateval_el = _get_child(el, 'dateval')
-        daterange_el = _get_child(el, 'daterange')
-        datespan_el = _get_child(el, 'datespan')
+        children = _get_children(el, cls.TAG_NAMES)
+        datestr_el = children.get('datestr')
+        dateval_el = children.get('dateval')
+        daterange_el = children.get('daterange')
+        datespan_el = children.get('datespan')
 
         # can't say just `foo or bar` because Element.__bool__ is deprecated :(
         elems = datestr_el, dateval_el, daterange_el, datespan_el
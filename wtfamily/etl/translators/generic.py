@@ -62,6 +62,19 @@ ATTR_VALUE_NORMALIZERS_BY_TYPE = {
 }
 
 
+# qualified tag → local name, e.g.
+# "{http://gramps-project.org/xml/1.7.1/}name" → "name"
+_LOCAL_NAMES = {}
+
+
+def _get_local_name(tag):
+    try:
+        return _LOCAL_NAMES[tag]
+    except KeyError:
+        local_name = _LOCAL_NAMES[tag] = etree.QName(tag).localname
+        return local_name
+
+
 def serialize_attr_value(value):
     """
     Converts given value from a Python type to string for XML.
@@ -169,6 +182,15 @@ def tag_translator_factory(tags=None, attrs=None, contributors=None,
 
 # TODO: rename to TagTranslator?
 class TagTranslator:
+    """
+    Translates a tag and its nested tags according to the declarations
+    (`TAGS`, `ATTRS`, etc.).
+
+    The declarations are compiled once per class, when it is created, into
+    lookup tables (see `_compile()`), so `from_xml()` and `to_xml()` don't
+    inspect them per element.  The translators are stateless and each
+    nested tag is handled by a single shared instance of its translator.
+    """
     TAGS = {}
     ATTRS = ()
     AS_TEXT = False
@@ -181,29 +203,54 @@ class TagTranslator:
             # the GrampsXML DTD.
             raise ValueError('TAGS and AS_TEXT are mutually exclusive.')
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._compile()
+
+    @classmethod
+    def _compile(cls):
+        # attr → normalizer (or `None` to let `normalize_attr_value()` fail)
+        attr_types = cls.ATTRS if isinstance(cls.ATTRS, dict) else {}
+        cls._attr_normalizers = dict(
+            (attr, ATTR_VALUE_NORMALIZERS_BY_TYPE.get(attr_types.get(attr)))
+            for attr in cls.ATTRS)
+        cls._attr_order = sorted(cls.ATTRS)
+        cls._attr_names = frozenset(cls.ATTRS)
+
+        # tag → `(handler, is_list, cardinality)`
+        cls._tag_handlers = {}
+        for nested_tag, Translator in cls.TAGS.items():
+            cardinality = None
+            if isinstance(Translator, AbstractTagCardinality):
+                cardinality = Translator
+            is_list = not (cardinality and cardinality.SINGLE_VALUE)
+            cls._tag_handlers[nested_tag] = Translator(), is_list, cardinality
+        cls._tag_order = [(k, cls._tag_handlers[k]) for k in sorted(cls.TAGS)]
+
+        contributed = [c.TAG_NAMES for c in cls.CONTRIBUTORS]
+        cls._expected_tag_names = list(itertools.chain(cls.TAGS, *contributed))
+
     @property
     def expected_tag_names(self):
-        declared = self.TAGS.keys()
-        contributed = [c.TAG_NAMES for c in self.CONTRIBUTORS]
-
-        return list(itertools.chain(declared, *contributed))
+        return self._expected_tag_names
 
     def from_xml(self, el, handle_to_id=None):
         data = {}
         attrs = {}
 
-        for attr in el.attrib:
-            if attr not in self.ATTRS:
+        for attr, value in el.items():
+            try:
+                normalizer = self._attr_normalizers[attr]
+            except KeyError:
                 _debug('{}: unexpected attr {}'.format(el.tag, attr))
 
                 continue
 
-            target_type = None
-            if isinstance(self.ATTRS, dict):
-                target_type = self.ATTRS[attr]
-
-            value = el.get(attr)
-            attrs[attr] = normalize_attr_value(value, target_type)
+            if normalizer:
+                attrs[attr] = normalizer(value)
+            else:
+                attrs[attr] = normalize_attr_value(value,
+                                                   self.ATTRS.get(attr))
 
         try:
             attrs = self.post_normalize_attrs(attrs, handle_to_id)
@@ -219,28 +266,24 @@ class TagTranslator:
         if self.TEXT_UNDER_KEY:
             data[self.TEXT_UNDER_KEY] = el.text
 
+        tag_handlers = self._tag_handlers
+
         for nested_el in el:
             # Use the local name instead of the qualified one,
             # i.e. "{http://gramps-project.org/xml/1.7.1/}name" → "name"
-            nested_tag = etree.QName(nested_el.tag).localname
+            nested_tag = _get_local_name(nested_el.tag)
 
-            if nested_tag not in self.TAGS:
+            try:
+                translator, is_list, _ = tag_handlers[nested_tag]
+            except KeyError:
                 # sanity check
-                if nested_tag not in self.expected_tag_names:
+                if nested_tag not in self._expected_tag_names:
                     _debug('{}: nested tag {} not in expected {}'
                            .format(el.tag, nested_tag, self.expected_tag_names))
 
                 # expected to be handled by a TagTranslatorContributor
                 continue
 
-            Translator = self.TAGS[nested_tag]
-            translator = Translator()
-
-            is_list = True
-            if isinstance(Translator, AbstractTagCardinality):
-                if Translator.SINGLE_VALUE:
-                    is_list = False
-
             #key = translator.KEY or nested_tag
             key = nested_tag
             value = translator.from_xml(nested_el, handle_to_id=handle_to_id)
@@ -262,15 +305,19 @@ class TagTranslator:
 
         attrs = self.pre_serialize_attrs(data, id_to_handle)
 
-        for attr in sorted(attrs):
+        # `pre_serialize_attrs()` may add or remove attributes
+        if attrs.keys() == self._attr_names:
+            attr_order = self._attr_order
+        else:
+            attr_order = sorted(attrs)
+
+        for attr in attr_order:
             value = attrs[attr]
 
             if value is not None:
                 el.set(attr, serialize_attr_value(value))
 
-        for nested_tag in sorted(self.TAGS):
-            Translator = self.TAGS[nested_tag]
-
+        for nested_tag, (translator, _, cardinality) in self._tag_order:
             # NOTE: subtag == key, but may be different
             values = data.get(nested_tag)
 
@@ -279,11 +326,10 @@ class TagTranslator:
             elif not isinstance(values, list):
                 values = [values]
 
-            if isinstance(Translator, AbstractTagCardinality):
-                Translator.validate_values(values)
+            if cardinality:
+                cardinality.validate_values(values)
 
             for value in values:
-                translator = Translator()
                 nested_el = translator.to_xml(nested_tag, value, id_to_handle)
                 el.append(nested_el)
 
@@ -338,6 +384,9 @@ class TagTranslator:
         return value
 
 
+TagTranslator._compile()
+
+
 class TextTagTranslator(TagTranslator):
     """
     Generates a ``<foo>some text</foo>`` element.
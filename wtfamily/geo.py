@@ -0,0 +1,101 @@
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+"""
+Vectorized great-circle distances.
+
+Coordinates are given as `(lat, lng)` pairs in degrees (see
+`Place.coords_tuple`); missing ones are `None` and result in NaN distances.
+Everything is computed with the haversine formula on NumPy arrays, so
+a whole distance matrix or a list of route legs costs a handful of array
+operations instead of a Python-level call per pair.  On the mean Earth
+radius the error against an ellipsoidal model is well under 0.5%, which
+is plenty for migration analysis.
+"""
+import numpy as np
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def to_radians(coords):
+    """
+    Returns an `(n, 2)` array of given `(lat, lng)` pairs in radians,
+    with NaN in place of missing (`None`) pairs.
+    """
+    items = [(np.nan, np.nan) if x is None else x for x in coords]
+    return np.radians(np.array(items, dtype=float).reshape(-1, 2))
+
+
+def _haversine(lat1, lng1, lat2, lng2):
+    h = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2)
+    # rounding may push `h` slightly above 1 for antipodal points
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(h, 1)))
+
+
+def distance(coords, other_coords):
+    "Returns the distance in km between two points (NaN if either is unknown)."
+    a = to_radians([coords, other_coords])
+    return float(_haversine(a[0, 0], a[0, 1], a[1, 0], a[1, 1]))
+
+
+def distance_matrix(coords, other_coords=None):
+    """
+    Returns an `(n, m)` array of distances in km between each of `coords`
+    and each of `other_coords` (or each other if not given).
+    """
+    a = to_radians(coords)
+    b = a if other_coords is None else to_radians(other_coords)
+    return _haversine(a[:, 0, None], a[:, 1, None], b[None, :, 0], b[None, :, 1])
+
+
+def leg_distances(coords):
+    """
+    Returns an array of `n - 1` distances in km between consecutive points
+    of a route.
+    """
+    a = to_radians(coords)
+    return _haversine(a[:-1, 0], a[:-1, 1], a[1:, 0], a[1:, 1])
+
+
+def route_lengths(routes):
+    """
+    Returns an array with the total length in km of each of given routes
+    (sequences of coordinates).  Unknown points are skipped, i.e. the route
+    goes straight from the previous known point to the next one.
+
+    All routes are concatenated and measured in one pass; the legs which
+    would join the end of one route to the start of the next are dropped.
+    """
+    routes = [[p for p in x if p is not None] for x in routes]
+    sizes = np.array([len(x) for x in routes], dtype=int)
+    lengths = np.zeros(len(routes))
+    if sizes.sum() < 2:
+        return lengths
+
+    legs = leg_distances([p for x in routes for p in x])
+
+    # leg `i` connects points `i` and `i + 1`; the route of point `i + 1`
+    # owns it unless that point is the first one of its route
+    starts = np.cumsum(sizes) - sizes
+    owners = np.repeat(np.arange(len(routes)), sizes)[1:]
+    is_inner = np.ones(len(legs), dtype=bool)
+    is_inner[starts[(sizes > 0) & (starts > 0)] - 1] = False
+    np.add.at(lengths, owners[is_inner], legs[is_inner])
+    return lengths
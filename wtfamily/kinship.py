@@ -0,0 +1,402 @@
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+"""
+Kinship graph: an in-memory index of parent, child, partner and sibling
+relations between people, built from the `families` collection.
+
+People are mapped to consecutive integers and each kind of relation is
+stored as a compact adjacency list (an offsets array and a targets array),
+so that answering "who are the parents of X" costs a dict lookup and an
+array slice instead of several database queries per hop.
+"""
+from array import array
+
+from cache import GenerationalCache
+
+
+FAMILY_PROJECTION = ['id', 'father', 'mother', 'childref']
+
+# relations followed by `KinshipGraph.find_path()` (siblings are reached via
+# a common parent) and their inverses
+PATH_KINDS = 'parents', 'children', 'partners'
+INVERSE_KINDS = {
+    'parents': 'children',
+    'children': 'parents',
+    'partners': 'partners',
+}
+
+
+class Adjacency:
+    """
+    Compressed sparse row representation of directed edges between
+    int-indexed nodes.
+    """
+    def __init__(self, lists):
+        self.offsets = array('l', [0])
+        self.targets = array('l')
+        for targets in lists:
+            self.targets.extend(targets)
+            self.offsets.append(len(self.targets))
+
+    def __getitem__(self, node):
+        return self.targets[self.offsets[node]:self.offsets[node + 1]]
+
+    def __len__(self):
+        return len(self.targets)
+
+
+class KinshipGraph:
+    KINDS = 'parents', 'children', 'partners', 'siblings'
+
+    def __init__(self, families):
+        """
+        :param families: an iterable of family documents (only `father`,
+            `mother` and `childref` keys are used).
+        """
+        self.ids = []
+        self.index = {}
+
+        parents, children, partners, siblings = {}, {}, {}, {}
+
+        for family in families:
+            # same order as in the original `Person.get_parents()`
+            family_parents = [self._add(family[k]['id'])
+                              for k in ('mother', 'father') if k in family]
+            family_children = [self._add(ref['id'] if isinstance(ref, dict)
+                                         else ref)
+                               for ref in family.get('childref', [])]
+
+            for child in family_children:
+                _extend_unique(parents, child, family_parents)
+                _extend_unique(siblings, child,
+                               [x for x in family_children if x != child])
+
+            for parent in family_parents:
+                _extend_unique(children, parent, family_children)
+                _extend_unique(partners, parent,
+                               [x for x in family_parents if x != parent])
+
+        size = len(self.ids)
+        self.parents = Adjacency(parents.get(i, ()) for i in range(size))
+        self.children = Adjacency(children.get(i, ()) for i in range(size))
+        self.partners = Adjacency(partners.get(i, ()) for i in range(size))
+        self.siblings = Adjacency(siblings.get(i, ()) for i in range(size))
+
+    def __repr__(self):
+        return '<{} {} people, {} parent links, {} partner links>'.format(
+            self.__class__.__name__, len(self.ids), len(self.parents),
+            len(self.partners))
+
+    def __contains__(self, pk):
+        return pk in self.index
+
+    def _add(self, pk):
+        try:
+            return self.index[pk]
+        except KeyError:
+            node = self.index[pk] = len(self.ids)
+            self.ids.append(pk)
+            return node
+
+    @classmethod
+    def from_collection(cls, collection):
+        return cls(collection.find({}, projection=FAMILY_PROJECTION))
+
+    def related_ids(self, kind, pk):
+        """
+        Returns IDs of people related to given person.
+
+        :param kind: one of `KINDS`.
+        """
+        assert kind in self.KINDS, kind
+        try:
+            node = self.index[pk]
+        except KeyError:
+            return []
+        ids = self.ids
+        return [ids[x] for x in getattr(self, kind)[node]]
+
+    def iter_generations(self, pk, kind, max_generations=None):
+        """
+        Breadth-first traversal along given kind of relation (normally
+        `parents` or `children`).  Yields ``(generation, ids)`` pairs starting
+        with ``(0, [pk])``.  Each person is yielded at most once (at the
+        nearest generation), so pedigree collapse does not multiply the work.
+
+        :param max_generations: if given, stop after this many generations
+            away from the starting person.
+        """
+        assert kind in self.KINDS, kind
+
+        yield 0, [pk]
+
+        try:
+            start = self.index[pk]
+        except KeyError:
+            return
+
+        adjacency = getattr(self, kind)
+        visited = {start}
+        current = [start]
+        generation = 0
+
+        while current:
+            generation += 1
+            if max_generations is not None and generation > max_generations:
+                return
+
+            following = []
+            for node in current:
+                for other in adjacency[node]:
+                    if other not in visited:
+                        visited.add(other)
+                        following.append(other)
+
+            if following:
+                yield generation, [self.ids[x] for x in following]
+
+            current = following
+
+    def find_path(self, pk, other_pk, max_length=None):
+        """
+        Returns the shortest path between two people as a list of
+        ``(id, kind)`` pairs, where `kind` is how the person relates to the
+        previous one (`None` for the first one), e.g.::
+
+            [('I1', None), ('I2', 'parents'), ('I3', 'children')]
+
+        means that I2 is a parent of I1 and I3 is a child of I2.
+        Returns `None` if the people are not related.
+
+        Both ends are searched breadth-first at once, always expanding the
+        smaller frontier, so the work is roughly the square root of what
+        a one-way search would need.
+
+        :param max_length: give up on paths longer than this.
+        """
+        if pk == other_pk:
+            return [(pk, None)] if pk in self.index else None
+        try:
+            start = self.index[pk]
+            goal = self.index[other_pk]
+        except KeyError:
+            return None
+
+        # node -> (neighbour towards the start/goal, kind, distance)
+        forward = {start: (None, None, 0)}
+        backward = {goal: (None, None, 0)}
+        forward_front = [start]
+        backward_front = [goal]
+        length = 0
+
+        while forward_front and backward_front:
+            if max_length is not None and length >= max_length:
+                return None
+            length += 1
+            if len(forward_front) <= len(backward_front):
+                forward_front, meeting = self._expand(
+                    forward_front, forward, backward, inverse=False)
+            else:
+                backward_front, meeting = self._expand(
+                    backward_front, backward, forward, inverse=True)
+            if meeting is not None:
+                return self._join_path(meeting, forward, backward)
+
+        return None
+
+    def _expand(self, front, seen, seen_from_other_end, inverse):
+        """
+        Visits the next level of a breadth-first search.  Returns the new
+        front and the node closest to the other end where both searches
+        meet (or `None`).
+        """
+        following = []
+        meeting = None
+        for node in front:
+            distance = seen[node][2] + 1
+            for kind in PATH_KINDS:
+                for other in getattr(self, kind)[node]:
+                    if other in seen:
+                        continue
+                    # the search from the goal walks the edges backwards
+                    seen[other] = (node, INVERSE_KINDS[kind] if inverse
+                                   else kind, distance)
+                    following.append(other)
+                    if other in seen_from_other_end and (
+                            meeting is None or
+                            seen_from_other_end[other][2] <
+                            seen_from_other_end[meeting][2]):
+                        meeting = other
+        return following, meeting
+
+    def _join_path(self, meeting, forward, backward):
+        steps = []
+        node = meeting
+        while node is not None:
+            previous, kind, _ = forward[node]
+            steps.append((node, kind))
+            node = previous
+        steps.reverse()
+
+        node = meeting
+        while backward[node][0] is not None:
+            following, kind, _ = backward[node]
+            steps.append((following, kind))
+            node = following
+
+        return [(self.ids[node], kind) for node, kind in steps]
+
+    def parents_of(self, pk):
+        return self.related_ids('parents', pk)
+
+    def children_of(self, pk):
+        return self.related_ids('children', pk)
+
+    def partners_of(self, pk):
+        return self.related_ids('partners', pk)
+
+    def siblings_of(self, pk):
+        return self.related_ids('siblings', pk)
+
+
+# neutral term -> (male, female)
+GENDERED_TERMS = {
+    'parent': ('father', 'mother'),
+    'grandparent': ('grandfather', 'grandmother'),
+    'child': ('son', 'daughter'),
+    'grandchild': ('grandson', 'granddaughter'),
+    'sibling': ('brother', 'sister'),
+    'aunt or uncle': ('uncle', 'aunt'),
+    'niece or nephew': ('nephew', 'niece'),
+    'partner': ('husband', 'wife'),
+}
+ORDINALS = ('first', 'second', 'third', 'fourth', 'fifth', 'sixth',
+            'seventh', 'eighth', 'ninth', 'tenth')
+TIMES = {1: 'once', 2: 'twice', 3: 'thrice'}
+
+
+def describe_path(kinds, genders=()):
+    """
+    Returns a kinship label for a path found by `KinshipGraph.find_path()`,
+    e.g. ``'second cousin once removed'`` or ``"wife's brother"``.
+
+    :param kinds: the kinds of the steps (without the leading `None`).
+    :param genders: genders (``'M'``, ``'F'`` or anything else if unknown)
+        of the people on the path including the first one; used to pick
+        e.g. "mother" instead of "parent".
+    """
+    kinds = list(kinds)
+    genders = list(genders) + [None] * (len(kinds) + 1 - len(genders))
+
+    if not kinds:
+        return 'self'
+
+    # the path is split into blood relations (up to a common ancestor, then
+    # down to the relative) and partnerships; each part is described
+    # separately and the results are chained: "mother's brother's wife"
+    parts = []
+    up = down = 0
+    for i, kind in enumerate(kinds):
+        if kind == 'parents' and down or kind == 'partners':
+            if up or down:
+                parts.append(label_blood_relation(up, down, genders[i]))
+            up = down = 0
+        if kind == 'parents':
+            up += 1
+        elif kind == 'children':
+            down += 1
+        else:
+            parts.append(_gendered('partner', genders[i + 1]))
+    if up or down:
+        parts.append(label_blood_relation(up, down, genders[-1]))
+
+    return "'s ".join(parts)
+
+
+def label_blood_relation(up, down, gender=None):
+    """
+    Returns a kinship label for a person who is `down` generations below
+    a common ancestor which is `up` generations above the other person.
+    """
+    if not (up or down):
+        return 'self'
+    if not down:
+        return _with_greats('parent', up, gender)
+    if not up:
+        return _with_greats('child', down, gender)
+    if up == down == 1:
+        return _gendered('sibling', gender)
+    if down == 1:
+        return _with_greats('aunt or uncle', up - 1, gender, grand=False)
+    if up == 1:
+        return _with_greats('niece or nephew', down - 1, gender, grand=False)
+
+    degree = min(up, down) - 1
+    removed = abs(up - down)
+    label = '{} cousin'.format(_ordinal(degree))
+    if removed:
+        label += ' {} removed'.format(TIMES.get(removed,
+                                                '{} times'.format(removed)))
+    return label
+
+
+def _with_greats(term, generations, gender, grand=True):
+    """
+    ``('parent', 3) -> 'great-grandparent'``,
+    ``('aunt or uncle', 3, grand=False) -> 'great-great-aunt or uncle'``
+    """
+    greats = generations - 1
+    if grand and generations > 1:
+        term = 'grand' + term
+        greats -= 1
+    return 'great-' * greats + _gendered(term, gender)
+
+
+def _gendered(term, gender):
+    male, female = GENDERED_TERMS[term]
+    return {'M': male, 'F': female}.get(gender, term)
+
+
+def _ordinal(number):
+    if number <= len(ORDINALS):
+        return ORDINALS[number - 1]
+    return '{}th'.format(number)
+
+
+def _extend_unique(lists, key, values):
+    existing = lists.setdefault(key, [])
+    existing.extend(x for x in values if x not in existing)
+
+
+_graphs = GenerationalCache()
+
+
+def get_graph(collection, generation=None):
+    """
+    Returns the kinship graph for given `families` collection.  The graph is
+    built on first access and then reused while the data generation stays
+    the same (or until `invalidate()` is called).
+    """
+    return _graphs.get(collection.full_name, generation,
+                       lambda: KinshipGraph.from_collection(collection))
+
+
+def invalidate():
+    "Drops all cached graphs."
+    _graphs.clear()
@@ -16,26 +16,47 @@
 #
 #    You should have received a copy of the GNU Lesser General Public License
 #    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+from collections import OrderedDict, namedtuple
+import calendar
+import copy
 import datetime
 import functools
 import itertools
+import random
 import re
+import sys
+import threading
+import time
+import types
 
-from cached_property import cached_property
-from flask import g
+from flask import g, has_app_context
+from pymongo import UpdateOne
 from dateutil.parser import parse as parse_date
-import geopy.distance
 
+from cache import GenerationalCache
+import geo
+import kinship
 from schema import *
+import search
+from validation import compile_schema
 
 
 RELATED_KEY_PREFIX = 'related_'
+# see `QuerySet.aggregate()` with relation paths
+PREFETCHED_KEY_PREFIX = 'prefetched_'
 
 
 class ObjectNotFound(Exception):
     pass
 
 
+class FieldNotLoaded(Exception):
+    """
+    Raised on access to a field which was excluded by a projection
+    (see `PartialDocument`).
+    """
+
+
 def as_list(f):
     @functools.wraps(f)
     def inner(*args, **kwargs):
@@ -44,27 +65,712 @@ def as_list(f):
     return inner
 
 
+# Shared read-only placeholder for per-instance caches that were never
+# written to; saves an empty dict per instance.
+EMPTY_CACHE = types.MappingProxyType({})
+
+
+class cached_slot_property:
+    """
+    A `cached_property` for classes with `__slots__`: the computed value is
+    stored in the instance's `_cache` mapping instead of its `__dict__`.
+    """
+    def __init__(self, func):
+        functools.update_wrapper(self, func)
+        self.func = func
+        self.name = func.__name__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        try:
+            return obj._cache[self.name]
+        except KeyError:
+            pass
+        value = self.func(obj)
+        if obj._cache is EMPTY_CACHE:
+            obj._cache = {}
+        obj._cache[self.name] = value
+        return value
+
+
 def icount(iterable):
     return sum(1 for _ in iterable)
 
 
+class Relation(namedtuple('Relation', 'model_name key')):
+    """
+    Declares a relation in `Entity.RELATIONS`: the name of the referenced
+    model and the key that holds the references, e.g.
+    ``Relation('Event', 'eventref.id')``.
+    """
+    @property
+    def model(self):
+        return globals()[self.model_name]
+
+    @property
+    def cache_key(self):
+        return _strip_id_suffix(self.key)
+
+    def get_pks(self, obj):
+        return _extract_ids(obj, self.cache_key)
+
+
+class KinshipRelation(namedtuple('KinshipRelation', 'kind')):
+    """
+    Declares a relation between people resolved via the kinship graph
+    (see `kinship.KinshipGraph.KINDS`).
+    """
+    @property
+    def model(self):
+        return Person
+
+    @property
+    def cache_key(self):
+        return self.kind
+
+    def get_pks(self, obj):
+        return obj._get_kinship_graph().related_ids(self.kind, obj.id)
+
+
+Relative = namedtuple('Relative', 'person generation')
+
+# See `Person.find_relationship()`; `kind` is how the person relates to the
+# previous one on the path
+RelationshipStep = namedtuple('RelationshipStep', 'person kind')
+Relationship = namedtuple('Relationship', 'path label')
+
+# See `QuerySet.page()`
+Page = namedtuple('Page', 'items next_after')
+
+# A name node broken into parts, see `Person.parsed_names`
+ParsedName = namedtuple('ParsedName',
+                        'first primary_surnames patronymic nonpatronymic group')
+
+
+class PartialDocument(dict):
+    """
+    A document fetched with a projection.  Reading a top-level field that was
+    not projected either raises `FieldNotLoaded` or fetches the rest of the
+    document, depending on `policy`:
+
+    * ``'fetch'``: load the whole document on first access to a missing
+      field (and complain to stderr, the projection is probably too narrow);
+    * ``'strict'``: raise `FieldNotLoaded`.
+
+    The same applies to access to the whole document (iteration, `keys()`,
+    `items()`, `dict(doc)` etc.); use `loaded_keys()` to only look at what
+    is there.
+    """
+    POLICY_FETCH = 'fetch'
+    POLICY_STRICT = 'strict'
+
+    def __init__(self, data, fields, loader, policy=POLICY_FETCH):
+        super().__init__(data)
+        self.fields = frozenset(f.partition('.')[0] for f in fields) | {'_id'}
+        self.is_complete = False
+        self._loader = loader
+        self._policy = policy
+
+    def _ensure_loaded(self, key):
+        if self.is_complete or key in self.fields:
+            return
+        self._load('{!r}'.format(key))
+
+    def _ensure_complete(self):
+        if not self.is_complete:
+            self._load('the whole document')
+
+    def _load(self, what):
+        if self._policy == self.POLICY_STRICT:
+            raise FieldNotLoaded('{}: {} was not projected'
+                                 .format(super().get('id'), what))
+
+        sys.stderr.write('Partial document {}: fetching the rest for {}\n'
+                         .format(super().get('id'), what))
+        self.update(self._loader())
+        self.is_complete = True
+
+    def loaded_keys(self):
+        "Returns the keys fetched so far (never fetches anything)."
+        return super().keys()
+
+    def __getitem__(self, key):
+        self._ensure_loaded(key)
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        self._ensure_loaded(key)
+        return super().__contains__(key)
+
+    def get(self, key, default=None):
+        self._ensure_loaded(key)
+        return super().get(key, default)
+
+    def __iter__(self):
+        self._ensure_complete()
+        return super().__iter__()
+
+    def __len__(self):
+        self._ensure_complete()
+        return super().__len__()
+
+    def keys(self):
+        self._ensure_complete()
+        return super().keys()
+
+    def values(self):
+        self._ensure_complete()
+        return super().values()
+
+    def items(self):
+        self._ensure_complete()
+        return super().items()
+
+    def copy(self):
+        self._ensure_complete()
+        return dict(self)
+
+
+class QuerySet:
+    """
+    A lazy query: nothing is fetched until the query set is iterated.
+    Returned by `Entity.find()`; every method returns a new query set, so
+    they can be chained::
+
+        Person.find().order_by('sort_keys.name').skip(100).limit(50)
+        Event.find({'type': 'Birth'}).only('date').count()
+        Event.find().aggregate(Place, field='place.id')
+        Person.find().aggregate('parents', 'families.children.events')
+
+    The whole chain compiles to a single MongoDB query (or a pipeline if
+    related models are aggregated).  Each iteration runs it again.
+    """
+    def __init__(self, model, conditions=None, projection=None):
+        self.model = model
+        self.conditions = conditions or {}
+        self.projection = model._normalize_projection(projection)
+        self.sort = []
+        self.offset = 0
+        self.size = 0
+        # `(related model, local field, foreign field)` for `aggregate()`
+        self.lookups = []
+        # relation name -> the same for nested relations, see `aggregate()`
+        self.relations = OrderedDict()
+
+    def __repr__(self):
+        return '<{} {.__name__} {}>'.format(
+            self.__class__.__name__, self.model, self.conditions)
+
+    def _clone(self, **attrs):
+        clone = self.__class__(self.model)
+        clone.__dict__.update(self.__dict__, **attrs)
+        return clone
+
+    def filter(self, conditions=None, **kwargs):
+        "Adds conditions (combined with the existing ones by AND)."
+        conditions = dict(conditions or {}, **kwargs)
+        if not self.conditions:
+            combined = conditions
+        elif not conditions:
+            combined = self.conditions
+        elif set(conditions) & set(self.conditions):
+            combined = {'$and': [self.conditions, conditions]}
+        else:
+            combined = dict(self.conditions, **conditions)
+        return self._clone(conditions=combined)
+
+    def order_by(self, *keys):
+        """
+        Sorts by given keys; a key prefixed with ``-`` means descending
+        order.  Replaces the previous ordering.
+        """
+        sort = [(k[1:], -1) if k.startswith('-') else (k, 1) for k in keys]
+        return self._clone(sort=sort)
+
+    def skip(self, number):
+        return self._clone(offset=number)
+
+    def limit(self, number):
+        return self._clone(size=number)
+
+    def only(self, *fields):
+        "Fetches only given fields (see `PartialDocument`)."
+        return self._clone(projection=self.model._normalize_projection(fields))
+
+    def aggregate(self, *related, field=None, foreign_field=None):
+        """
+        Loads related instances along with the results, in the same
+        pipeline.  Each item of `related` is either:
+
+        * a (dotted) relation path, as in `Entity.prefetch()`, e.g.
+          ``'families.children.events'``.  The related instances go to the
+          prefetch cache, so `find_related()` and the properties based on it
+          don't query the database.  Kinship relations (`parents`, etc.)
+          are looked up through the families;
+
+        * a model.  Its related instances are embedded in the instance's
+          data under ``related_<entity_name>``.  The keys are inferred from
+          `REFERENCES` unless given:
+
+          :param field: the key in this model's documents (`id` if the other
+              model references this one).
+          :param foreign_field: the key in the related model's documents.
+
+        Nested relations require MongoDB 5.0 (see `get_pipeline()`).
+        """
+        lookups = list(self.lookups)
+        relations = copy.deepcopy(self.relations)
+        for item in related:
+            if isinstance(item, str):
+                _add_relation_path(self.model, relations, item)
+            else:
+                lookups.append(self._make_model_lookup(item, field,
+                                                       foreign_field))
+        return self._clone(lookups=lookups, relations=relations)
+
+    def _make_model_lookup(self, related_model, field, foreign_field):
+        assert issubclass(related_model, Entity), related_model
+        model = self.model
+        if field is None:
+            field = model.REFERENCES.get(related_model.__name__, 'id')
+        if foreign_field is None:
+            foreign_field = related_model.REFERENCES.get(model.__name__, 'id')
+        if field == foreign_field:
+            raise ValueError('Could not find a reference between {.__name__} '
+                             'and {.__name__}'.format(model, related_model))
+        return related_model, field, foreign_field
+
+    @property
+    def is_aggregation(self):
+        return bool(self.lookups or self.relations)
+
+    def count(self):
+        "Returns the number of matching documents (with skip and limit)."
+        _log_query(self.model, self.conditions)
+        options = {}
+        if self.offset:
+            options['skip'] = self.offset
+        if self.size:
+            options['limit'] = self.size
+        return self.model._get_collection().count_documents(self.conditions,
+                                                            **options)
+
+    def first(self):
+        for obj in self.limit(1):
+            return obj
+
+    def page(self, size, after=None, key='id'):
+        """
+        Returns a `Page` of up to `size` instances ordered by given key (and
+        `id` for ties) and the position to pass as `after` for the next
+        page, or `None` if this is the last one.  The position is
+        a ``(key value, id)`` pair.
+
+        Unlike `skip()`, this costs the same for any page as long as there
+        is an index on ``(key, id)``.
+        """
+        queryset = self
+        if after is not None:
+            queryset = queryset.filter(_make_keyset_conditions(key, *after))
+        if key == 'id':
+            queryset = queryset.order_by('id')
+        else:
+            queryset = queryset.order_by(key, 'id')
+            top_key = key.partition('.')[0]
+            if self.projection and top_key not in self.projection:
+                queryset = queryset._clone(
+                    projection=self.projection + [top_key])
+
+        items = list(queryset.limit(size + 1))
+        if len(items) <= size:
+            return Page(items, None)
+        items = items[:size]
+        last = items[-1]
+        return Page(items, (_get_dotted(last._data, key), last.id))
+
+    def get_pipeline(self):
+        """
+        Returns the aggregation pipeline equivalent to this query set: a
+        single `$match` (and sorting and paging, so that only the documents
+        in the page are joined), then a `$lookup` per related model or
+        relation, then the projection.
+
+        Nested relations use the `$lookup` syntax with both `localField`
+        and `pipeline` (MongoDB 5.0+), which keeps the join on the indexed
+        `id` of the related collection.
+        """
+        stages = []
+        if self.conditions:
+            stages.append({'$match': self.conditions})
+        if self.sort:
+            stages.append({'$sort': OrderedDict(self.sort)})
+        if self.offset:
+            stages.append({'$skip': self.offset})
+        if self.size:
+            stages.append({'$limit': self.size})
+        for related_model, field, foreign_field in self.lookups:
+            stages.append(_make_lookup_stage(
+                related_model, field, RELATED_KEY_PREFIX +
+                related_model.entity_name, foreign_field=foreign_field))
+        stages.extend(_make_relation_lookup_stages(self.model, self.relations))
+        if self.projection:
+            fields = (self.projection +
+                      [RELATED_KEY_PREFIX + m.entity_name
+                       for m, _, _ in self.lookups] +
+                      [PREFETCHED_KEY_PREFIX + x for x in self.relations])
+            stages.append({'$project': dict((k, 1) for k in fields)})
+        return stages
+
+    def _get_cursor(self):
+        cursor = self.model._get_collection().find(self.conditions,
+                                                   self.projection)
+        if self.sort:
+            cursor = cursor.sort(self.sort)
+        if self.offset:
+            cursor = cursor.skip(self.offset)
+        if self.size:
+            cursor = cursor.limit(self.size)
+        return cursor
+
+    def explain(self):
+        """
+        Returns MongoDB's explanation of the query (or the pipeline).
+        See also `get_plan_stages()`.
+        """
+        if not self.is_aggregation:
+            return self._get_cursor().explain()
+        collection = self.model._get_collection()
+        return collection.database.command(
+            'aggregate', collection.name, pipeline=self.get_pipeline(),
+            explain=True)
+
+    def get_plan_stages(self):
+        """
+        Returns the stage names of the winning plan, e.g. ``['FETCH',
+        'IXSCAN']``.  For a pipeline pushed down to the query engine (MongoDB
+        6.0+) this includes the joins, e.g. ``EQ_LOOKUP``; otherwise only the
+        initial query is covered, see `explain()` for the `$lookup` stages.
+        """
+        explained = self.explain()
+        if 'queryPlanner' not in explained:
+            explained = explained['stages'][0]['$cursor']
+        plan = explained['queryPlanner']['winningPlan']
+        return list(_iter_plan_stages(plan))
+
+    def __iter__(self):
+        _log_query(self.model, self.conditions)
+        if self.is_aggregation:
+            items = self.model._get_collection().aggregate(self.get_pipeline())
+            return (self._from_aggregated(x) for x in items)
+        return (self._from_document(x) for x in self._get_cursor())
+
+    def _from_document(self, item):
+        try:
+            return self.model._from_document(item, self.projection)
+        except ValidationError:
+            import pprint
+            sys.stderr.write('ERROR in {.__name__}:\n{}\n'
+                             .format(self.model, pprint.pformat(item)))
+            raise
+
+    def _from_aggregated(self, item):
+        model = self.model
+        prefetched = _pop_prefetched(model, item, self.relations)
+        related = {}
+        for related_model, _, _ in self.lookups:
+            key = RELATED_KEY_PREFIX + related_model.entity_name
+            related[key] = [related_model(x) for x in item.pop(key)]
+
+        if self.projection:
+            fields = self.projection + list(related)
+            obj = model(model._make_partial_document(dict(item, **related),
+                                                     fields))
+        else:
+            obj = model(item)
+            obj._data = dict(obj._data, **related)
+        if prefetched:
+            obj._prefetched = dict(obj._prefetched, **prefetched)
+        return obj
+
+
+# How kinship relations are looked up in the database: via given relation
+# to families, then via given family relations to people
+KINSHIP_VIA_FAMILIES = {
+    'parents': ('parent_families', ('mother', 'father')),
+    'siblings': ('parent_families', ('children',)),
+    'partners': ('families', ('mother', 'father')),
+    'children': ('families', ('children',)),
+}
+
+
+def _add_relation_path(model, tree, path):
+    "Adds a dotted relation path to a tree of relation names (see `QuerySet`)"
+    name, _, subpath = path.partition('.')
+
+    try:
+        relation = model.RELATIONS[name]
+    except KeyError:
+        raise ValueError('{.__name__} has no relation "{}"'
+                         .format(model, name)) from None
+
+    if not isinstance(relation, (Relation, KinshipRelation)):
+        # an alias for one or more other paths
+        for aliased_path in relation:
+            if subpath:
+                aliased_path = '{}.{}'.format(aliased_path, subpath)
+            _add_relation_path(model, tree, aliased_path)
+        return
+
+    subtree = tree.setdefault(name, OrderedDict())
+    if subpath:
+        _add_relation_path(relation.model, subtree, subpath)
+
+
+def _make_lookup_stage(model, local_field, as_key, tree=None,
+                       foreign_field='id'):
+    lookup = {
+        'from': model.entity_name,
+        'localField': local_field,
+        'foreignField': foreign_field,
+        'as': as_key,
+    }
+    if tree:
+        lookup['pipeline'] = _make_relation_lookup_stages(model, tree)
+    return {'$lookup': lookup}
+
+
+def _make_relation_lookup_stages(model, tree):
+    stages = []
+    for name, subtree in tree.items():
+        relation = model.RELATIONS[name]
+        as_key = PREFETCHED_KEY_PREFIX + name
+        if isinstance(relation, KinshipRelation):
+            stages.extend(_make_kinship_lookup_stages(relation.kind, as_key,
+                                                      subtree))
+        else:
+            stages.append(_make_lookup_stage(relation.model, relation.key,
+                                             as_key, subtree))
+    return stages
+
+
+def _make_kinship_lookup_stages(kind, as_key, tree):
+    families_relation, family_relations = KINSHIP_VIA_FAMILIES[kind]
+    families_key = as_key + '_families'
+    family_tree = OrderedDict((x, tree) for x in family_relations)
+    people = {'$reduce': {
+        'input': '$' + families_key,
+        'initialValue': [],
+        'in': {'$concatArrays': ['$$value'] + [
+            '$$this.' + PREFETCHED_KEY_PREFIX + x for x in family_relations]},
+    }}
+    return [
+        _make_lookup_stage(Family, Person.RELATIONS[families_relation].key,
+                           families_key, family_tree),
+        # one's siblings and partners are found in the same families
+        {'$addFields': {as_key: {'$filter': {
+            'input': people,
+            'cond': {'$ne': ['$$this.id', '$id']},
+        }}}},
+        {'$unset': families_key},
+    ]
+
+
+def _pop_prefetched(model, item, tree):
+    """
+    Removes the documents looked up for given relation tree from given raw
+    document and returns a dict of instances in the `_prefetched` format.
+    """
+    prefetched = {}
+    for name, subtree in tree.items():
+        relation = model.RELATIONS[name]
+        related_model = relation.model
+        instances = OrderedDict()
+        for related_item in item.pop(PREFETCHED_KEY_PREFIX + name, []):
+            nested = _pop_prefetched(related_model, related_item, subtree)
+            obj = related_model._from_document(related_item)
+            if nested:
+                obj._prefetched = dict(obj._prefetched, **nested)
+            instances.setdefault(obj.id, obj)
+
+        if isinstance(relation, Relation) and relation.cache_key in item:
+            # `$lookup` does not preserve the order of references
+            pks = _extract_refs(item[relation.cache_key])
+            prefetched[relation.cache_key] = [instances[pk] for pk in pks
+                                              if pk in instances]
+        else:
+            prefetched[relation.cache_key] = list(instances.values())
+    return prefetched
+
+
+class IdentityMap:
+    """
+    Request-scoped registry of loaded entities keyed by (model, id).
+
+    Ensures that a document is fetched and wrapped at most once per request,
+    no matter how many properties (`Family.father`, `Event.place`, etc.)
+    refer to it.  Usage::
+
+        identity_map = IdentityMap()
+        person = identity_map.get(Person, 'I0001')    # → None (miss)
+        identity_map.add(Person.find_one({'id': 'I0001'}))
+        person = identity_map.get(Person, 'I0001')    # → Person (hit)
+
+    """
+    def __init__(self):
+        self._items = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return '<{} {} items, {} hits, {} misses>'.format(
+            self.__class__.__name__, len(self), self.hits, self.misses)
+
+    def peek(self, model, pk):
+        "Same as `get()` but does not affect the counters."
+        return self._items.get((model, pk))
+
+    def get(self, model, pk):
+        try:
+            obj = self._items[model, pk]
+        except KeyError:
+            self.misses += 1
+            return None
+        else:
+            self.hits += 1
+            return obj
+
+    def add(self, obj):
+        """
+        Registers given instance.  If an instance with the same model and ID
+        is already known, the known one is returned so that there's always
+        exactly one object per document.
+        """
+        return self._items.setdefault((type(obj), obj.id), obj)
+
+    def clear(self):
+        self._items.clear()
+
+    @property
+    def stats(self):
+        return {
+            'items': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
 class Entity:
+    # Instances are numerous and short-lived, don't give each a `__dict__`.
+    # Subclasses must declare empty `__slots__` to keep it that way.
+    __slots__ = '_data', '_prefetched', '_cache'
+
     entity_name = NotImplemented
     sort_key = None
     schema = COMMON_SCHEMA
 
     REFERENCES = NotImplemented
 
+    # Named relations that can be batch-loaded with `prefetch()`.
+    # Values are either `Relation` instances or tuples of (dotted) relation
+    # paths which the name is an alias for.
+    RELATIONS = {}
+
+    # Top-level fields read by `_get_pretty_data()`; used as the projection
+    # for lists of public data.  `None` means the whole document.
+    PUBLIC_DATA_FIELDS = None
+
+    # What to do on access to a field not included in the projection
+    # (see `PartialDocument`).
+    PARTIAL_DOCUMENT_POLICY = PartialDocument.POLICY_FETCH
+
+    # Keys (or pymongo index specs) that are queried directly and need an
+    # index in addition to those derived from REFERENCES and RELATIONS.
+    INDEXED_KEYS = ()
+
+    # Whether `search()` is supported (see `get_search_texts()`).
+    SEARCHABLE = False
+
+    # Whether the documents store `sort_keys` for server-side ordering (see
+    # `get_sort_keys()`).  They depend on other documents and are therefore
+    # computed after import by `build_sort_keys()`.
+    SORTABLE = False
+
+    # relations to batch-load when computing sort keys
+    SORT_KEYS_PREFETCH = ()
+
+    # Whether the documents have a top-level `date`.  If so, its numeric
+    # bounds are stored on `save()` and indexed (see `find_in_date_range()`).
+    DATED = False
+
+    # Derived fields which depend on other documents (see
+    # `_update_related_fields()`).  They are computed on `save()` but not by
+    # `prepare_to_save()`, so on import they are built afterwards by
+    # `build_derived_fields()`.
+    RELATED_FIELDS = ()
+
+    # relations to batch-load when computing `RELATED_FIELDS`
+    RELATED_FIELDS_PREFETCH = ()
+
+    # How to validate documents loaded from the database (see
+    # `configure_read_validation()`).  Documents are always fully validated
+    # on `save()`.
+    READ_VALIDATION_TRUST = 'trust'
+    READ_VALIDATION_SAMPLE = 'sample'
+    READ_VALIDATION_FULL = 'full'
+    READ_VALIDATION = READ_VALIDATION_SAMPLE
+    READ_VALIDATION_SAMPLE_RATE = 0.01
+
     # let them access the exception class by Entity (sub)class attribute
     ObjectNotFound = ObjectNotFound
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # compile once at import time instead of interpreting on each call
+        cls._validator = staticmethod(compile_schema(cls.schema))
+
     def __init__(self, data):
         self._data = data
 
-        # XXX degrades performance, don't use in production
-        if __debug__:
+        # related instances batch-loaded by `prefetch()`, by reference key
+        self._prefetched = EMPTY_CACHE
+
+        # values of `cached_slot_property` attributes, by name
+        self._cache = EMPTY_CACHE
+
+        if not self.is_partial and self._should_validate_on_read():
             self.validate()
 
+    @classmethod
+    def configure_read_validation(cls, mode, sample_rate=None):
+        """
+        Sets the validation mode for documents instantiated from the database:
+
+        * `trust`: don't validate, the data was validated on import;
+        * `sample`: validate a random fraction (`sample_rate`) of documents
+          to catch schema drift without paying for it on every read;
+        * `full`: validate every document.
+        """
+        modes = (cls.READ_VALIDATION_TRUST, cls.READ_VALIDATION_SAMPLE,
+                 cls.READ_VALIDATION_FULL)
+        if mode not in modes:
+            raise ValueError('Read validation mode must be one of {}, got {!r}'
+                             .format(', '.join(modes), mode))
+        cls.READ_VALIDATION = mode
+        if sample_rate is not None:
+            cls.READ_VALIDATION_SAMPLE_RATE = float(sample_rate)
+
+    @classmethod
+    def _should_validate_on_read(cls):
+        if cls.READ_VALIDATION == cls.READ_VALIDATION_FULL:
+            return True
+        if cls.READ_VALIDATION == cls.READ_VALIDATION_SAMPLE:
+            return random.random() < cls.READ_VALIDATION_SAMPLE_RATE
+        return False
+
     def __eq__(self, other):
         if type(self) == type(other) and self.id == other.id:
             return True
@@ -87,6 +793,75 @@ class Entity:
 
         return database[cls.entity_name]
 
+    @classmethod
+    def _get_identity_map(cls):
+        """
+        Returns the request-scoped `IdentityMap` or `None` if there's none
+        (e.g. outside of Flask app context).
+
+        This can be monkey-patched to avoid Flask's `g`.
+        """
+        if not has_app_context():
+            return None
+        return g.get('identity_map')
+
+    @classmethod
+    def _from_document(cls, item, projection=None):
+        """
+        Wraps given raw document into an instance of this model.  If the
+        document is already known to the identity map, the known instance is
+        returned instead of a new one.
+
+        If the document was fetched with a `projection`, the instance is
+        partial (see `PartialDocument`) and is not registered in the
+        identity map.
+        """
+        identity_map = cls._get_identity_map()
+
+        if identity_map is not None and 'id' in item:
+            known = identity_map.peek(cls, item['id'])
+            if known is not None:
+                return known
+
+        if projection:
+            return cls(cls._make_partial_document(item, projection))
+
+        if identity_map is None or 'id' not in item:
+            return cls(item)
+
+        return identity_map.add(cls(item))
+
+    @classmethod
+    def _normalize_projection(cls, projection):
+        """
+        Returns a list of projected fields (always including `id`).
+        Only inclusive projections are supported.
+        """
+        if not projection:
+            return None
+        if isinstance(projection, dict):
+            if not all(projection.values()):
+                raise ValueError('Only inclusive projections are supported: {}'
+                                 .format(projection))
+            projection = list(projection)
+        fields = list(projection)
+        if 'id' not in fields:
+            fields.append('id')
+        return fields
+
+    @classmethod
+    def _make_partial_document(cls, item, projection):
+        collection = cls._get_collection()
+        pk = item['_id']
+        loader = lambda: collection.find_one({'_id': pk})
+        return PartialDocument(item, projection, loader,
+                               cls.PARTIAL_DOCUMENT_POLICY)
+
+    @property
+    def is_partial(self):
+        return (isinstance(self._data, PartialDocument)
+                and not self._data.is_complete)
+
     def _find_refs(self, key, model):
         # 'eventref.id' is fine for MongoDB lookups, but not for `__getitem__`.
         # We just strip the inner part here, it will be conditionally tried
@@ -94,6 +869,11 @@ class Entity:
         if key.endswith('.id'):
             key = key.partition('.id')[0]
 
+        try:
+            return list(self._prefetched[key])
+        except KeyError:
+            pass
+
         try:
             refs = self._data[key]
         except KeyError:
@@ -108,11 +888,7 @@ class Entity:
         if not isinstance(pks, list):
             pks = [pks]
 
-        return model.find({
-            'id': {
-                '$in': pks
-            }
-        })
+        return model.find_by_pks(pks)
 
     def find_related(self, other_cls, by_key=None):
         """
@@ -127,7 +903,74 @@ class Entity:
         return self._find_refs(by_key, other_cls)
 
     @classmethod
-    def find_all_referencing(cls, other_cls_or_obj, other_id=None):
+    def prefetch(cls, instances, *relations):
+        """
+        Batch-loads given relations for all given instances of this model.
+        Each relation costs a single query regardless of the number of
+        instances; afterwards `find_related()` and the properties based on it
+        are served from the per-instance cache.  Usage::
+
+            people = Person.prefetch(Person.find(), 'parents', 'events')
+
+            for person in people:
+                person.get_parents()   # no queries here
+
+        Relations are looked up in `RELATIONS`; nested ones are expressed
+        as dotted paths, e.g. ``'parent_families.father'``.
+
+        Returns the instances as a list.
+        """
+        instances = list(instances)
+        for path in relations:
+            cls._prefetch_path(instances, path)
+        return instances
+
+    @classmethod
+    def _prefetch_path(cls, instances, path):
+        name, _, subpath = path.partition('.')
+
+        try:
+            relation = cls.RELATIONS[name]
+        except KeyError:
+            raise ValueError('{.__name__} has no relation "{}"'
+                             .format(cls, name)) from None
+
+        if not isinstance(relation, (Relation, KinshipRelation)):
+            # an alias for one or more other paths
+            for aliased_path in relation:
+                if subpath:
+                    aliased_path = '{}.{}'.format(aliased_path, subpath)
+                cls._prefetch_path(instances, aliased_path)
+            return
+
+        key = relation.cache_key
+
+        pks_by_instance = []
+        for obj in instances:
+            if key not in obj._prefetched:
+                pks_by_instance.append((obj, relation.get_pks(obj)))
+
+        if pks_by_instance:
+            all_pks = list(OrderedDict.fromkeys(
+                itertools.chain.from_iterable(pks for _, pks in pks_by_instance)))
+            found = dict((x.id, x) for x in
+                         relation.model.find_by_pks(all_pks))
+
+            for obj, pks in pks_by_instance:
+                if obj._prefetched is EMPTY_CACHE:
+                    obj._prefetched = {}
+                obj._prefetched[key] = [found[pk] for pk in pks if pk in found]
+
+        if subpath:
+            related = OrderedDict()
+            for obj in instances:
+                for other in obj._prefetched[key]:
+                    related.setdefault(other.id, other)
+            relation.model._prefetch_path(list(related.values()), subpath)
+
+    @classmethod
+    def find_all_referencing(cls, other_cls_or_obj, other_id=None,
+                             projection=None):
         """
         Returns instances of this model that reference given another model
         or model instance.  Usage::
@@ -151,7 +994,7 @@ class Entity:
         assert issubclass(other_cls, Entity)
         key = cls.REFERENCES[other_cls.__name__]
 
-        return cls.find({key: other_id})
+        return cls.find({key: other_id}, projection=projection)
 
     @classmethod
     def get(cls, pk):
@@ -162,22 +1005,84 @@ class Entity:
         return instance
 
     @classmethod
-    def find(cls, conditions=None):
-        for item in cls._get_collection().find(conditions):
-            try:
-                yield cls(item)
-            except ValidationError as e:
-                import sys
-                import pprint
-                sys.stderr.write('ERROR in {.__name__}:\n{}\n'
-                                 .format(cls, pprint.pformat(item)))
-                raise e
+    def find_by_pks(cls, pks):
+        """
+        Returns a list of instances with given IDs, in the same order.
+        Missing IDs are silently skipped.
+
+        Instances already known to the identity map are taken from there;
+        the rest is fetched with a single query.
+        """
+        identity_map = cls._get_identity_map()
+
+        found = {}
+        if identity_map is not None:
+            for pk in pks:
+                obj = identity_map.get(cls, pk)
+                if obj is not None:
+                    found[pk] = obj
+
+        missing_pks = [pk for pk in pks if pk not in found]
+        if missing_pks:
+            for obj in cls.find({'id': {'$in': missing_pks}}):
+                found[obj.id] = obj
+
+        return [found[pk] for pk in pks if pk in found]
+
+    @classmethod
+    def find(cls, conditions=None, projection=None):
+        """
+        Returns a lazy `QuerySet` of instances matching given conditions.
+
+        :param projection: a list of fields to fetch; the instances will be
+            partial (see `PartialDocument`).
+        """
+        return QuerySet(cls, conditions, projection)
 
     @classmethod
-    def find_one(cls, conditions=None):
-        item = cls._get_collection().find_one(conditions)
+    def find_one(cls, conditions=None, projection=None):
+        projection = cls._normalize_projection(projection)
+
+        # shortcut for lookups by primary key
+        identity_map = cls._get_identity_map()
+        if identity_map is not None and conditions and list(conditions) == ['id']:
+            pk = conditions['id']
+            if isinstance(pk, str):
+                obj = identity_map.get(cls, pk)
+                if obj is not None:
+                    return obj
+
+        _log_query(cls, conditions)
+        item = cls._get_collection().find_one(conditions, projection)
         if item:
-            return cls(item)
+            return cls._from_document(item, projection)
+
+    @classmethod
+    def find_in_date_range(cls, since=None, until=None, conditions=None,
+                           projection=None):
+        """
+        Returns instances with dates overlapping given range.  Bounds are
+        inclusive and can be years (`1850`), Gramps date strings
+        (`'1850-05'`) or `datetime.date` objects; either can be omitted.
+        Undated documents never match.
+
+        Runs as a single indexed query on the bounds stored on import.
+        """
+        if not cls.DATED:
+            raise ValueError('{.__name__} has no dates'.format(cls))
+
+        conditions = dict(conditions or {})
+        bounds = _get_date_range_conditions(since, until)
+        for key, value in bounds.items():
+            conditions['date_bounds.' + key] = value
+        if not bounds:
+            conditions['date_bounds'] = {'$exists': True}
+        return cls.find(conditions, projection=projection)
+
+    @classmethod
+    def can_find_in_date_range(cls):
+        "Whether `find_in_date_range()` is supported (see `DATED`)"
+        return cls.DATED
 
     # FIXME optimize! this is insane.
     @classmethod
@@ -194,87 +1099,57 @@ class Entity:
                 yield obj
 
     @classmethod
-    def aggregate(cls, conditions, *related_models):
+    def aggregate(cls, conditions, *related_models, projection=None):
         """
-        TODO: separate aggregation from base query:
-
-            Event.find(id=x).aggregate(Person, Place)
-
-        Prerequisite: all Model.find_* methods return ResultSet instances
-        which provide additional methods.  If that's applicable here...
-
-        A possibly better syntax:
-
-            Event.find(id=x) \
-                .aggregate(Person, field='personref') \
-                .aggregate(Place, local_field='place')
-
-        TODO: custom aliases, e.g.:
-
-              Person.find_one(id=x).aggregate({
-                  parents: {'model': Person, 'localField': ...},
-                  children: {'model': Person, 'localField': ...},
-              })
-
-              # ^^^ this case is actually more complicated because these
-              # relations are established through families, so we need more
-              # items in the pipeline.
+        Yields instances matching given conditions with related instances of
+        given models embedded (see `QuerySet.aggregate()`).
         """
-        pipeline_stages = []
-
+        queryset = cls.find(conditions, projection=projection)
         for related_model in related_models:
-            assert issubclass(related_model, Entity)
-
-            if related_model == cls:
-                continue
-
-            # there can be two cases:
-            # 1) central model references another one → that one gets aggregated;
-            # 2) another model references central one → still gets aggregated.
-
-            local_key = cls.REFERENCES.get(related_model.__name__, 'id')
-            foreign_key = related_model.REFERENCES.get(cls.__name__, 'id')
-
-            if not local_key and not foreign_key:
-                raise Exception('Could not find a reference between {} and {}'
-                                .format(cls.__name__ and related_model.__name__))
-
-            assert local_key != foreign_key, (cls, related_model, local_key, foreign_key)
+            if related_model != cls:
+                queryset = queryset.aggregate(related_model)
+        return queryset
 
-            lookup = {
-                'from': related_model.entity_name,
-                'as': RELATED_KEY_PREFIX + related_model.entity_name,
-                'localField': local_key,
-                'foreignField': foreign_key
-            }
-
-            pipeline_stages.append({
-                '$match': conditions,
-            })
-            pipeline_stages.append({
-                '$lookup': lookup
-            })
-
-        print(pipeline_stages)
+    @classmethod
+    def count(cls):
+        return cls.find().count()
 
-        for item in cls._get_collection().aggregate(pipeline_stages):
-            temp_extracted_keys = {}
+    @classmethod
+    def get_index_specs(cls):
+        """
+        Returns a list of ``(keys, options)`` pairs describing the indexes
+        needed by this model: a unique one on `id` (if the model has IDs)
+        and one per reference key (multikey if the references are a list).
+        """
+        specs = []
 
-            for related_model in related_models:
-                key = RELATED_KEY_PREFIX + related_model.entity_name
-                sub_items = item.pop(key)
-                temp_extracted_keys[key] = [related_model(x) for x in
-                                            sub_items]
+        if 'id' in cls.schema:
+            specs.append(('id', {'unique': True}))
 
-            obj = cls(item)
+        keys = []
+        if cls.REFERENCES is not NotImplemented:
+            keys.extend(cls.REFERENCES.values())
+        keys.extend(x.key for x in cls.RELATIONS.values()
+                    if isinstance(x, Relation))
+        keys.extend(cls.INDEXED_KEYS)
+        if cls.DATED:
+            keys.extend(DATE_BOUNDS_INDEXES)
 
-            obj._data = dict(obj._data, **temp_extracted_keys)
+        for key in keys:
+            if key != 'id' and (key, {}) not in specs:
+                specs.append((key, {}))
 
-            yield obj
+        return specs
 
     @classmethod
-    def count(cls):
-        return cls._get_collection().count()
+    def ensure_indexes(cls):
+        """
+        Creates the indexes described by `get_index_specs()` (if they don't
+        exist yet).  Returns the list of index names.
+        """
+        collection = cls._get_collection()
+        return [collection.create_index(keys, **options)
+                for keys, options in cls.get_index_specs()]
 
     @property
     def _id(self):
@@ -290,7 +1165,7 @@ class Entity:
 
     def validate(self):
         try:
-            validate(self.schema, self._data)
+            self._validator(self._data)
         except ValidationError as e:
             import pprint
             pprint.pprint(self.schema)
@@ -330,8 +1205,11 @@ class Entity:
             return data
 
     def get_pretty_data(self):
-        related_keys = [k for k in self._data.keys() if
-                        k.startswith(RELATED_KEY_PREFIX)]
+        if self.is_partial:
+            keys = self._data.loaded_keys()
+        else:
+            keys = self._data.keys()
+        related_keys = [k for k in keys if k.startswith(RELATED_KEY_PREFIX)]
         related_data = {}
         for key in related_keys:
             #related_data[key] = [_strip_objectid(x) for x in self._data[key]]
@@ -342,34 +1220,196 @@ class Entity:
     def _get_pretty_data(self):
         raise NotImplementedError
 
+    def get_search_texts(self):
+        "Texts to match search queries against (names, titles, etc.)"
+        raise NotImplementedError
+
     def matches_query(self, query):
+        tokens = [search.normalize(x) for x in self.get_search_texts() if x]
+        return search.matches(tokens, search.split_query(query))
+
+    @classmethod
+    def _get_search_collection(cls):
+        return cls._get_database()[search.SEARCH_COLLECTION]
+
+    @classmethod
+    def search(cls, query, limit=None):
+        """
+        Returns a list of instances matching given query: each word of the
+        query must be a (case- and accent-insensitive) substring of some of
+        the instance's search texts.
+
+        Uses the search index built on import (see `build_search_index()`).
+        """
+        if not cls.SEARCHABLE:
+            raise ValueError('{.__name__} is not searchable'.format(cls))
+        patterns = search.split_query(query)
+        if not patterns:
+            return []
+
+        conditions = search.make_conditions(cls.entity_name, patterns)
+        candidates = cls._get_search_collection().find(
+            conditions, {'id': 1, 'tokens': 1})
+
+        pks = []
+        for candidate in candidates:
+            if search.matches(candidate['tokens'], patterns):
+                pks.append(candidate['id'])
+                if limit and len(pks) >= limit:
+                    break
+        return cls.find_by_pks(pks)
+
+    def get_sort_keys(self):
+        "Returns a dict of values to order by (see `SORTABLE`)."
         raise NotImplementedError
 
+    @classmethod
+    def build_sort_keys(cls, missing_only=False):
+        """
+        (Re)computes `sort_keys` for all documents of this model.  Returns
+        the number of updated documents.
+
+        If `missing_only` is true, only the documents without `sort_keys`
+        (e.g. imported by an older version) are updated.
+        """
+        conditions = {'sort_keys': {'$exists': False}} if missing_only else None
+        collection = cls._get_collection()
+        count = 0
+        for batch in _iter_chunks(cls.find(conditions), 1000):
+            batch = cls.prefetch(batch, *cls.SORT_KEYS_PREFETCH)
+            collection.bulk_write([
+                UpdateOne({'_id': x._id}, {'$set': {'sort_keys': x.get_sort_keys()}})
+                for x in batch
+            ], ordered=False)
+            count += len(batch)
+        return count
+
+    @classmethod
+    def build_search_index(cls):
+        """
+        (Re)creates search index entries for this model.  Returns the number
+        of indexed documents.
+        """
+        collection = cls._get_search_collection()
+        collection.delete_many({'model': cls.entity_name})
+        docs = (search.make_document(cls.entity_name, x.id,
+                                     x.get_search_texts())
+                for x in cls.find())
+        count = 0
+        for batch in _iter_chunks(docs, 1000):
+            collection.insert_many(batch)
+            count += len(batch)
+        return count
+
     def save(self):
-        self.validate()
-        self._get_collection().insert_one(self._data)
+        if self.RELATED_FIELDS:
+            self._update_related_fields()
+        self._get_collection().insert_one(self.prepare_to_save())
         #self._get_collection().replace_one({id: self.id}, self._data,
         #                                   upsert=True)
 
+    def prepare_to_save(self):
+        """
+        Updates the derived fields, validates the document and returns it.
+        Use this to insert many documents at once.
+        """
+        if self.is_partial:
+            raise ValueError('Cannot save a partial document: {}'.format(self.id))
+        self._update_derived_fields()
+        self.validate()
+        return self._data
+
+    def _update_derived_fields(self):
+        "Adds (or refreshes) fields computed from the data for querying"
+        if self.DATED:
+            self._update_date_bounds()
+
+    def _update_related_fields(self):
+        "Adds (or refreshes) `RELATED_FIELDS`"
+
+    @classmethod
+    def get_derived_fields(cls):
+        """
+        Names of the fields set (or removed) by `_update_derived_fields()`
+        and `_update_related_fields()`
+        """
+        own = ('date_bounds',) if cls.DATED else ()
+        return own + tuple(cls.RELATED_FIELDS)
+
+    @classmethod
+    def build_derived_fields(cls, related_only=False):
+        """
+        (Re)computes the derived fields (see `_update_derived_fields()`) for
+        all documents of this model.  Returns the number of updated
+        documents.
+
+        If `related_only` is true, only `RELATED_FIELDS` are stored (the
+        other ones are written on import).
+        """
+        if related_only:
+            fields = tuple(cls.RELATED_FIELDS)
+        else:
+            fields = cls.get_derived_fields()
+        if not fields:
+            return 0
+        collection = cls._get_collection()
+        count = 0
+        for batch in _iter_chunks(cls.find(), 1000):
+            if cls.RELATED_FIELDS:
+                batch = cls.prefetch(batch, *cls.RELATED_FIELDS_PREFETCH)
+            requests = []
+            for x in batch:
+                x._update_derived_fields()
+                x._update_related_fields()
+                update = {}
+                present = dict((k, x._data[k]) for k in fields if k in x._data)
+                missing = dict((k, '') for k in fields if k not in x._data)
+                if present:
+                    update['$set'] = present
+                if missing:
+                    update['$unset'] = missing
+                requests.append(UpdateOne({'_id': x._id}, update))
+            collection.bulk_write(requests, ordered=False)
+            count += len(batch)
+        return count
+
+    def _update_date_bounds(self):
+        bounds = get_date_bounds(self._data.get('date'))
+        if bounds:
+            self._data['date_bounds'] = bounds
+        else:
+            self._data.pop('date_bounds', None)
+
 
 class Family(Entity):
+    __slots__ = ()
     entity_name = 'families'
     schema = FAMILY_SCHEMA
     REFERENCES = {
         'Event': 'events.id',
     }
+    RELATIONS = {
+        'father': Relation('Person', 'father.id'),
+        'mother': Relation('Person', 'mother.id'),
+        'children': Relation('Person', 'childref.id'),
+        'parents': ('father', 'mother'),
+        'people': ('father', 'mother', 'children'),
+    }
+    PUBLIC_DATA_FIELDS = ('father', 'mother', 'citationref', 'noteref',
+                          'childref', 'events', 'attribute', 'priv')
+    SORTABLE = True
+    SORT_KEYS_PREFETCH = 'parents.events',
+    # for ordering and paging, see `QuerySet.page()`
+    INDEXED_KEYS = [('sort_keys.birth_year', 1), ('id', 1)],
 
     def __repr__(self):
         return '{} + {}'.format(self.father or '?',
                                 self.mother or '?')
 
     def _get_participant(self, key):
-        try:
-            pk = self._data[key]['id']
-        except KeyError:
-            return None
-        else:
-            return Person.find_one({'id': pk})
+        people = self._find_refs(key, Person)
+        if people:
+            return people[0]
 
     def _get_pretty_data(self):
         return {
@@ -415,6 +1455,20 @@ class Family(Entity):
         else:
             return self.mother
 
+    def get_sort_keys(self):
+        # This is a very naïve sorting method.
+        # We sort families by father's birth year; if it's missing, then
+        # by mother's.  This does not take into account actual marriage dates,
+        # so if the second wife was older than the first one, the second family
+        # goes first.  The general idea is to roughly sort the families and
+        # have older people appear before younger ones.
+        birth_year = ''
+        if self.father and self.father.birth:
+            birth_year = str(self.father.birth.year)
+        elif self.mother and self.mother.birth:
+            birth_year = str(self.mother.birth.year)
+        return {'birth_year': birth_year}
+
     @property
     def sortkey(self):
         if self.father:
@@ -425,13 +1479,37 @@ class Family(Entity):
 
 
 class Person(Entity):
+    __slots__ = ()
     entity_name = 'people'
     schema = PERSON_SCHEMA
+    SEARCHABLE = True
+    SORTABLE = True
+    # for ordering and paging, see `QuerySet.page()`
+    INDEXED_KEYS = ([('sort_keys.name', 1), ('id', 1)],
+                    [('sort_keys.group', 1), ('id', 1)],
+                    # see `find_in_date_range()`
+                    [('event_date_bounds.earliest', 1),
+                     ('event_date_bounds.latest', 1)])
+    RELATED_FIELDS = 'event_date_bounds',
+    RELATED_FIELDS_PREFETCH = 'events',
     REFERENCES = {
         'Citation': 'citationref.id',
         'Event': 'eventref.id',
         'MediaObject': 'objectref.id',
     }
+    RELATIONS = {
+        'events': Relation('Event', 'eventref.id'),
+        'citations': Relation('Citation', 'citationref.id'),
+        'families': Relation('Family', 'parentin.id'),
+        'parent_families': Relation('Family', 'childof.id'),
+        'parents': KinshipRelation('parents'),
+        'siblings': KinshipRelation('siblings'),
+        'partners': KinshipRelation('partners'),
+        'children': KinshipRelation('children'),
+    }
+    # NOTE: `eventref` is needed for birth and death
+    PUBLIC_DATA_FIELDS = ('name', 'gender', 'attribute', 'childof', 'parentin',
+                          'citationref', 'noteref', 'eventref', 'priv')
     NAME_TEMPLATE = '{first} {patronymic} {primary} ({nonpatronymic})'
 
     # these are for templates, etc.
@@ -443,8 +1521,7 @@ class Person(Entity):
         return '{}'.format(self.name)
 
     def _format_all_names(self, template=NAME_TEMPLATE):
-        names = self._data['name']
-        return self._format_names(names, template) or []
+        return [self._format_name_parts(x, template) for x in self.parsed_names]
 
     def _format_one_name(self, template=NAME_TEMPLATE):
         return self._format_all_names(template)[0]
@@ -452,7 +1529,7 @@ class Person(Entity):
     def _get_pretty_data(self):
         return {
             # TODO use foo_id for IDs
-            'group_names': list(self.group_names),
+            'group_names': self.group_names,
             'group_name': self.group_name,
             'names': self.names,
             'name': self.name,
@@ -470,50 +1547,58 @@ class Person(Entity):
             'event_ids': _simplified_refs(self._data.get('eventref')),
         }
 
-    @property
+    # The name properties are computed from `parsed_names` once per instance.
+    # NOTE: the returned lists are shared, don't modify them.
+
+    @cached_slot_property
+    def parsed_names(self):
+        "A `ParsedName` per name node"
+        name_nodes = self._data['name']
+        if not isinstance(name_nodes, list):
+            name_nodes = [name_nodes]
+        return [ParsedName(*self._get_name_parts(n), group=n.get('group'))
+                for n in name_nodes]
+
+    @cached_slot_property
     def names(self):
         return self._format_all_names()
 
-    @property
+    @cached_slot_property
     def name(self):
         return self._format_one_name()
 
-    @property
+    @cached_slot_property
     def first_and_last_names(self):
         return self._format_one_name('{first} {primary}')
 
-    @property
+    @cached_slot_property
     def first_name(self):
         return self._format_one_name('{first}')
 
-    @property
+    @cached_slot_property
     def initials(self):
         return ''.join(x[0].upper() for x in self.name.split(' ') if x)
 
-    @property
+    @cached_slot_property
+    @as_list
     def group_names(self):
-        name_nodes = self._data['name']
-        if not isinstance(name_nodes, list):
-            name_nodes = [name_nodes]
-
         # Check for name groups and aliases; if none, use first found surname
+        aliases = NameMap.get_group_as_map()
         first_found_surname = None
-        for n in name_nodes:
-            assert not isinstance(n, str)
-            if 'group' in n:
-                yield n['group']
+        for parsed in self.parsed_names:
+            if parsed.group is not None:
+                yield parsed.group
 
-            _, primary_surnames, _, _ = self._get_name_parts(n)
-            for surname in primary_surnames:
+            for surname in parsed.primary_surnames:
                 if not first_found_surname:
                     first_found_surname = surname
-                alias = NameMap.group_as(surname)
+                alias = aliases.get(surname)
                 if alias:
                     yield alias
         if first_found_surname:
             yield first_found_surname
 
-    @property
+    @cached_slot_property
     def group_name(self):
         for name in self.group_names:
             # first found wins
@@ -521,7 +1606,7 @@ class Person(Entity):
         else:
             return self.name
 
-    @cached_property
+    @cached_slot_property
     @as_list
     def events(self):
         # TODO: the `eventref` records are dicts with `hlink` and `role`.
@@ -529,7 +1614,7 @@ class Person(Entity):
         items = self.find_related(Event)
         return sorted(items, key=lambda e: e.date)
 
-    @cached_property
+    @cached_slot_property
     @as_list
     def places(self):
         # unique with respect to the original order (expecting events sorted by date)
@@ -541,6 +1626,35 @@ class Person(Entity):
                 seen[event.place.id] = True
         return places
 
+    @property
+    def route(self):
+        """
+        Places of the events in chronological order, without immediate
+        repetitions (unlike `places`, a place may be visited again).
+        """
+        route = []
+        for event in self.events:
+            place = event.place
+            if place and not (route and route[-1].id == place.id):
+                route.append(place)
+        return route
+
+    @cached_slot_property
+    def travel_distance(self):
+        "Lifetime travel distance in km along the `route`."
+        return self.get_travel_distances([self])[0]
+
+    @classmethod
+    def get_travel_distances(cls, people):
+        """
+        Returns a list of lifetime travel distances in km for given people.
+        Events and places are batch-loaded and all routes are measured
+        in a single vectorized computation.
+        """
+        people = cls.prefetch(people, 'events.place')
+        routes = [[x.coords_tuple for x in person.route] for person in people]
+        return geo.route_lengths(routes).tolist()
+
     @property
     def attributes(self):
         try:
@@ -563,60 +1677,125 @@ class Person(Entity):
     def get_families(self):
         return self.find_related(Family, by_key='parentin')
 
+    @classmethod
+    def _get_kinship_graph(cls):
+        return kinship.get_graph(Family._get_collection(),
+                                 get_data_generation())
+
+    @classmethod
+    def find_in_date_range(cls, since=None, until=None, conditions=None,
+                           projection=None):
+        """
+        People who took part in events dated within given range (see
+        `Entity.find_in_date_range()`).  Queries the bounds of the events
+        stored with each person (see `_update_related_fields()`).
+        """
+        conditions = dict(conditions or {})
+        bounds = _get_date_range_conditions(since, until)
+        if bounds:
+            # the same event must match both bounds
+            conditions['event_date_bounds'] = {'$elemMatch': bounds}
+        else:
+            conditions['event_date_bounds'] = {'$exists': True}
+        return cls.find(conditions, projection=projection)
+
+    @classmethod
+    def can_find_in_date_range(cls):
+        # by the dates of the events
+        return True
+
+    def _update_related_fields(self):
+        bounds = []
+        for event in self.find_related(Event):
+            event_bounds = get_date_bounds(event._data.get('date'))
+            if event_bounds and event_bounds not in bounds:
+                bounds.append(event_bounds)
+        if bounds:
+            self._data['event_date_bounds'] = bounds
+        else:
+            self._data.pop('event_date_bounds', None)
+
+    def _get_kin(self, kind):
+        try:
+            return list(self._prefetched[kind])
+        except KeyError:
+            pass
+        pks = self._get_kinship_graph().related_ids(kind, self.id)
+        return Person.find_by_pks(pks)
+
     def get_parents(self):
-        for family in self.get_parent_families():
-            if family.mother:
-                yield family.mother
-            if family.father:
-                yield family.father
+        return self._get_kin('parents')
 
     def get_siblings(self):
-        for family in self.get_parent_families():
-            for child in family.children:
-                if child != self:
-                    yield child
+        return self._get_kin('siblings')
 
     def get_partners(self):
-        for family in self.get_families():
-            partners = family.father, family.mother
-            for partner in partners:
-                if partner and partner != self:
-                    yield partner
+        return self._get_kin('partners')
 
     def get_children(self):
-        for family in self.get_families():
-            for child in family.children:
-                yield child
-
-    def find_ancestors(self):
-        stack = [self]
-        while stack:
-            p = stack.pop()
-            yield p
-            for parent in p.get_parents():
-                stack.append(parent)
-
-    def find_descendants(self):
-        stack = [self]
-        while stack:
-            p = stack.pop()
-            yield p
-            for child in p.get_children():
-                stack.append(child)
-
-    @cached_property
-    @as_list
+        return self._get_kin('children')
+
+    def traverse(self, kind, max_generations=None):
+        """
+        Yields `Relative` items (person + generation number) found by walking
+        the kinship graph along given kind of relation, starting with this
+        person at generation 0.  Every person is yielded once even if they
+        can be reached by several paths (pedigree collapse).
+
+        People are loaded with one query per generation.
+
+        :param kind: ``'parents'`` (ancestors) or ``'children'``
+            (descendants).
+        :param max_generations: stop this many generations away.
+        """
+        graph = self._get_kinship_graph()
+        for generation, pks in graph.iter_generations(self.id, kind,
+                                                      max_generations):
+            if generation == 0:
+                people = [self]
+            else:
+                people = Person.find_by_pks(pks)
+            for person in people:
+                yield Relative(person, generation)
+
+    def find_ancestors(self, max_generations=None):
+        for relative in self.traverse('parents', max_generations):
+            yield relative.person
+
+    def find_descendants(self, max_generations=None):
+        for relative in self.traverse('children', max_generations):
+            yield relative.person
+
+    def find_relationship(self, other, max_length=None):
+        """
+        Returns a `Relationship` with the shortest path (a list of
+        `RelationshipStep` items, starting with this person) from this person
+        to the other one and a label such as "second cousin once removed",
+        or `None` if they are not related.
+
+        The path is found in the kinship graph; the only query loads the
+        people on the path.
+        """
+        steps = self._get_kinship_graph().find_path(self.id, other.id,
+                                                    max_length)
+        if steps is None:
+            return None
+        pks = [pk for pk, _ in steps]
+        people = dict((x.id, x) for x in Person.find_by_pks(pks))
+        path = [RelationshipStep(people[pk], kind) for pk, kind in steps
+                if pk in people]
+        label = kinship.describe_path(
+            [kind for _, kind in steps[1:]],
+            [people[pk].gender if pk in people else None for pk in pks])
+        return Relationship(path, label)
+
+    @cached_slot_property
     def related_people(self):
-        parents = list(self.get_parents())
-        siblings = list(self.get_siblings())
-        partners = list(self.get_partners())
-        children = list(self.get_children())
-        people = parents + siblings + partners + children
-        seen = {}
-        for person in people:
-            if person.id not in seen:
-                yield person
-                seen[person.id] = True
+        graph = self._get_kinship_graph()
+        kinds = 'parents', 'siblings', 'partners', 'children'
+        pks = OrderedDict.fromkeys(itertools.chain.from_iterable(
+            graph.related_ids(kind, self.id) for kind in kinds))
+        return Person.find_by_pks(list(pks))
 
     @property
     def birth(self):
@@ -704,22 +1883,25 @@ class Person(Entity):
 
     @classmethod
     def _format_name(cls, name_node, template=NAME_TEMPLATE):
-        #template = '{primary} ({nonpatronymic}), {first} {patronymic}'
+        parts = ParsedName(*cls._get_name_parts(name_node), group=None)
+        return cls._format_name_parts(parts, template)
 
-        first, primary_surnames, patronymic, nonpatronymic = cls._get_name_parts(name_node)
+    @classmethod
+    def _format_name_parts(cls, parts, template=NAME_TEMPLATE):
+        #template = '{primary} ({nonpatronymic}), {first} {patronymic}'
 
         return template.format(
-            first = first,
-            primary = ', '.join(primary_surnames),
-            patronymic = ' '.join(patronymic),
-            nonpatronymic = ', '.join(nonpatronymic),
+            first = parts.first,
+            primary = ', '.join(parts.primary_surnames),
+            patronymic = ' '.join(parts.patronymic),
+            nonpatronymic = ', '.join(parts.nonpatronymic),
         ).replace(' ()', '').strip()
 
-    def matches_query(self, query):
-        patterns = query.lower().split()
-        raw_tokens = itertools.chain(self.names, self.group_names)
-        tokens = [t.lower().strip() for t in raw_tokens]
-        return all(any(p in t.lower() for t in tokens) for p in patterns)
+    def get_search_texts(self):
+        return itertools.chain(self.names, self.group_names)
+
+    def get_sort_keys(self):
+        return {'name': self.name, 'group': self.group_name}
 
 
 def _format_dateval(dateval):
@@ -744,6 +1926,7 @@ def _format_dateval(dateval):
 
 
 class Event(Entity):
+    __slots__ = ()
     entity_name = 'events'
     sort_key = lambda item: item.date
     schema = EVENT_SCHEMA
@@ -751,6 +1934,13 @@ class Event(Entity):
         'Place': 'place.id',
         'Citation': 'citationref.id',
     }
+    RELATIONS = {
+        'place': Relation('Place', 'place.id'),
+        'citations': Relation('Citation', 'citationref.id'),
+    }
+    PUBLIC_DATA_FIELDS = ('type', 'date', 'date_bounds', 'description',
+                          'place', 'citationref', 'priv')
+    DATED = True
 
     TYPE_BIRTH = 'Birth'
     TYPE_DEATH = 'Death'
@@ -778,11 +1968,11 @@ class Event(Entity):
     def type(self):
         return self._data['type']
 
-    @property
+    @cached_slot_property
     def date(self):
         date = self._data.get('date')
         if date:
-            return DateRepresenter(**date)
+            return DateRepresenter(bounds=self._data.get('date_bounds'), **date)
         else:
             # XXX this is a hack for `xs|sort(attribute='x')` Jinja filter
             # in Python 3.x environment where None can't be compared
@@ -814,12 +2004,25 @@ class Event(Entity):
 
 
 class Place(Entity):
+    __slots__ = ()
     entity_name = 'places'
     REFERENCES = {
         'Citation': 'citationref.id',
         'Place': 'placeref.id'
     }
+    RELATIONS = {
+        'citations': Relation('Citation', 'citationref.id'),
+        'parent_places': Relation('Place', 'placeref.id'),
+    }
+    PUBLIC_DATA_FIELDS = ('pname', 'coord', 'location', 'placeref',
+                          'citationref', 'noteref', 'priv')
+    # enough to put a place on a map
+    MAP_DATA_FIELDS = ('pname', 'ptitle', 'coord', 'location', 'priv')
+    INDEXED_KEYS = ([('location', '2dsphere')],
+                    # map viewports, see `find_within()`
+                    [('latlng.lat', 1), ('latlng.lng', 1)])
     schema = PLACE_SCHEMA
+    SEARCHABLE = True
 
     def __repr__(self):
         return '{0.name}'.format(self)
@@ -835,9 +2038,8 @@ class Place(Entity):
             'note_ids': _simplified_refs(self._data.get('noteref')),
         }
 
-    def matches_query(self, query):
-        patterns = query.lower().split()
-        return all(any(p in n.lower() for n in self.names) for p in patterns)
+    def get_search_texts(self):
+        return self.names
 
     @property
     def name(self):
@@ -861,8 +2063,16 @@ class Place(Entity):
     def alt_names(self):
         return self.names[1:]
 
-    @property
+    @cached_slot_property
     def coords(self):
+        location = self._data.get('location')
+        if location:
+            lng, lat = location['coordinates']
+            return {'lat': lat, 'lng': lng}
+        # not imported with the location (or invalid coordinates)
+        return self._parse_coords()
+
+    def _parse_coords(self):
         coords = self._data.get('coord')
         if not coords:
             return
@@ -871,6 +2081,82 @@ class Place(Entity):
             'lng': _normalize_coords_to_pure_degrees(coords['long']),
         }
 
+    @classmethod
+    def get_derived_fields(cls):
+        return super().get_derived_fields() + ('location', 'latlng')
+
+    def _update_derived_fields(self):
+        super()._update_derived_fields()
+        location = self.get_location()
+        if location:
+            lng, lat = location['coordinates']
+            self._data['location'] = location
+            self._data['latlng'] = {'lat': lat, 'lng': lng}
+        else:
+            self._data.pop('location', None)
+            self._data.pop('latlng', None)
+
+    def get_location(self):
+        """
+        Returns the coordinates as a GeoJSON point (for the `2dsphere` index)
+        or `None` if they are missing or can't be parsed.
+        """
+        try:
+            coords = self._parse_coords()
+        except (AssertionError, IndexError, ValueError):
+            return None
+        if not coords:
+            return None
+        if not (-90 <= coords['lat'] <= 90 and -180 <= coords['lng'] <= 180):
+            return None
+        return _make_point(coords['lat'], coords['lng'])
+
+    @classmethod
+    def find_within(cls, bbox, conditions=None, projection=None):
+        """
+        Yields places located within given bounding box: a tuple of
+        `(south, west, north, east)` in degrees (as in Google Maps'
+        `LatLngBounds.toUrlValue()`).  A box crossing the antimeridian
+        (west > east) is supported.
+
+        The box is flat (edges are lines of latitude and longitude, as on
+        the map) so it is matched by ranges of the plain `latlng` coordinates
+        (served by a compound index) rather than with `$geoWithin`, which
+        treats polygon edges as great circles.
+        """
+        south, west, north, east = bbox
+
+        if west == east:
+            # an empty box (not the whole globe), nothing can be in it
+            conditions = dict(conditions or {}, id={'$in': []})
+            return cls.find(conditions, projection=projection)
+
+        def _box(west, east):
+            return {'latlng.lat': {'$gte': south, '$lte': north},
+                    'latlng.lng': {'$gte': west, '$lte': east}}
+
+        conditions = dict(conditions or {})
+        if west <= east:
+            conditions.update(_box(west, east))
+        else:
+            # each branch is a separate index scan
+            conditions['$or'] = [_box(west, 180), _box(-180, east)]
+        return cls.find(conditions, projection=projection)
+
+    @classmethod
+    def find_near(cls, point, radius, conditions=None, projection=None):
+        """
+        Yields places within `radius` metres from given `(lat, lng)` point,
+        nearest first.
+        """
+        conditions = dict(conditions or {}, location={
+            '$nearSphere': {
+                '$geometry': _make_point(*point),
+                '$maxDistance': radius,
+            },
+        })
+        return cls.find(conditions, projection=projection)
+
     @property
     def coords_tuple(self):
         coords = self.coords
@@ -879,25 +2165,47 @@ class Place(Entity):
         return coords['lat'], coords['lng']
 
     def distance_to(self, other):
-        if not (self.coords and other.coords):
+        "Returns the great-circle distance in km to another place."
+        if not (self.coords_tuple and other.coords_tuple):
             return
-        return geopy.distance.vincenty(self.coords_tuple, other.coords_tuple)
+        return geo.distance(self.coords_tuple, other.coords_tuple)
+
+    @classmethod
+    def get_distance_matrix(cls, places, other_places=None):
+        """
+        Returns a NumPy array of distances in km between each of given places
+        and each of `other_places` (or each other if not given).  Unknown
+        distances are NaN.
+        """
+        other_coords = None
+        if other_places is not None:
+            other_coords = [x.coords_tuple for x in other_places]
+        return geo.distance_matrix([x.coords_tuple for x in places],
+                                   other_coords)
+
+    @classmethod
+    def get_leg_distances(cls, places):
+        """
+        Returns a NumPy array of distances in km between consecutive places
+        of a route.  Unknown distances are NaN.
+        """
+        return geo.leg_distances([x.coords_tuple for x in places])
 
     @property
     def parent_places(self):
         return self.find_related(Place)
 
-    @cached_property
+    @cached_slot_property
     @as_list
     def nested_places(self):
         return self.find_all_referencing(self)
 
-    @cached_property
+    @cached_slot_property
     @as_list
     def events(self):
         return Event.find_all_referencing(self)
 
-    @cached_property
+    @cached_slot_property
     def events_years(self):
         dates = sorted(e.date for e in self.events if e.date)
         if not dates:
@@ -909,29 +2217,118 @@ class Place(Entity):
         else:
             return '{.year}—{.year}'.format(since, until)
 
-    @cached_property
+    @classmethod
+    def _get_closure_collection(cls):
+        return cls._get_database()[PLACE_CLOSURE_COLLECTION]
+
+    @classmethod
+    def build_closure(cls):
+        """
+        (Re)builds the closure of the place hierarchy: a document per each
+        pair of a place and its direct or indirect nested place (including
+        the place itself at depth 0).  Returns the number of pairs.
+        """
+        parents = {}
+        for item in cls._get_collection().find({}, {'id': 1, 'placeref': 1}):
+            parents[item['id']] = _extract_refs(item.get('placeref') or [])
+
+        collection = cls._get_closure_collection()
+        collection.delete_many({})
+        for keys in PLACE_CLOSURE_INDEXES:
+            collection.create_index(keys)
+
+        pairs = (
+            {'ancestor': ancestor, 'descendant': pk, 'depth': depth}
+            for pk in parents
+            for ancestor, depth in _iter_ancestors(pk, parents)
+        )
+        count = 0
+        for batch in _iter_chunks(pairs, 1000):
+            collection.insert_many(batch)
+            count += len(batch)
+        return count
+
+    @cached_slot_property
+    def descendant_ids(self):
+        """
+        IDs of this place and all places nested in it at any depth.
+        Read from the closure with a single query.
+        """
+        rows = self._get_closure_collection().find(
+            {'ancestor': self.id}, {'descendant': 1})
+        pks = [x['descendant'] for x in rows]
+        if not pks:
+            # the closure was not built for this database, walk the tree
+            pks = [self.id]
+            nested_to_see = list(self.nested_places)
+            while nested_to_see:
+                place = nested_to_see.pop()
+                if place.id not in pks:
+                    pks.append(place.id)
+                    nested_to_see.extend(place.nested_places)
+        return pks
+
+    @cached_slot_property
     @as_list
     def events_recursive(self):
+        # events with references to any place in current place hierarchy
+        return Event.find({'place.id': {'$in': self.descendant_ids}})
 
-        # build a list of refs for current place hierarchy
-        places = []
-        nested_to_see = [self]
-        while nested_to_see:
-            place = nested_to_see.pop()
-            places.append(place)
-            nested_to_see.extend(place.nested_places)
+    @classmethod
+    def get_hierarchy_stats(cls, places):
+        """
+        Returns a dict with stats per given place ID:
 
-        events_seen = {}
+        * `events`: number of events in the place itself;
+        * `events_recursive`: the same including all nested places;
+        * `places`: number of places directly nested in it.
 
-        # find events with references to any of these places
-        for place in places:
-            for event in Event.find_all_referencing(place):
-                if event.id in events_seen:
-                    continue
-                yield event
-                events_seen[event.id] = True
+        Costs one query to the closure and one aggregation of events.
+        Places missing from the closure (e.g. it was not built for this
+        database) fall back to walking the tree (see `descendant_ids`).
+        """
+        places = list(places)
+        pks = [x.id for x in places]
+        descendants = dict((pk, []) for pk in pks)
+        stats = dict((pk, {'events': 0, 'events_recursive': 0, 'places': 0})
+                     for pk in pks)
+        rows = cls._get_closure_collection().find(
+            {'ancestor': {'$in': pks}},
+            {'ancestor': 1, 'descendant': 1, 'depth': 1})
+        for row in rows:
+            descendants[row['ancestor']].append(row['descendant'])
+            if row['depth'] == 1:
+                stats[row['ancestor']]['places'] += 1
 
-    @cached_property
+        for place in places:
+            # each place is its own descendant in a built closure
+            if not descendants[place.id]:
+                descendants[place.id] = place.descendant_ids
+                stats[place.id]['places'] = len(place.nested_places)
+
+        all_pks = set(itertools.chain(pks, *descendants.values()))
+        pipeline = [
+            {'$match': {'place.id': {'$in': list(all_pks)}}},
+            {'$group': {'_id': '$place.id', 'count': {'$sum': 1}}},
+        ]
+        counts = dict((x['_id'], x['count']) for x in
+                      Event._get_collection().aggregate(pipeline))
+
+        for pk in pks:
+            stats[pk]['events'] = counts.get(pk, 0)
+            # the place itself is its own descendant at depth 0
+            subtree = descendants[pk] or [pk]
+            stats[pk]['events_recursive'] = sum(counts.get(x, 0)
+                                                for x in subtree)
+        return stats
+
+    @cached_slot_property
+    def related_places_stats(self):
+        "`get_hierarchy_stats()` for parent and nested places"
+        return self.get_hierarchy_stats(
+            list(self.parent_places) + self.nested_places)
+
+    @cached_slot_property
     @as_list
     def people(self):
         people = {}
@@ -953,9 +2350,13 @@ class Place(Entity):
 
 
 class Source(Entity):
+    __slots__ = ()
     entity_name = 'sources'
     schema = SOURCE_SCHEMA
+    SEARCHABLE = True
     sort_key = lambda item: item.title
+    PUBLIC_DATA_FIELDS = ('stitle', 'sauthor', 'spubinfo', 'sabbrev',
+                          'reporef', 'noteref', 'priv')
 
     def __repr__(self):
         return str(self.title)
@@ -971,11 +2372,8 @@ class Source(Entity):
             'note_ids': _simplified_refs(self._data.get('noteref')),
         }
 
-    def matches_query(self, query):
-        patterns = query.lower().split()
-        raw_tokens = self.title, self.author, self.pubinfo
-        tokens = [t.lower() for t in raw_tokens if t]
-        return all(any(p in t for t in tokens) for p in patterns)
+    def get_search_texts(self):
+        return self.title, self.author, self.pubinfo
 
     @property
     def title(self):
@@ -1003,6 +2401,7 @@ class Source(Entity):
 
 
 class Citation(Entity):
+    __slots__ = ()
     entity_name = 'citations'
     schema = CITATION_SCHEMA
 
@@ -1011,6 +2410,14 @@ class Citation(Entity):
         'Note': 'noteref.id',
         'MediaObject': 'objref.id',
     }
+    RELATIONS = {
+        'source': Relation('Source', 'sourceref.id'),
+        'notes': Relation('Note', 'noteref.id'),
+        'media': Relation('MediaObject', 'objref.id'),
+    }
+    PUBLIC_DATA_FIELDS = ('page', 'date', 'date_bounds', 'sourceref',
+                          'noteref', 'objref', 'priv')
+    DATED = True
 
     def __repr__(self):
         if self.page:
@@ -1037,11 +2444,11 @@ class Citation(Entity):
     def page(self):
         return self._data.get('page')
 
-    @property
+    @cached_slot_property
     def date(self):
         date = self._data.get('date')
         if date:
-            return DateRepresenter(**date)
+            return DateRepresenter(bounds=self._data.get('date_bounds'), **date)
         else:
             # XXX this is a hack for `xs|sort(attribute='x')` Jinja filter
             # in Python 3.x environment where None can't be compared
@@ -1066,11 +2473,13 @@ class Citation(Entity):
 
 
 class Note(Entity):
+    __slots__ = ()
     entity_name = 'notes'
     schema = NOTE_SCHEMA
     REFERENCES = {
         'MediaObject': 'objref.id',
     }
+    PUBLIC_DATA_FIELDS = ('text', 'type', 'objref', 'priv')
 
     def _get_pretty_data(self):
         return {
@@ -1094,17 +2503,21 @@ class Note(Entity):
 
 
 class Bookmark(Entity):
+    __slots__ = ()
     entity_name = 'bookmarks'
     schema = BOOKMARK_SCHEMA
 
 
 class NameMap(Entity):
+    __slots__ = ()
     entity_name = 'namemaps'
     schema = NAME_MAP_SCHEMA
+    INDEXED_KEYS = 'type',
 
     TYPE_GROUP_AS = 'group_as'
 
-    _cache_by_group_as = {}
+    # `group_as` mappings by collection name, see `get_group_as_map()`
+    _group_as_maps = GenerationalCache()
 
     def __repr__(self):
         return '<{} "{}" → "{}">'.format(self.type, self.key, self.value)
@@ -1129,32 +2542,40 @@ class NameMap(Entity):
         return self._data.get('value')
 
     @classmethod
-    def group_as(self, key):
-        # XXX optimization for in-memory store.
-        # This was the original (slow) version:
-        #
-        #   for item in self.find():
-        #       if item.type == self.TYPE_GROUP_AS and item.key == key:
-        #           return item.value
-        #
-        if not self._cache_by_group_as:
-            for item in self.find():
-                if item.type == self.TYPE_GROUP_AS:
-                    self._cache_by_group_as[item.key] = item.value
-        try:
-            return self._cache_by_group_as[key]
-        except KeyError:
-            return None
+    def get_group_as_map(cls):
+        """
+        Returns a dict of surname aliases (`key` → `value` of all `group_as`
+        name maps).  Loaded with a single query once per data generation.
+        The returned dict must not be modified.
+        """
+        collection = cls._get_collection()
+        return cls._group_as_maps.get(collection.full_name,
+                                      get_data_generation(),
+                                      cls._load_group_as_map)
+
+    @classmethod
+    def _load_group_as_map(cls):
+        conditions = {'type': cls.TYPE_GROUP_AS}
+        _log_query(cls, conditions)
+        items = cls._get_collection().find(conditions, {'key': 1, 'value': 1})
+        return dict((x['key'], x['value']) for x in items)
+
+    @classmethod
+    def group_as(cls, key):
+        return cls.get_group_as_map().get(key)
 
 
 class NameFormat(Entity):
+    __slots__ = ()
     entity_name = 'name-formats'
     schema = NAME_FORMAT_SCHEMA
 
 
 class MediaObject(Entity):
+    __slots__ = ()
     entity_name = 'objects'
     schema = MEDIA_OBJECT_SCHEMA
+    DATED = True
 
     @property
     def src(self):
@@ -1168,11 +2589,12 @@ class MediaObject(Entity):
     def mime(self):
         return self._data['file']['mime']
 
-    @property
+    @cached_slot_property
     def date(self):
         value = self._data.get('date')
         if value:
-            return DateRepresenter(**value)
+            return DateRepresenter(bounds=self._data.get('date_bounds'),
+                                   **value)
         else:
             return ''
 
@@ -1181,6 +2603,7 @@ class MediaObject(Entity):
 
 
 class Repository(Entity):
+    __slots__ = ()
     entity_name = 'repositories'
     schema = REPOSITORY_SCHEMA
 
@@ -1188,6 +2611,268 @@ class Repository(Entity):
         return '<Repository {type} {rname}>'.format(**self._data)
 
 
+#: Query shapes observed in this process, see `find_unindexed_queries()`.
+#: Maps ``(model, shape)`` (see `get_query_shape()`) to the number of
+#: queries.  The values are not kept: they can be large (`$in` lists) and
+#: the shapes are enough to explain the queries.
+OBSERVED_QUERIES = {}
+_observed_queries_lock = threading.Lock()
+
+
+def _log_query(model, conditions):
+    key = model, get_query_shape(conditions)
+    with _observed_queries_lock:
+        OBSERVED_QUERIES[key] = OBSERVED_QUERIES.get(key, 0) + 1
+
+
+# operators whose values are lists of conditions
+LOGICAL_QUERY_OPERATORS = '$and', '$or', '$nor'
+
+# see `_make_probe_conditions()`
+QUERY_PROBE_VALUES = {
+    '$in': [''],
+    '$nin': [''],
+    '$all': [''],
+    '$exists': True,
+    '$size': 0,
+    '$geometry': {'type': 'Point', 'coordinates': [0, 0]},
+    '$maxDistance': 0,
+}
+
+
+def get_query_shape(conditions):
+    """
+    Returns a hashable description of the structure of given query
+    conditions without the values::
+
+        >>> get_query_shape({'id': {'$in': ['I0001', 'I0002']}, 'gender': 'F'})
+        (('gender', None), ('id', (('$in', None),)))
+
+    """
+    return tuple(sorted((key, _get_query_value_shape(key, value))
+                        for key, value in (conditions or {}).items()))
+
+
+def _get_query_value_shape(key, value):
+    if key in LOGICAL_QUERY_OPERATORS:
+        return tuple(get_query_shape(x) for x in value)
+    if key == '$elemMatch' or (isinstance(value, dict) and
+                               all(k.startswith('$') for k in value)):
+        return get_query_shape(value)
+    return None
+
+
+def _make_probe_conditions(shape):
+    """
+    Returns query conditions of given shape (see `get_query_shape()`) with
+    dummy values: enough to see which index the query would use.
+    """
+    conditions = {}
+    for key, value in shape:
+        if key in LOGICAL_QUERY_OPERATORS:
+            conditions[key] = [_make_probe_conditions(x) for x in value]
+        elif value is not None:
+            conditions[key] = _make_probe_conditions(value)
+        else:
+            conditions[key] = QUERY_PROBE_VALUES.get(key, '')
+    return conditions
+
+
+def get_models():
+    return Entity.__subclasses__()
+
+
+# The data generation is stored in this collection so that all processes
+# (web workers, ETL commands) agree on it.
+META_COLLECTION = 'meta'
+DATA_GENERATION_ID = 'data_generation'
+
+# Last known generation by database name, for use outside of requests
+_data_generations = {}
+
+
+def get_data_generation():
+    """
+    Returns the generation number of the current database contents (see
+    `cache.GenerationalCache`).  It is read from the database at most once
+    per request; outside of requests (ETL and other commands) the value
+    read first is reused for the lifetime of the process.
+    """
+    db = Entity._get_database()
+
+    if has_app_context():
+        generations = g.setdefault('data_generations', {})
+    else:
+        generations = _data_generations
+
+    try:
+        return generations[db.name]
+    except KeyError:
+        doc = db[META_COLLECTION].find_one({'_id': DATA_GENERATION_ID})
+        generation = generations[db.name] = doc['value'] if doc else 0
+        return generation
+
+
+def bump_data_generation():
+    """
+    Marks the current database contents as new, invalidating the derived
+    caches in all processes.  Must be called after each import.
+
+    The number is time-based, so it keeps growing even if the database was
+    dropped and recreated by the import.
+    """
+    db = Entity._get_database()
+    doc = db[META_COLLECTION].find_one({'_id': DATA_GENERATION_ID})
+    previous = doc['value'] if doc else 0
+    generation = max(previous + 1, int(time.time() * 1000))
+    db[META_COLLECTION].replace_one({'_id': DATA_GENERATION_ID},
+                                    {'value': generation}, upsert=True)
+
+    _data_generations[db.name] = generation
+    if has_app_context():
+        g.setdefault('data_generations', {})[db.name] = generation
+    return generation
+
+
+def ensure_indexes():
+    """
+    Creates all indexes needed by all models.  Yields a line per index.
+    """
+    for model in get_models():
+        for name in model.ensure_indexes():
+            yield '{}: {}'.format(model.entity_name, name)
+
+
+def build_sort_keys(missing_only=False):
+    """
+    Recomputes stored sort keys for all sortable models.  Yields a line per
+    model.
+
+    If `missing_only` is true, only the documents without sort keys are
+    updated and the models without such documents are not reported.
+    """
+    for model in get_models():
+        if model.SORTABLE:
+            count = model.build_sort_keys(missing_only=missing_only)
+            if count or not missing_only:
+                yield '{}: {} documents'.format(model.entity_name, count)
+
+
+def build_derived_fields(related_only=False):
+    """
+    Recomputes the derived fields (e.g. `date_bounds`, `location`) for all
+    models which have them.  Yields a line per model.
+
+    If `related_only` is true, only the fields depending on other documents
+    (see `Entity.RELATED_FIELDS`) are built; this is a step of the import.
+    """
+    for model in get_models():
+        if related_only:
+            fields = model.RELATED_FIELDS
+        else:
+            fields = model.get_derived_fields()
+        if fields:
+            count = model.build_derived_fields(related_only=related_only)
+            yield '{}: {} documents'.format(model.entity_name, count)
+
+
+def build_search_index():
+    """
+    Rebuilds the search index for all searchable models.  Yields a line
+    per model.
+    """
+    collection = Entity._get_database()[search.SEARCH_COLLECTION]
+    collection.create_index(search.INDEX_SPEC)
+    for model in get_models():
+        if model.SEARCHABLE:
+            count = model.build_search_index()
+            yield '{}: {} documents'.format(model.entity_name, count)
+
+
+# see `Place.build_closure()`
+PLACE_CLOSURE_COLLECTION = 'place_closure'
+PLACE_CLOSURE_INDEXES = 'ancestor', 'descendant'
+
+
+def build_place_closure():
+    "Rebuilds the place hierarchy closure.  Yields a status line."
+    count = Place.build_closure()
+    yield '{}: {} pairs'.format(PLACE_CLOSURE_COLLECTION, count)
+
+
+def _iter_ancestors(pk, parents):
+    """
+    Yields ``(ancestor_id, depth)`` for given place: itself at depth 0, then
+    its parents, grandparents and so on (each once, at the nearest depth).
+    """
+    seen = {pk}
+    current = [pk]
+    depth = 0
+    while current:
+        for ancestor in current:
+            yield ancestor, depth
+        depth += 1
+        following = []
+        for x in current:
+            for parent in parents.get(x, ()):
+                if parent not in seen:
+                    seen.add(parent)
+                    following.append(parent)
+        current = following
+
+
+def _iter_chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def find_unindexed_queries(include_observed=True):
+    """
+    Explains the query shapes used by the models and yields
+    ``(model, conditions, plan_stages)`` for those which require a full
+    collection scan.
+
+    The checked shapes are the lookups by ID and by each reference key
+    (see `Entity.get_index_specs()`) plus, if `include_observed` is true,
+    all queries issued by this process so far (`OBSERVED_QUERIES`).
+    """
+    shapes = OrderedDict()
+
+    for model in get_models():
+        for keys, _ in model.get_index_specs():
+            if isinstance(keys, str):
+                shapes[model, ((keys, None),)] = None
+
+    if include_observed:
+        with _observed_queries_lock:
+            shapes.update(OrderedDict.fromkeys(OBSERVED_QUERIES))
+
+    for model, shape in shapes:
+        if not shape:
+            # full scans are what was asked for
+            continue
+        conditions = _make_probe_conditions(shape)
+        explained = model._get_collection().find(conditions).explain()
+        stages = list(_iter_plan_stages(explained['queryPlanner']['winningPlan']))
+        if 'COLLSCAN' in stages:
+            yield model, conditions, stages
+
+
+def _iter_plan_stages(plan):
+    yield plan.get('stage')
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            yield from _iter_plan_stages(plan[key])
+    for sub_plan in plan.get('inputStages', []):
+        yield from _iter_plan_stages(sub_plan)
+
+
 def _extract_refs(ref):
     """
     Returns a list of IDs (strings)
@@ -1204,6 +2889,36 @@ def _extract_refs(ref):
 
     return [x['id'] if isinstance(x, dict) else x for x in ref]
 
+def _make_keyset_conditions(key, value, pk):
+    "Conditions for documents following given one in `(key, id)` order"
+    if key == 'id':
+        return {'id': {'$gt': pk}}
+    if value is None:
+        # nulls (and missing values) go first
+        return {'$or': [
+            {key: None, 'id': {'$gt': pk}},
+            {key: {'$ne': None}},
+        ]}
+    return {'$or': [
+        {key: {'$gt': value}},
+        {key: value, 'id': {'$gt': pk}},
+    ]}
+
+
+def _get_dotted(data, key):
+    for part in key.split('.'):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(part)
+    return data
+
+
+def _strip_id_suffix(key):
+    # 'eventref.id' is fine for MongoDB lookups, but not for `__getitem__`.
+    if key.endswith('.id'):
+        key = key.partition('.id')[0]
+    return key
+
 def _extract_ids(obj, key):
     value = obj._data.get(key)
     if not value:
@@ -1216,6 +2931,11 @@ def _format_date(obj_data):
         return str(DateRepresenter(**date))
     return ''
 
+def _make_point(lat, lng):
+    # NOTE: GeoJSON wants longitude first
+    return {'type': 'Point', 'coordinates': [float(lng), float(lat)]}
+
+
 def _normalize_coords_to_pure_degrees(coords):
     if isinstance(coords, float):
         return coords
@@ -1229,7 +2949,7 @@ def _normalize_coords_to_pure_degrees(coords):
         # seconds
         pure_degrees += parts.pop(0) / (60*60)
     assert not parts, (coords, pure_degrees, parts)
-    if 'S' in coords or 'W' in coords:
+    if 'S' in coords or 'W' in coords or coords.lstrip().startswith('-'):
         pure_degrees = -pure_degrees
     return pure_degrees
 
@@ -1264,7 +2984,10 @@ class DateRepresenter:
     QUAL_CALCULATED = 'calculated'
     QUALITY_OPTIONS = (QUAL_NONE, QUAL_ESTIMATED, QUAL_CALCULATED)
 
-    def __init__(self, value=None, modifier=MOD_NONE, quality=QUAL_NONE):
+    __slots__ = 'value', 'modifier', 'quality', '_bounds'
+
+    def __init__(self, value=None, modifier=MOD_NONE, quality=QUAL_NONE,
+                 bounds=None):
         assert modifier in self.MODIFIER_OPTIONS
         assert quality in self.QUALITY_OPTIONS
 
@@ -1274,6 +2997,9 @@ class DateRepresenter:
         self.modifier = modifier
         self.quality = quality
 
+        # precomputed `get_date_bounds()`, if stored along with the date
+        self._bounds = bounds or NotImplemented
+
     def __bool__(self):
         return self.value is not None
 
@@ -1333,8 +3059,26 @@ class DateRepresenter:
 
     def __lt__(self, other):
         assert isinstance(other, type(self));
-        # FIXME this is extremely rough
-        return str(self.year) < str(other.year)
+        # unknown dates go first
+        return self.sortkey < other.sortkey
+
+    @property
+    def bounds(self):
+        """
+        A dict with `earliest` and `latest` ordinal days and the `sortkey`
+        (see `get_date_bounds()`) or `None` if the date can't be parsed.
+        """
+        if self._bounds is NotImplemented:
+            self._bounds = get_date_bounds({
+                'value': self.value,
+                'modifier': self.modifier,
+            })
+        return self._bounds
+
+    @property
+    def sortkey(self):
+        bounds = self.bounds
+        return bounds['sortkey'] if bounds else 0
 
     def _can_be_parsed(self):
         return self.modifier != self.MOD_TEXTONLY
@@ -1433,15 +3177,155 @@ class DateRepresenter:
             return datetime.datetime(value)
         if not isinstance(value, str):
             raise TypeError('expected a str, got {!r}'.format(value))
-        # supplying default to avoid bug when the default day (31) was out
-        # of range for given month (e.g. 30th is the last possible DoM).
-        #print('    parse_date(', repr(value),')')
-        return parse_date(value, default=datetime.datetime(1,1,1))
+        return parse_gramps_date(value)
 
     def _parse_to_year(self, value):
         return self._parse_to_datetime(value).year
 
 
+# Both `find_in_date_range()` conditions use the compound index; sorting by
+# date uses the other one.
+DATE_BOUNDS_INDEXES = (
+    [('date_bounds.earliest', 1), ('date_bounds.latest', 1)],
+    'date_bounds.sortkey',
+)
+
+def _get_date_range_conditions(since, until):
+    """
+    Returns MongoDB conditions on the `earliest` and `latest` keys of stored
+    date bounds which overlap given (inclusive) range; see
+    `Entity.find_in_date_range()`.
+    """
+    conditions = {}
+    if until is not None:
+        conditions['earliest'] = {'$lte': _get_bounds(until)[1]}
+    if since is not None:
+        conditions['latest'] = {'$gte': _get_bounds(since)[0]}
+    return conditions
+
+
+GRAMPS_DATE_VALUE_RE = re.compile(r'^(\d{1,4})(?:-(\d\d)(?:-(\d\d))?)?$')
+
+
+def get_date_bounds(date):
+    """
+    Returns numeric bounds of a date in our unified format (as stored under
+    the `date` key) or `None` if the date is unknown or text-only::
+
+        >>> get_date_bounds({'value': '1850'})
+        {'earliest': 675334, 'latest': 675698, 'sortkey': 675334}
+
+    `earliest` and `latest` are ordinal days (see `datetime.date.toordinal()`)
+    covering the whole precision of the value (a year, a month or a day) or
+    both ends of a span or range.  The `sortkey` is the earliest day, moved
+    one day back for "before X" and past the latest day for "after X".
+    """
+    if not date:
+        return None
+    value = date.get('value')
+    modifier = date.get('modifier')
+    if not value or modifier == DateRepresenter.MOD_TEXTONLY:
+        return None
+
+    if isinstance(value, dict):
+        start = value.get('start')
+        stop = value.get('stop')
+        start_bounds = _get_value_bounds(start) if start else None
+        stop_bounds = _get_value_bounds(stop) if stop else None
+        if not (start_bounds or stop_bounds):
+            return None
+        earliest = (start_bounds or stop_bounds)[0]
+        latest = (stop_bounds or start_bounds)[1]
+    else:
+        bounds = _get_value_bounds(value)
+        if not bounds:
+            return None
+        earliest, latest = bounds
+
+    if modifier == DateRepresenter.MOD_BEFORE:
+        sortkey = earliest - 1
+    elif modifier == DateRepresenter.MOD_AFTER:
+        sortkey = latest + 1
+    else:
+        sortkey = earliest
+
+    return {
+        'earliest': earliest,
+        'latest': latest,
+        'sortkey': sortkey,
+    }
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_gramps_date(value):
+    """
+    Returns a `datetime.datetime` for given Gramps date value.  Unknown parts
+    default to the first month/day::
+
+        >>> parse_gramps_date('1850-05')
+        datetime.datetime(1850, 5, 1, 0, 0)
+
+    The usual `YYYY`, `YYYY-MM` and `YYYY-MM-DD` values are parsed directly;
+    only odd strings are handed over to the much slower `dateutil` parser.
+    Results are memoized: the same few thousand values are parsed over and
+    over again by `DateRepresenter` properties.
+    """
+    match = GRAMPS_DATE_VALUE_RE.match(value)
+    if match:
+        year, month, day = match.groups()
+        try:
+            return datetime.datetime(int(year), int(month or 1) or 1,
+                                     int(day or 1) or 1)
+        except ValueError:
+            pass
+    # supplying default to avoid bug when the default day (31) was out
+    # of range for given month (e.g. 30th is the last possible DoM).
+    return parse_date(value, default=datetime.datetime(1,1,1))
+
+
+def _get_value_bounds(value):
+    """
+    Returns a tuple of the earliest and latest ordinal days of given Gramps
+    date value (`YYYY`, `YYYY-MM` or `YYYY-MM-DD`, zeroes for unknown parts)
+    or `None` if it can't be parsed.
+    """
+    match = GRAMPS_DATE_VALUE_RE.match(value)
+    if match:
+        year, month, day = (int(x or 0) for x in match.groups())
+        try:
+            if year and month and day:
+                ordinal = datetime.date(year, month, day).toordinal()
+                return ordinal, ordinal
+            if year and month:
+                last_day = calendar.monthrange(year, month)[1]
+                return (datetime.date(year, month, 1).toordinal(),
+                        datetime.date(year, month, last_day).toordinal())
+            if year:
+                return (datetime.date(year, 1, 1).toordinal(),
+                        datetime.date(year, 12, 31).toordinal())
+        except ValueError:
+            pass
+
+    # something odd, let the generic parser try it
+    try:
+        parsed = parse_date(value, default=datetime.datetime(1,1,1))
+    except (ValueError, OverflowError):
+        return None
+    ordinal = parsed.toordinal()
+    return ordinal, ordinal
+
+
+def _get_bounds(value):
+    "Returns ordinal bounds of a year, a Gramps date string or a date"
+    if isinstance(value, datetime.date):
+        ordinal = value.toordinal()
+        return ordinal, ordinal
+    bounds = _get_value_bounds(str(value))
+    if not bounds:
+        raise ValueError('Cannot parse date {!r}'.format(value))
+    return bounds
+
+
 def _simplified_refs(value):
     """
     Normalizes Gramps references to a predictable form without metadata.
@@ -16,21 +16,31 @@
 #
 #    You should have received a copy of the GNU Lesser General Public License
 #    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+import base64
 import datetime
 import functools
 import itertools
+import json
 import os.path
 import sys
 from time import time
+from urllib.parse import urlencode
 
+from bson import json_util
 from confu import Configurable
 from flask import Blueprint, Response, abort, jsonify, request, render_template
 from pymongo.database import Database
 from werkzeug.utils import secure_filename
 
+from cache import GenerationalCache
 from etl import WTFamilyETL
 
 from models import (
+    OBSERVED_QUERIES,
+    QuerySet,
+    find_unindexed_queries,
+    get_data_generation,
+    get_query_shape,
     Person,
     Event,
     Family,
@@ -49,9 +59,37 @@ def jsonify_with_cors(*args, **kwargs):
     resp = jsonify(*args, **kwargs)
     if ALLOW_ANY_HOST:
         resp.headers.add('Access-Control-Allow-Origin', '*')
+        resp.headers.add('Access-Control-Expose-Headers', 'Link')
     return resp
 
 
+def encode_cursor(position):
+    "Makes an opaque `after` request value from a `Page.next_after`"
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+# JSON types allowed as the sort key value in a cursor (`None` if missing)
+CURSOR_VALUE_TYPES = (str, int, float, type(None))
+
+
+def decode_cursor(cursor):
+    """
+    Returns the `(value, pk)` position from an `after` request value made
+    by `encode_cursor()`.  Anything else (including query operators in
+    place of the values) is rejected.
+    """
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        abort(400, 'Malformed "after"')
+    if not (isinstance(position, list) and len(position) == 2
+            and isinstance(position[0], CURSOR_VALUE_TYPES)
+            and isinstance(position[1], str)):
+        abort(400, 'Malformed "after"')
+    value, pk = position
+    return value, pk
+
+
 def print_json_resp_stats(time_start, resp, purpose):
     time_end = time()
     duration = time_end - time_start
@@ -64,21 +102,93 @@ def print_json_resp_stats(time_start, resp, purpose):
 
 
 class GenericModelAdapter:
+    # relations to batch-load for list items, see `Entity.prefetch()`
+    PREFETCH_RELATIONS = ()
+
+    # `order` request values → keys to page by, see `QuerySet.page()`
+    ORDER_KEYS = {'id': 'id'}
+    MAX_PAGE_SIZE = 1000
+
+    @classmethod
+    def get_page_params(cls):
+        """
+        Returns a `(size, after, key)` tuple from the `limit`, `after` and
+        `order` request values or `None` if neither `limit` nor `after` is
+        given (then the list is not paginated).
+        """
+        size = request.values.get('limit')
+        after = request.values.get('after')
+        if not (size or after):
+            return None
+        try:
+            size = int(size) if size else cls.MAX_PAGE_SIZE
+        except ValueError:
+            abort(400, 'Expected a number in "limit"')
+        if not 0 < size <= cls.MAX_PAGE_SIZE:
+            abort(400, '"limit" must be 1 to {}'.format(cls.MAX_PAGE_SIZE))
+        order = request.values.get('order', 'id')
+        try:
+            key = cls.ORDER_KEYS[order]
+        except KeyError:
+            abort(400, 'Expected one of {} in "order"'.format(
+                ', '.join(sorted(cls.ORDER_KEYS))))
+        return size, decode_cursor(after) if after else None, key
+
+    @classmethod
+    def prefetch(cls, model, obj_list):
+        return model.prefetch(obj_list, *cls.PREFETCH_RELATIONS)
+
+    @classmethod
+    def get_projection(cls, model):
+        "Fields needed to serialize list items, see `prepare_obj()`"
+        return model.PUBLIC_DATA_FIELDS
+
+    @classmethod
+    def get_date_range(cls):
+        """
+        Returns a `(since, until)` tuple from the `from` and `to` request
+        values (years, inclusive) or `None` if neither is given.
+        """
+        since = request.values.get('from')
+        until = request.values.get('to')
+        if not (since or until):
+            return None
+        try:
+            return (int(since) if since else None,
+                    int(until) if until else None)
+        except ValueError:
+            abort(400, 'Expected years in "from" and "to"')
+
     @classmethod
     def provide_list(cls, model):
         only_these_raw = request.values.get('ids', '')
         only_these_ids = [x for x in only_these_raw.split(',') if x]
         by_query = request.values.get('q')
+        date_range = cls.get_date_range()
+        projection = cls.get_projection(model)
 
+        if date_range and not model.can_find_in_date_range():
+            abort(400, 'Cannot filter {} by date'.format(model.entity_name))
+        if by_query and not only_these_ids and not model.SEARCHABLE:
+            abort(400, 'Cannot search {}'.format(model.entity_name))
+
+        conditions = {}
         if only_these_ids:
-            return model.find({'id': {'$in': only_these_ids}})
-        elif by_query:
-            xs = model.find()
-            # TODO: optimize: use class methods FooModel.find_matching()
-            # (i.e. they'd know which fields to search with $or)
+            conditions['id'] = {'$in': only_these_ids}
+
+        if date_range:
+            xs = model.find_in_date_range(*date_range,
+                                          conditions=conditions,
+                                          projection=projection)
+        else:
+            xs = model.find(conditions or None, projection=projection)
+
+        if by_query and not only_these_ids:
+            if model.SEARCHABLE and not date_range:
+                return model.search(by_query)
             return (p for p in xs if p.matches_query(by_query))
         else:
-            return model.find()
+            return xs
 
     @classmethod
     def prepare_obj(cls, obj, protect=False):
@@ -95,10 +205,30 @@ class PlaceModelAdapter(GenericModelAdapter):
         #return super().provide_list(model)
 
         # TODO: do this only on special request
-        return model.aggregate({}, Event)
+        return model.aggregate({}, Event,
+                               projection=cls.get_projection(model))
+
+class FamilyModelAdapter(GenericModelAdapter):
+    model = Family
+    ORDER_KEYS = dict(GenericModelAdapter.ORDER_KEYS,
+                      birth_year='sort_keys.birth_year')
+
 
 class PersonModelAdapter(GenericModelAdapter):
     model = Person
+    PREFETCH_RELATIONS = 'events',
+    ORDER_KEYS = dict(GenericModelAdapter.ORDER_KEYS,
+                      name='sort_keys.name', group='sort_keys.group')
+
+    @classmethod
+    def prefetch(cls, model, obj_list):
+        relations = list(cls.PREFETCH_RELATIONS)
+
+        # FIXME pass request values explicitly
+        if request.values.get('with_related_people_ids'):
+            relations.extend(['parents', 'partners'])
+
+        return model.prefetch(obj_list, *relations)
 
     @classmethod
     def provide_list(cls, model):
@@ -147,7 +277,8 @@ class EventModelAdapter(GenericModelAdapter):
         citation_ids = [x for x in citation_ids_raw.split(',') if x]
 
         if place_id:
-            return Event.find_all_referencing(Place, place_id)
+            return Event.find_all_referencing(
+                Place, place_id, projection=cls.get_projection(model))
         elif citation_ids:
             citations = Citation.find({'id': {'$in': citation_ids}})
             events_by_citation = [c.events for c in citations]
@@ -167,7 +298,8 @@ class CitationModelAdapter(GenericModelAdapter):
         source_id = request.values.get('source')
 
         if source_id:
-            return model.find_all_referencing(Source, source_id)
+            return model.find_all_referencing(
+                Source, source_id, projection=cls.get_projection(model))
         else:
             return super().provide_list(model)
 
@@ -201,7 +333,7 @@ class RESTfulService(Configurable):
         mapping = {
             Person: ('people', PersonModelAdapter),
             Event: ('events', EventModelAdapter),
-            Family: ('families', GenericModelAdapter),
+            Family: ('families', FamilyModelAdapter),
             Place: ('places', PlaceModelAdapter),
             Source: ('sources', GenericModelAdapter),
             Citation: ('citations', CitationModelAdapter),
@@ -223,10 +355,16 @@ class RESTfulService(Configurable):
             blueprint.route(url_detail, methods=['GET'])(handler_detail)
 
         blueprint.route('/person_name_groups', methods=['GET'])(self.person_name_group_list)
+        blueprint.route('/people/<string:id>/relationship/<string:other_id>',
+                        methods=['GET'])(self.relationship_detail)
 
         blueprint.route('/etl/gramps_xml', methods=['GET', 'POST'])(
             self.etl_gramps_xml)
 
+        if self.debug:
+            blueprint.route('/debug/unindexed_queries', methods=['GET'])(
+                self.unindexed_query_list)
+
         return blueprint
 
     def _list(self, model, adapter, debug):
@@ -234,10 +372,32 @@ class RESTfulService(Configurable):
 
         obj_list = adapter.provide_list(model)
 
+        if debug and request.values.get('explain'):
+            # e.g. `/r/places/?explain=1` to check index use
+            if not isinstance(obj_list, QuerySet):
+                abort(400, 'The list is not a single query')
+            return Response(json_util.dumps(obj_list.explain()),
+                            mimetype='application/json')
+
+        next_after = None
+        page_params = adapter.get_page_params()
+        if page_params:
+            if not isinstance(obj_list, QuerySet):
+                abort(400, 'This list cannot be paginated')
+            obj_list, next_after = obj_list.page(*page_params)
+
+        obj_list = adapter.prefetch(model, obj_list)
+
         protect = not debug
         pure_data_items = [adapter.prepare_obj(obj, protect) for obj in obj_list]
         resp = jsonify_with_cors(pure_data_items)
 
+        if next_after:
+            args = request.args.to_dict()
+            args['after'] = encode_cursor(next_after)
+            resp.headers.add('Link', '<{}?{}>; rel="next"'.format(
+                request.base_url, urlencode(args)))
+
         purpose = '{} list'.format(model.__name__)
         print_json_resp_stats(time_start, resp, purpose)
 
@@ -259,30 +419,90 @@ class RESTfulService(Configurable):
 
         return resp
 
+    def relationship_detail(self, id, other_id):
+        """
+        How two people are related: the shortest path between them (IDs and
+        relation kinds, see `Person.find_relationship()`) and a kinship
+        label.  Responds with 404 if either person is missing or they are
+        not related.  Usage::
+
+          GET /r/people/I0001/relationship/I0042?max_length=20
+        """
+        time_start = time()
+
+        try:
+            person = Person.get(id)
+            other = Person.get(other_id)
+        except Person.ObjectNotFound:
+            abort(404)
+
+        try:
+            max_length = int(request.values.get('max_length', 0)) or None
+        except ValueError:
+            abort(400, 'Expected a number in "max_length"')
+
+        relationship = person.find_relationship(other, max_length)
+        if relationship is None:
+            abort(404, 'The people are not related')
+
+        resp = jsonify_with_cors({
+            'label': relationship.label,
+            'path': [{'id': step.person.id, 'kind': step.kind}
+                     for step in relationship.path],
+        })
+
+        print_json_resp_stats(time_start, resp, purpose='relationship')
+
+        return resp
+
+    # person name groups by database name, see `person_name_group_list()`
+    _person_name_groups = GenerationalCache()
+
     @classmethod
-    @functools.lru_cache()
     def person_name_group_list(cls):
-        "Runs once, caches the response (already in JSON)"
+        "Computed once per data generation"
 
         time_start = time()
 
+        group_names = cls._person_name_groups.get(
+            Person._get_database().name, get_data_generation(),
+            cls._get_person_name_groups)
+
+        resp = jsonify_with_cors(group_names)
+
+        print_json_resp_stats(time_start, resp, purpose='surname_list')
+
+        return resp
+
+    @classmethod
+    def _get_person_name_groups(cls):
         seen_group_names = {}
 
-        for p in Person.find():
+        for p in Person.find(projection=['name']):
             group_name = p.group_name
             data = seen_group_names.setdefault(group_name, {})
             #data['count'] = data.get('count', 0) + 1
             data.setdefault('person_ids', []).append(p.id)
 
-        group_names = [
+        return [
             dict({'name': n}, **seen_group_names[n])
             for n in sorted(seen_group_names)]
 
-        resp = jsonify_with_cors(group_names)
-
-        print_json_resp_stats(time_start, resp, purpose='surname_list')
-
-        return resp
+    def unindexed_query_list(self):
+        """
+        Lists queries (both declared by the models and actually issued by
+        this process) that cannot use an index.
+        """
+        items = []
+        for model, conditions, stages in find_unindexed_queries():
+            count = OBSERVED_QUERIES.get((model, get_query_shape(conditions)), 0)
+            items.append({
+                'collection': model.entity_name,
+                'keys': tuple(sorted(conditions)),
+                'times_issued': count,
+                'plan': stages,
+            })
+        return jsonify_with_cors(items)
 
     def etl_gramps_xml(self):
         """
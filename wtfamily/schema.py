@@ -116,6 +116,16 @@ MIXED_DATE_SCHEMA_MIXIN = {
     **GRAMPS_DATE_SCHEMA_MIXIN
 }
 
+# Derived from `date` on import (see `models.get_date_bounds()`), only for
+# top-level documents; used for indexed date range queries and sorting.
+DATE_BOUNDS_SCHEMA_MIXIN = {
+    maybe-'date_bounds': {
+        'earliest': int,    # ordinal day (see `datetime.date.toordinal()`)
+        'latest': int,
+        'sortkey': int,
+    },
+}
+
 ATTRIBUTE = {
     'type': str,
     'value': str,
@@ -181,6 +191,10 @@ FAMILY_SCHEMA = {
     },
     maybe-'citationref': [REF_SCHEMA],
     maybe-'noteref': [REF_SCHEMA],
+    # derived after import, see `Family.get_sort_keys()`
+    maybe-'sort_keys': {
+        'birth_year': str,
+    },
     maybe-'childref': [
         {
             'id': str,
@@ -210,6 +224,13 @@ PLACE_SCHEMA = {
         },
     ],
     maybe-'coord': {'long': str, 'lat': str},
+    # derived from `coord` on import, see `Place.get_location()`
+    maybe-'location': {
+        'type': Equals('Point'),
+        'coordinates': [float],    # longitude, latitude
+    },
+    # the same, for range queries, see `Place.find_within()`
+    maybe-'latlng': {'lat': float, 'lng': float},
     #maybe-'alt_name': [str],
     maybe-'change': datetime.datetime,
     'type': str,    # TODO: strict check?
@@ -278,6 +299,21 @@ PERSON_SCHEMA = {
         }
     ],
     maybe-'attribute': [ ATTRIBUTE ],
+
+    # derived after import, see `Person.get_sort_keys()`
+    maybe-'sort_keys': {
+        'name': str,
+        'group': str,
+    },
+
+    # derived after import, see `Person._update_related_fields()`
+    maybe-'event_date_bounds': [
+        {
+            'earliest': int,
+            'latest': int,
+            'sortkey': int,
+        },
+    ],
 }
 SOURCE_SCHEMA = {
     'stitle': str,
@@ -296,6 +332,7 @@ CITATION_SCHEMA = {
     maybe-'confidence': str,
 
     **MIXED_DATE_SCHEMA_MIXIN,
+    **DATE_BOUNDS_SCHEMA_MIXIN,
 }
 EVENT_SCHEMA = {
     'type': str,    # TODO enum
@@ -306,7 +343,8 @@ EVENT_SCHEMA = {
     maybe-'objref': [OBJREF_SCHEMA],
     maybe-'attribute': [ATTRIBUTE],
 
-    **MIXED_DATE_SCHEMA_MIXIN
+    **MIXED_DATE_SCHEMA_MIXIN,
+    **DATE_BOUNDS_SCHEMA_MIXIN,
 }
 NOTE_SCHEMA = {
     'text': str,
@@ -343,6 +381,7 @@ MEDIA_OBJECT_SCHEMA = {
     maybe-'citationref': [REF_SCHEMA],
 
     **MIXED_DATE_SCHEMA_MIXIN,
+    **DATE_BOUNDS_SCHEMA_MIXIN,
 }
 REPOSITORY_SCHEMA = {
     'rname': str,
@@ -0,0 +1,97 @@
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+"""
+Substring search index.
+
+Searchable models (see `Entity.SEARCHABLE`) contribute normalized tokens
+(names, titles, etc.) per document.  The index stores them in a separate
+collection along with all their n-grams up to `GRAM_SIZE` characters, with
+a multikey index on the grams.  A query pattern is looked up by its own
+grams (or as a whole if it's short enough), so the database only returns
+documents that may contain it; the candidates are then checked for real
+substring matches.  The cost is thus proportional to the number of
+candidates rather than to the size of the collection.
+"""
+import unicodedata
+
+
+SEARCH_COLLECTION = 'search'
+GRAM_SIZE = 3
+
+INDEX_SPEC = [('model', 1), ('grams', 1)]
+
+
+def normalize(text):
+    """
+    Returns a case- and accent-insensitive form of given text::
+
+        >>> normalize('Пётр Érard')
+        'петр erard'
+
+    """
+    decomposed = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def split_query(query):
+    "Returns normalized patterns; all of them must match"
+    return normalize(query).split()
+
+
+def get_grams(tokens):
+    "Returns a set of all substrings of up to `GRAM_SIZE` characters"
+    grams = set()
+    for token in tokens:
+        for size in range(1, GRAM_SIZE + 1):
+            grams.update(token[i:i+size] for i in range(len(token) - size + 1))
+    # query patterns never contain whitespace
+    return set(x for x in grams if not any(c.isspace() for c in x))
+
+
+def get_pattern_grams(pattern):
+    "Returns the grams every token containing given pattern must have"
+    if len(pattern) <= GRAM_SIZE:
+        return [pattern]
+    return [pattern[i:i+GRAM_SIZE]
+            for i in range(len(pattern) - GRAM_SIZE + 1)]
+
+
+def make_document(model_name, pk, texts):
+    tokens = sorted(set(normalize(x) for x in texts if x))
+    return {
+        'model': model_name,
+        'id': pk,
+        'tokens': tokens,
+        'grams': sorted(get_grams(tokens)),
+    }
+
+
+def make_conditions(model_name, patterns):
+    grams = []
+    for pattern in patterns:
+        grams.extend(x for x in get_pattern_grams(pattern) if x not in grams)
+    return {
+        'model': model_name,
+        'grams': {'$all': grams},
+    }
+
+
+def matches(tokens, patterns):
+    "Each pattern must be a substring of some token"
+    return all(any(p in t for t in tokens) for p in patterns)
@@ -0,0 +1,76 @@
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+import os
+
+import pytest
+
+import kinship
+import models
+from models import Entity, NameMap
+
+
+def _bulk_write(collection, requests, ordered=True):
+    # mongomock's `bulk_write()` is incompatible with pymongo 4 `UpdateOne`
+    for x in requests:
+        collection.update_one(x._filter, x._doc)
+
+
+def _reset_caches(monkeypatch):
+    # the databases have the same names and generations, so the derived
+    # data cached by one test would be served to the next one
+    monkeypatch.setattr(models, '_data_generations', {})
+    NameMap._group_as_maps.clear()
+    kinship._graphs.clear()
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """
+    An empty in-memory database (mongomock) used by all models.  Skips the
+    test if mongomock is not installed.
+    """
+    mongomock = pytest.importorskip('mongomock')
+    db = mongomock.MongoClient().db
+    # some code replaces it (e.g. `load()`), make sure it's restored
+    monkeypatch.setattr(Entity, '_get_database', classmethod(lambda cls: db))
+    monkeypatch.setattr(Entity, 'READ_VALIDATION', Entity.READ_VALIDATION_TRUST)
+    monkeypatch.setattr(mongomock.Collection, 'bulk_write', _bulk_write)
+    _reset_caches(monkeypatch)
+    return db
+
+
+@pytest.fixture
+def server_db(monkeypatch):
+    """
+    A throwaway database on a real MongoDB server (for query plans etc.)
+    given by the `WTFAMILY_TEST_MONGODB_URI` environment variable.  Skips
+    the test if it is not set.
+    """
+    uri = os.environ.get('WTFAMILY_TEST_MONGODB_URI')
+    if not uri:
+        pytest.skip('WTFAMILY_TEST_MONGODB_URI is not set')
+    from pymongo import MongoClient
+    client = MongoClient(uri)
+    db_name = 'wtfamily-test-{}'.format(os.getpid())
+    client.drop_database(db_name)
+    db = client[db_name]
+    monkeypatch.setattr(Entity, '_get_database', classmethod(lambda cls: db))
+    _reset_caches(monkeypatch)
+    yield db
+    client.drop_database(db_name)
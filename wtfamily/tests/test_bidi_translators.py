@@ -165,6 +165,49 @@ def test_list_of_strings():
     assert deserialized_from_xml == data
 
 
+def test_compiled_once():
+    class DishTranslator(s.TagTranslator):
+        ATTRS = {
+            'base': str,
+            'amount': int,
+        }
+        TEXT_UNDER_KEY = 'text'
+
+    class CafeTranslator(s.TagTranslator):
+        ATTRS = 'place',
+        TAGS = {
+            'visitor': s.MaybeMany(s.TextTagTranslator),
+            'dish': s.OneOrMore(DishTranslator),
+        }
+
+    # the tables are built with the class, sorted for serialization
+    assert CafeTranslator._attr_order == ['place']
+    assert [k for k, _ in CafeTranslator._tag_order] == ['dish', 'visitor']
+    assert DishTranslator._attr_order == ['amount', 'base']
+
+    # the same stateless translator handles all nested tags of a kind
+    dish_translator, is_list, _ = CafeTranslator._tag_handlers['dish']
+    assert isinstance(dish_translator, DishTranslator)
+    assert is_list
+
+    xml = trim('''
+    <green-midget-cafe xmlns="http://example.org/cafe/" place="Bromley">
+      <dish amount="2" base="egg">spam</dish>
+      <dish amount="1" base="bacon">spam</dish>
+    </green-midget-cafe>
+    ''')
+    data = {
+        'place': 'Bromley',
+        'dish': [
+            {'amount': 2, 'base': 'egg', 'text': 'spam'},
+            {'amount': 1, 'base': 'bacon', 'text': 'spam'},
+        ],
+    }
+
+    # namespaced tags are matched by the local names
+    assert CafeTranslator().from_xml(etree.fromstring(xml)) == data
+
+
 class TestMappingMultipleTagsToOneKey:
     """
     GrampsXML keeps the date in one of a few tags; WTFamily uses a single key
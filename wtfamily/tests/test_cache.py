@@ -0,0 +1,69 @@
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+import threading
+import time
+
+from cache import GenerationalCache
+
+
+def test_reused_within_generation():
+    cache = GenerationalCache()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return {'Petrova': 'Petrov'}
+
+    first = cache.get('namemaps', 1, loader)
+    second = cache.get('namemaps', 1, loader)
+
+    assert first is second
+    assert len(calls) == 1
+
+
+def test_reloaded_on_new_generation():
+    cache = GenerationalCache()
+
+    assert cache.get('namemaps', 1, lambda: 'old') == 'old'
+    assert cache.get('namemaps', 2, lambda: 'new') == 'new'
+    assert cache.get('other', 2, lambda: 'other') == 'other'
+    assert len(cache) == 2
+
+
+def test_concurrent_first_access_loads_once():
+    cache = GenerationalCache()
+    calls = []
+    results = []
+
+    def loader():
+        calls.append(1)
+        time.sleep(0.05)
+        return object()
+
+    def worker():
+        results.append(cache.get('namemaps', 1, loader))
+
+    threads = [threading.Thread(target=worker) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert len(set(map(id, results))) == 1
@@ -0,0 +1,198 @@
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+import datetime
+
+import pytest
+
+import models
+from models import Event, Note, Person, get_date_bounds, parse_gramps_date
+
+
+def _day(*args):
+    return datetime.date(*args).toordinal()
+
+
+@pytest.mark.parametrize('date,expected', [
+    # year only
+    ({'value': '1850'}, (_day(1850, 1, 1), _day(1850, 12, 31))),
+    ({'value': '1850-00-00'}, (_day(1850, 1, 1), _day(1850, 12, 31))),
+    # year and month
+    ({'value': '1850-02'}, (_day(1850, 2, 1), _day(1850, 2, 28))),
+    # full date
+    ({'value': '1850-05-17'}, (_day(1850, 5, 17), _day(1850, 5, 17))),
+    # compound dates cover both ends
+    ({'modifier': 'range', 'value': {'start': '1850', 'stop': '1855-06'}},
+     (_day(1850, 1, 1), _day(1855, 6, 30))),
+    ({'modifier': 'span', 'value': {'start': '1850-05-17'}},
+     (_day(1850, 5, 17), _day(1850, 5, 17))),
+    ({'modifier': 'span', 'value': {'stop': '1855'}},
+     (_day(1855, 1, 1), _day(1855, 12, 31))),
+    # qualifiers don't widen the bounds
+    ({'modifier': 'about', 'value': '1850'},
+     (_day(1850, 1, 1), _day(1850, 12, 31))),
+    ({'modifier': 'before', 'value': '1850'},
+     (_day(1850, 1, 1), _day(1850, 12, 31))),
+    ({'quality': 'estimated', 'value': '1850'},
+     (_day(1850, 1, 1), _day(1850, 12, 31))),
+])
+def test_date_bounds(date, expected):
+    bounds = get_date_bounds(date)
+
+    assert (bounds['earliest'], bounds['latest']) == expected
+
+
+@pytest.mark.parametrize('modifier,sortkey', [
+    (None, _day(1850, 1, 1)),
+    ('about', _day(1850, 1, 1)),
+    ('before', _day(1849, 12, 31)),
+    ('after', _day(1851, 1, 1)),
+])
+def test_date_bounds_sortkey(modifier, sortkey):
+    date = {'value': '1850', 'modifier': modifier}
+
+    assert get_date_bounds(date)['sortkey'] == sortkey
+
+
+@pytest.mark.parametrize('date', [
+    None,
+    {},
+    {'value': ''},
+    {'value': 'about 1850', 'modifier': 'textonly'},
+    {'value': 'sometime'},
+    {'value': '1850-13'},
+    {'modifier': 'span', 'value': {}},
+])
+def test_no_date_bounds(date):
+    assert get_date_bounds(date) is None
+
+
+@pytest.fixture
+def events(db):
+    for pk, date in [
+        ('E1', {'value': '1850'}),
+        ('E2', {'value': '1855-03-10'}),
+        ('E3', {'modifier': 'range',
+                'value': {'start': '1860', 'stop': '1865'}}),
+        ('E4', {'modifier': 'before', 'value': '1870'}),
+        ('E5', None),
+    ]:
+        data = {'id': pk, 'type': 'Birth'}
+        if date:
+            data['date'] = date
+        Event(data).save()
+
+
+@pytest.mark.parametrize('since,until,expected', [
+    # a year matches all days of a year-only date
+    (1850, 1850, ['E1']),
+    ('1850-07', '1850-07', ['E1']),
+    # the bounds are inclusive
+    ('1855-03-10', None, ['E2', 'E3', 'E4']),
+    (None, '1855-03-10', ['E1', 'E2']),
+    (None, '1855-03-09', ['E1']),
+    (datetime.date(1855, 3, 11), datetime.date(1859, 12, 31), []),
+    # a range overlaps any part of it
+    (1863, 1863, ['E3']),
+    (1865, 1870, ['E3', 'E4']),
+    # "before" is not open-ended
+    (1871, None, []),
+    # undated events never match
+    (None, None, ['E1', 'E2', 'E3', 'E4']),
+])
+def test_find_in_date_range(events, since, until, expected):
+    found = Event.find_in_date_range(since, until)
+
+    assert sorted(x.id for x in found) == expected
+
+
+def test_find_in_date_range_with_conditions(events):
+    found = Event.find_in_date_range(1850, 1870,
+                                     conditions={'id': {'$in': ['E1', 'E5']}})
+
+    assert [x.id for x in found] == ['E1']
+
+
+def test_find_in_bad_date_range(events):
+    with pytest.raises(ValueError):
+        Event.find_in_date_range('sometime')
+
+
+def test_find_undated_in_date_range():
+    assert Event.can_find_in_date_range()
+    # by the dates of the events
+    assert Person.can_find_in_date_range()
+    assert not Note.can_find_in_date_range()
+    with pytest.raises(ValueError):
+        Note.find_in_date_range(1850)
+
+
+@pytest.fixture
+def parse_date_calls(monkeypatch):
+    "Values passed to the `dateutil` parser by `parse_gramps_date()`"
+    calls = []
+
+    def _parse_date(value, **kwargs):
+        calls.append(value)
+        return parse_date(value, **kwargs)
+
+    parse_date = models.parse_date
+    monkeypatch.setattr(models, 'parse_date', _parse_date)
+    parse_gramps_date.cache_clear()
+    yield calls
+    parse_gramps_date.cache_clear()
+
+
+@pytest.mark.parametrize('value,expected,fallback', [
+    # year only
+    ('1850', datetime.datetime(1850, 1, 1), False),
+    ('850', datetime.datetime(850, 1, 1), False),
+    # year and month
+    ('1850-05', datetime.datetime(1850, 5, 1), False),
+    # full date
+    ('1850-05-17', datetime.datetime(1850, 5, 17), False),
+    # zeroes for unknown parts
+    ('1850-00-00', datetime.datetime(1850, 1, 1), False),
+    ('1850-05-00', datetime.datetime(1850, 5, 1), False),
+    # odd formats
+    ('17 May 1850', datetime.datetime(1850, 5, 17), True),
+    ('1850/05/17', datetime.datetime(1850, 5, 17), True),
+])
+def test_parse_gramps_date(parse_date_calls, value, expected, fallback):
+    assert parse_gramps_date(value) == expected
+    assert parse_date_calls == ([value] if fallback else [])
+
+
+@pytest.mark.parametrize('value', [
+    '1850-02-30',
+    '1850-13',
+    'sometime',
+    '',
+])
+def test_parse_bad_gramps_date(parse_date_calls, value):
+    with pytest.raises(ValueError):
+        parse_gramps_date(value)
+    # the fast path gives up on them, `dateutil` has the last word
+    assert parse_date_calls == [value]
+
+
+def test_parse_gramps_date_is_memoized(parse_date_calls):
+    first = parse_gramps_date('17 May 1850')
+
+    assert parse_gramps_date('17 May 1850') is first
+    assert parse_date_calls == ['17 May 1850']
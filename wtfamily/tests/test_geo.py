@@ -0,0 +1,92 @@
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+import math
+
+import pytest
+
+import geo
+
+
+PARIS = 48.8566, 2.3522
+LONDON = 51.5074, -0.1278
+MOSCOW = 55.7558, 37.6173
+
+
+def test_distance_matrix():
+    matrix = geo.distance_matrix([PARIS, LONDON, MOSCOW])
+
+    assert matrix.shape == (3, 3)
+    assert (matrix.diagonal() == 0).all()
+    assert (matrix == matrix.T).all()
+    assert matrix[0, 1] == pytest.approx(344, rel=0.01)
+    assert matrix[0, 2] == pytest.approx(2486, rel=0.01)
+
+
+def test_distance_matrix_rectangular_with_missing_coords():
+    matrix = geo.distance_matrix([PARIS, None], [LONDON, MOSCOW, PARIS])
+
+    assert matrix.shape == (2, 3)
+    assert matrix[0, 2] == 0
+    assert all(math.isnan(x) for x in matrix[1])
+
+
+def test_leg_distances():
+    legs = geo.leg_distances([PARIS, LONDON, PARIS])
+
+    assert legs.tolist() == pytest.approx([344, 344], rel=0.01)
+
+
+def test_route_lengths():
+    paris_london = geo.distance_matrix([PARIS], [LONDON])[0, 0]
+    lengths = geo.route_lengths([
+        [PARIS, LONDON, PARIS],
+        [],
+        [MOSCOW],
+        [LONDON, None, PARIS],
+        [PARIS, LONDON],
+        [],
+    ])
+
+    # no legs between the routes, unknown points are skipped
+    assert lengths.tolist() == pytest.approx(
+        [2 * paris_london, 0, 0, paris_london, paris_london, 0])
+
+
+def test_route_lengths_skip_unknown_points():
+    lengths = geo.route_lengths([
+        [PARIS, None, MOSCOW],
+        [None, PARIS, None, None, LONDON, None],
+        [None, None],
+    ])
+
+    assert lengths.tolist() == pytest.approx([
+        geo.distance(PARIS, MOSCOW),
+        geo.distance(PARIS, LONDON),
+        0,
+    ])
+
+
+def test_distance():
+    assert geo.distance(PARIS, LONDON) == pytest.approx(344, rel=0.01)
+    assert math.isnan(geo.distance(PARIS, None))
+
+
+def test_route_lengths_empty():
+    assert geo.route_lengths([]).tolist() == []
+    assert geo.route_lengths([[PARIS]]).tolist() == [0]
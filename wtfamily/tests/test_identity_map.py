@@ -0,0 +1,97 @@
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+import contextlib
+
+from flask import Flask, g
+import pytest
+
+from models import Entity, IdentityMap, Person
+
+
+@pytest.fixture
+def people(db):
+    db.people.insert_many([
+        {'id': 'I1', 'gender': 'M', 'name': [{'first': 'Иван'}]},
+        {'id': 'I2', 'gender': 'F', 'name': [{'first': 'Анна'}]},
+    ])
+
+
+@pytest.fixture
+def app():
+    return Flask(__name__)
+
+
+@contextlib.contextmanager
+def _request(app):
+    "A request context with the identity map set up as by the web app"
+    with app.test_request_context('/'):
+        g.identity_map = IdentityMap()
+        yield
+
+
+def test_same_instance_within_request(people, app):
+    with _request(app):
+        person = Person.get('I1')
+
+        assert Person.get('I1') is person
+        assert Person.find_one({'id': 'I1'}) is person
+        assert [x for x in Person.find() if x.id == 'I1'] == [person]
+        assert Person.find({'id': 'I1'}).first() is person
+        assert Person.find_by_pks(['I2', 'I1'])[1] is person
+        assert g.identity_map.stats['items'] == 2
+
+
+def test_lookups_by_pk_hit_the_map(people, app, monkeypatch):
+    with _request(app):
+        person = Person.get('I1')
+        monkeypatch.setattr(Person, '_get_collection', classmethod(
+            lambda cls: pytest.fail('no query expected')))
+
+        assert Person.get('I1') is person
+        assert Person.find_by_pks(['I1']) == [person]
+        assert g.identity_map.hits == 2
+
+
+def test_partial_documents_are_not_registered(people, app):
+    with _request(app):
+        partial = Person.find({'id': 'I1'}, projection=['gender']).first()
+
+        assert partial.is_partial
+        assert g.identity_map.peek(Person, 'I1') is None
+        # the full instance is not shadowed by the partial one
+        person = Person.get('I1')
+        assert not person.is_partial
+        # ...and is reused even for projected queries
+        assert Person.find({'id': 'I1'}, projection=['gender']).first() is person
+
+
+def test_dropped_between_requests(people, app):
+    with _request(app):
+        first_map = g.identity_map
+        person = Person.get('I1')
+
+    with _request(app):
+        assert g.identity_map is not first_map
+        assert len(g.identity_map) == 0
+        assert Person.get('I1') is not person
+
+
+def test_no_map_outside_of_requests(people):
+    assert Entity._get_identity_map() is None
+    assert Person.get('I1') is not Person.get('I1')
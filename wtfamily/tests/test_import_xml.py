@@ -0,0 +1,193 @@
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+import gzip
+
+import pytest
+
+from etl import gramps_xml_to_mongo as importer
+from etl.handles import HandleTable
+from models import Event, NameMap, Person
+
+
+XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<database xmlns="http://gramps-project.org/xml/1.7.1/">
+  <header>
+    <created date="2018-01-01" version="4.2.8"/>
+  </header>
+  <events>
+    <event handle="_e1" change="1500000000" id="E0001">
+      <type>Birth</type>
+      <dateval val="1850-05-01"/>
+    </event>
+  </events>
+  <people>
+    <person handle="_i1" change="1500000000" id="I0001">
+      <gender>M</gender>
+      <name type="Birth Name">
+        <first>Ivan</first>
+        <surname>Petrov</surname>
+      </name>
+      <eventref hlink="_e1" role="Primary"/>
+    </person>
+  </people>
+  <namemaps>
+    <map type="group_as" key="Petrova" value="Petrov"/>
+  </namemaps>
+</database>
+'''
+
+
+@pytest.fixture(params=['plain', 'gzip'])
+def path(request, tmpdir):
+    path = str(tmpdir.join('data.gramps'))
+    opener = gzip.open if request.param == 'gzip' else open
+    with opener(path, 'wt', encoding='utf-8') as f:
+        f.write(XML)
+    return path
+
+
+def test_iter_records(path):
+    records = [(model, el.get('id') or el.get('key'))
+               for model, el in importer.iter_records(path)]
+
+    assert records == [
+        (Event, 'E0001'),
+        (Person, 'I0001'),
+        (NameMap, 'Petrova'),
+    ]
+
+
+def test_streaming_matches_in_memory(path):
+    in_memory = importer.transform(importer.extract(path))
+    streamed = importer.transform_stream(path)
+
+    def _key(item):
+        return item[1].__name__, str(item[2])
+
+    assert (sorted(((None, m, d) for _, m, d in in_memory), key=_key) ==
+            sorted(((None, m, d) for _, m, d in streamed), key=_key))
+
+
+def test_parallel_matches_serial(path):
+    serial = [(model, model(data).prepare_to_save())
+              for _, model, data in importer.transform_stream(path)]
+    parallel = list(importer.transform_stream(path, workers=2, chunk_size=1))
+
+    # same records in the same order, ready to be saved
+    assert [(m, d) for _, m, d in parallel] == serial
+    # the elements are stand-ins good enough for error messages
+    assert [importer._describe_element(el) for el, _, _ in parallel] == [
+        '<event id="E0001" handle="_e1">',
+        '<person id="I0001" handle="_i1">',
+        '<map key="Petrova">',
+    ]
+
+
+def test_refs_are_resolved(path):
+    people = [data for _, model, data in importer.transform_stream(path)
+              if model == Person]
+
+    assert people[0]['eventref'] == [{'id': 'E0001', 'role': 'Primary'}]
+
+
+def test_handle_table():
+    table = HandleTable()
+    for i in range(1000):
+        table.add('_h{}'.format(i), 'I{:04d}'.format(i))
+    table.freeze()
+
+    assert len(table) == 1000
+    assert table['_h0'] == 'I0000'
+    assert table['_h999'] == 'I0999'
+    assert '_h500' in table
+    assert '_nope' not in table
+    with pytest.raises(KeyError):
+        table['_nope']
+
+    with pytest.raises(RuntimeError):
+        table.add('_h1000', 'I1000')
+
+
+def test_handle_table_rejects_duplicates():
+    table = HandleTable()
+    table.add('_h1', 'I0001')
+    table.add('_h1', 'I0002')
+
+    with pytest.raises(ValueError):
+        table.freeze()
+
+
+def test_collect_handles(path):
+    table = importer.collect_handles(
+        el for _, el in importer._iter_record_elements(path))
+
+    assert len(table) == 2
+    assert table['_e1'] == 'E0001'
+    assert table['_i1'] == 'I0001'
+
+
+def test_load_in_batches(path, db, capsys):
+    importer.load(importer.transform_stream(path), db, batch_size=1)
+
+    assert db.people.count_documents({}) == 1
+    assert db.namemaps.count_documents({}) == 1
+    # derived fields are added
+    assert 'date_bounds' in db.events.find_one({'id': 'E0001'})
+    assert 'people: 1 records' in capsys.readouterr().out
+
+
+def test_load_in_parallel(path, db):
+    items = importer.transform_stream(path, workers=2)
+    importer.load(items, db, prepared=True)
+
+    assert db.people.count_documents({}) == 1
+    assert 'date_bounds' in db.events.find_one({'id': 'E0001'})
+
+
+def test_load_error_points_to_record(path, db, capsys):
+    from pymongo.errors import BulkWriteError
+
+    db.people.create_index('id', unique=True)
+    importer.load(importer.transform_stream(path), db)
+
+    with pytest.raises(BulkWriteError):
+        importer.load(importer.transform_stream(path), db)
+
+    assert '<person id="I0001" handle="_i1">' in capsys.readouterr().out
+
+
+def test_reimport_uses_new_name_aliases(tmpdir, db):
+    def _import(alias):
+        path = str(tmpdir.join('{}.gramps'.format(alias)))
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(XML.replace('<surname>Petrov</surname>',
+                                '<surname>Petrova</surname>')
+                       .replace('value="Petrov"', 'value="{}"'.format(alias)))
+        # as `import_gramps_xml --replace` does
+        for name in db.list_collection_names():
+            db.drop_collection(name)
+        importer.import_from_xml(path, db)
+
+    _import('Petrov')
+    # the running app has the aliases cached for the current data
+    assert Person.find_one({'id': 'I0001'}).group_name == 'Petrov'
+
+    _import('Petrovsky')
+
+    assert [x.id for x in Person.search('Petrovsky')] == ['I0001']
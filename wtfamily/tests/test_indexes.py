@@ -0,0 +1,137 @@
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+import threading
+
+import pytest
+
+import models
+from models import (OBSERVED_QUERIES, Event, Person, ensure_indexes,
+                    find_unindexed_queries, get_query_shape)
+
+
+@pytest.fixture
+def observed():
+    OBSERVED_QUERIES.clear()
+    yield OBSERVED_QUERIES
+    OBSERVED_QUERIES.clear()
+
+
+@pytest.mark.parametrize('conditions,shape', [
+    (None, ()),
+    ({'id': 'I1'}, (('id', None),)),
+    ({'id': {'$in': ['I1', 'I2']}, 'gender': 'F'},
+     (('gender', None), ('id', (('$in', None),)))),
+    # dicts which are values, not operators
+    ({'eventref': {'id': 'E1'}}, (('eventref', None),)),
+    ({'$or': [{'a': 1}, {'b': {'$gte': 1}}]},
+     (('$or', ((('a', None),), (('b', (('$gte', None),)),))),)),
+    ({'bounds': {'$elemMatch': {'earliest': {'$lte': 1}}}},
+     (('bounds', (('$elemMatch', (('earliest', (('$lte', None),)),)),)),)),
+    ({'location': {'$nearSphere': {'$geometry': {'type': 'Point',
+                                                 'coordinates': [1, 2]},
+                                   '$maxDistance': 5}}},
+     (('location', (('$nearSphere', (('$geometry', None),
+                                      ('$maxDistance', None))),)),)),
+])
+def test_query_shape(conditions, shape):
+    assert get_query_shape(conditions) == shape
+    # the conditions to explain the query are built from the shape
+    probe = models._make_probe_conditions(shape)
+    assert get_query_shape(probe) == shape
+
+
+def test_only_query_shapes_are_kept(db, observed):
+    list(Person.find({'id': {'$in': ['I1', 'I2']}}))
+    list(Person.find({'id': {'$in': ['I3']}}))
+    Event.find_one({'id': 'E1'})
+
+    assert observed == {
+        (Person, (('id', (('$in', None),)),)): 2,
+        (Event, (('id', None),)): 1,
+    }
+
+
+def test_queries_are_counted_in_all_threads(observed):
+    def _query():
+        for _ in range(1000):
+            models._log_query(Person, {'gender': 'F'})
+
+    threads = [threading.Thread(target=_query) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert observed == {(Person, (('gender', None),)): 8000}
+
+
+def test_ensure_indexes(db):
+    lines = list(ensure_indexes())
+
+    assert 'people: id_1' in lines
+    assert 'people: eventref.id_1' in lines
+    assert 'events: date_bounds.earliest_1_date_bounds.latest_1' in lines
+    assert db.people.index_information()['id_1']['unique']
+    # existing indexes are fine
+    assert list(ensure_indexes()) == lines
+
+
+def _fake_explain(cursor):
+    "Plans a collection scan unless a top-level key starts some index"
+    indexed = set(keys[0][0] for keys in
+                  (x['key'] for x in
+                   cursor.collection.index_information().values()))
+    stage = 'IXSCAN' if indexed & set(cursor._spec) else 'COLLSCAN'
+    return {'queryPlanner': {'winningPlan': {'stage': 'FETCH',
+                                             'inputStage': {'stage': stage}}}}
+
+
+def test_unindexed_queries_are_reported(db, observed, monkeypatch):
+    import mongomock
+    explained = []
+    monkeypatch.setattr(
+        mongomock.collection.Cursor, 'explain',
+        lambda cursor: explained.append(cursor._spec) or _fake_explain(cursor),
+        raising=False)
+    list(ensure_indexes())
+    list(Person.find({'gender': 'F'}))
+    list(Person.find({'id': {'$in': ['I1']}}))
+    list(Person.find())
+
+    found = list(find_unindexed_queries())
+
+    assert found == [(Person, {'gender': ''}, ['FETCH', 'COLLSCAN'])]
+    # the reference keys are checked, the observed values are not used
+    assert {'eventref.id': ''} in explained
+    assert {'id': {'$in': ['']}} in explained
+    # full scans are not reported
+    assert {} not in explained
+
+
+def test_unindexed_queries_on_server(server_db, observed):
+    list(ensure_indexes())
+    list(Person.find({'gender': 'F'}))
+    list(Person.find({'id': {'$in': ['I1']}}))
+    list(Event.find_in_date_range(1850, 1860))
+    list(Person.find_in_date_range(1850, 1860))
+
+    found = [(model, conditions) for model, conditions, _
+             in find_unindexed_queries()]
+
+    assert found == [(Person, {'gender': ''})]
@@ -0,0 +1,215 @@
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+import pytest
+
+from kinship import KinshipGraph, describe_path, label_blood_relation
+
+
+def _family(pk, father=None, mother=None, children=()):
+    data = {
+        'id': pk,
+        'childref': [{'id': x} for x in children],
+    }
+    if father:
+        data['father'] = {'id': father}
+    if mother:
+        data['mother'] = {'id': mother}
+    return data
+
+
+# Two cousins (A2 and B2) marry; their grandparents are the same couple.
+FAMILIES = [
+    _family('F1', father='G1', mother='G2', children=['A1', 'B1']),
+    _family('F2', father='A1', mother='AW', children=['A2']),
+    _family('F3', father='BH', mother='B1', children=['B2']),
+    _family('F4', father='A2', mother='B2', children=['C1', 'C2']),
+]
+
+
+def test_direct_relations():
+    graph = KinshipGraph(FAMILIES)
+
+    assert graph.parents_of('C1') == ['B2', 'A2']
+    assert graph.children_of('A2') == ['C1', 'C2']
+    assert graph.partners_of('A2') == ['B2']
+    assert graph.siblings_of('C1') == ['C2']
+    assert graph.parents_of('unknown') == []
+
+
+def test_ancestors_are_deduplicated():
+    graph = KinshipGraph(FAMILIES)
+
+    generations = list(graph.iter_generations('C1', 'parents'))
+
+    assert generations == [
+        (0, ['C1']),
+        (1, ['B2', 'A2']),
+        (2, ['B1', 'BH', 'AW', 'A1']),
+        # G1 and G2 are reachable via both A2 and B2 but listed once
+        (3, ['G2', 'G1']),
+    ]
+
+
+def test_max_generations():
+    graph = KinshipGraph(FAMILIES)
+
+    generations = list(graph.iter_generations('G1', 'children',
+                                              max_generations=2))
+
+    assert generations == [
+        (0, ['G1']),
+        (1, ['A1', 'B1']),
+        (2, ['A2', 'B2']),
+    ]
+
+
+def test_find_path():
+    graph = KinshipGraph(FAMILIES)
+
+    assert graph.find_path('A2', 'B2') == [('A2', None), ('B2', 'partners')]
+    assert graph.find_path('AW', 'BH') == [
+        ('AW', None),
+        ('A2', 'children'),
+        ('B2', 'partners'),
+        ('BH', 'parents'),
+    ]
+    assert graph.find_path('C1', 'C1') == [('C1', None)]
+
+
+def test_find_path_is_shortest():
+    graph = KinshipGraph(FAMILIES)
+
+    # via the common grandparents it would be 4 steps
+    path = graph.find_path('A1', 'C2')
+
+    assert [kind for _, kind in path[1:]] == ['children', 'children']
+
+
+def test_find_path_unrelated():
+    graph = KinshipGraph(FAMILIES + [_family('F5', father='X1')])
+
+    assert graph.find_path('C1', 'X1') is None
+    assert graph.find_path('C1', 'unknown') is None
+    assert graph.find_path('G1', 'C1', max_length=2) is None
+    assert graph.find_path('G1', 'C1', max_length=3) is not None
+
+
+@pytest.mark.parametrize('up,down,expected', [
+    (0, 0, 'self'),
+    (1, 0, 'parent'),
+    (2, 0, 'grandparent'),
+    (4, 0, 'great-great-grandparent'),
+    (0, 3, 'great-grandchild'),
+    (1, 1, 'sibling'),
+    (2, 1, 'aunt or uncle'),
+    (3, 1, 'great-aunt or uncle'),
+    (1, 3, 'great-niece or nephew'),
+    (2, 2, 'first cousin'),
+    (3, 4, 'second cousin once removed'),
+    (2, 5, 'first cousin thrice removed'),
+    (13, 12, '11th cousin once removed'),
+])
+def test_label_blood_relation(up, down, expected):
+    assert label_blood_relation(up, down) == expected
+
+
+def test_describe_path():
+    assert describe_path([]) == 'self'
+    assert describe_path(['parents', 'parents'], ['M', 'F', 'F']) == 'grandmother'
+    assert describe_path(['parents', 'children'], ['F', 'M', 'F']) == 'sister'
+    assert describe_path(['partners', 'parents', 'children'],
+                         [None, 'F', None, 'M']) == "wife's brother"
+    assert describe_path(['children', 'parents'], ['M', 'F', 'F']) == (
+        "daughter's mother")
+    assert describe_path(['parents', 'parents', 'children', 'children'],
+                         ['F', 'M', 'F', 'F', 'M']) == 'first cousin'
+
+
+def _person_ids(family):
+    for key in 'father', 'mother':
+        if key in family:
+            yield family[key]['id']
+    for ref in family['childref']:
+        yield ref['id']
+
+
+@pytest.fixture
+def kin_db(db):
+    db.families.insert_many([dict(x) for x in FAMILIES])
+    pks = set(x for family in FAMILIES for x in _person_ids(family))
+    db.people.insert_many([{'id': pk, 'gender': 'M', 'name': []}
+                           for pk in sorted(pks)])
+    return db
+
+
+@pytest.fixture
+def graph_builds(monkeypatch):
+    "Collections the kinship graphs were built from"
+    builds = []
+    from_collection = KinshipGraph.from_collection.__func__
+
+    def _from_collection(cls, collection):
+        builds.append(collection.name)
+        return from_collection(cls, collection)
+
+    monkeypatch.setattr(KinshipGraph, 'from_collection',
+                        classmethod(_from_collection))
+    return builds
+
+
+def test_graph_from_collection(kin_db):
+    graph = KinshipGraph.from_collection(kin_db.families)
+
+    assert graph.parents_of('C1') == KinshipGraph(FAMILIES).parents_of('C1')
+    assert len(graph.ids) == 10
+
+
+def test_graph_is_built_once_per_generation(kin_db, graph_builds):
+    from models import Person, bump_data_generation
+
+    assert [x.id for x in Person.get('C1').get_parents()] == ['B2', 'A2']
+    assert [x.id for x in Person.get('A2').get_children()] == ['C1', 'C2']
+    assert graph_builds == ['families']
+
+    kin_db.families.insert_one({'id': 'F5', 'father': {'id': 'C1'},
+                                'childref': [{'id': 'G1'}]})
+    # stale until the next import
+    assert Person.get('C1').get_children() == []
+    bump_data_generation()
+
+    assert [x.id for x in Person.get('C1').get_children()] == ['G1']
+    assert graph_builds == ['families', 'families']
+
+
+def test_kin_are_found_without_family_queries(kin_db, graph_builds,
+                                              monkeypatch):
+    import models
+    from models import Person
+
+    Person._get_kinship_graph()
+    queried = []
+    monkeypatch.setattr(models, '_log_query', lambda model, conditions:
+                        queried.append(model))
+    person = Person.get('C1')
+
+    assert [x.id for x in person.get_siblings()] == ['C2']
+    assert [x.id for x in person.get_parents()[1].get_partners()] == ['B2']
+    assert [x.id for x, _ in person.traverse('parents', 2)][:3] == [
+        'C1', 'B2', 'A2']
+    assert set(queried) == {Person}
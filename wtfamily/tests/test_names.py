@@ -0,0 +1,111 @@
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+import pytest
+
+from models import ParsedName, Person
+
+
+IVAN = {
+    'type': 'Birth Name',
+    'first': 'Иван',
+    'surname': [
+        {'text': 'Петров'},
+        {'text': 'Иванович', 'derivation': 'Patronymic'},
+        {'text': 'Сидоров', 'prim': '0'},
+    ],
+}
+VANYA = {'type': 'Also Known As', 'first': 'Ваня', 'surname': ['Петров']}
+
+
+@pytest.fixture
+def name_db(db):
+    db.namemaps.insert_one({'type': 'group_as', 'key': 'Петрова',
+                            'value': 'Петров'})
+    return db
+
+
+def _person(*names):
+    return Person({'id': 'I1', 'gender': 'M', 'name': list(names)})
+
+
+@pytest.mark.parametrize('name,expected', [
+    (IVAN, ParsedName('Иван', ['Петров'], ['Иванович'], ['Сидоров'], None)),
+    (VANYA, ParsedName('Ваня', ['Петров'], [], [], None)),
+    ({'type': 'Birth Name', 'surname': [{'text': 'Петрова'}],
+      'group': 'Сидоровы'},
+     ParsedName('?', ['Петрова'], [], [], 'Сидоровы')),
+    ({'type': 'Birth Name', 'first': 'Анна'},
+     ParsedName('Анна', ['?'], [], [], None)),
+])
+def test_parsed_names(name_db, name, expected):
+    assert _person(name).parsed_names == [expected]
+
+
+def test_formatted_names(name_db):
+    person = _person(IVAN, VANYA)
+
+    # same as formatted from scratch
+    assert person.names == [Person._format_name(IVAN),
+                            Person._format_name(VANYA)]
+    assert person.name == 'Иван Иванович Петров (Сидоров)'
+    assert person.first_and_last_names == 'Иван Петров'
+    assert person.first_name == 'Иван'
+    assert _person(dict(IVAN, surname=IVAN['surname'][:2])).initials == 'ИИП'
+
+
+@pytest.mark.parametrize('names,group_names,group_name', [
+    # the first found surname
+    ([IVAN], ['Петров'], 'Петров'),
+    # explicit group and aliases go first
+    ([{'type': 'Birth Name', 'first': 'Анна', 'group': 'Сидоровы',
+       'surname': [{'text': 'Петрова'}]}],
+     ['Сидоровы', 'Петров', 'Петрова'], 'Сидоровы'),
+    ([{'type': 'Birth Name', 'first': 'Анна', 'surname': []}],
+     [], 'Анна'),
+])
+def test_group_names(name_db, names, group_names, group_name):
+    person = _person(*names)
+
+    assert person.group_names == group_names
+    assert person.group_name == group_name
+
+
+def test_names_are_parsed_once(name_db, monkeypatch):
+    calls = []
+    get_name_parts = Person._get_name_parts.__func__
+
+    def _get_name_parts(cls, name_node):
+        calls.append(name_node['first'])
+        return get_name_parts(cls, name_node)
+
+    monkeypatch.setattr(Person, '_get_name_parts',
+                        classmethod(_get_name_parts))
+    person = _person(IVAN, VANYA)
+
+    for _ in range(2):
+        person.get_public_data()
+        person.get_sort_keys()
+        list(person.get_search_texts())
+
+    assert calls == ['Иван', 'Ваня']
+    assert person.names is person.names
+    assert person.group_names is person.group_names
+    # other instances of the same document parse it again
+    assert _person(IVAN).name == person.name
+    assert calls == ['Иван', 'Ваня', 'Иван']
@@ -0,0 +1,189 @@
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+import pytest
+
+from models import Place
+
+
+def _make_place(coord):
+    return Place({'id': 'P0001', 'type': 'City', 'pname': [{'value': 'X'}],
+                  'coord': coord})
+
+
+@pytest.mark.parametrize('coord,expected', [
+    ({'lat': '55.75', 'long': '37.62'}, [37.62, 55.75]),
+    ({'lat': '-33.9', 'long': '-151.2'}, [-151.2, -33.9]),
+    ({'lat': 'unknown', 'long': '37.62'}, None),
+    ({'lat': '95', 'long': '37.62'}, None),
+])
+def test_location(coord, expected):
+    place = _make_place(coord)
+    location = place.get_location()
+    if expected is None:
+        assert location is None
+    else:
+        assert location == {'type': 'Point', 'coordinates': expected}
+
+
+PLACES = {
+    'Paris': (48.86, 2.35),
+    'Moscow': (55.75, 37.62),
+    'Lyon': (45.76, 4.84),
+    'Greenwich': (45, 0),
+    'Anadyr': (64.73, 177.5),
+    'Nome': (64.5, -165.4),
+    'Sydney': (-33.87, 151.21),
+}
+
+
+@pytest.mark.parametrize('bbox,expected', [
+    ((50, 30, 60, 40), {'Moscow'}),
+    # wide viewport: its south edge is a line of latitude, not a great
+    # circle bulging to the north
+    ((40, -45, 60, 45), {'Paris', 'Lyon', 'Greenwich', 'Moscow'}),
+    ((60, 170, 70, -160), {'Anadyr', 'Nome'}),
+    ((-90, -180, 90, 180), set(PLACES)),
+    # collapsed map
+    ((40, 10, 60, 10), set()),
+])
+def test_find_within(db, bbox, expected):
+    _insert_places(db)
+
+    assert {x.id for x in Place.find_within(bbox)} == expected
+
+
+def _insert_places(db):
+    db.places.insert_many([
+        {'id': name, 'type': 'City',
+         'coord': {'lat': str(lat), 'long': str(lng)}}
+        for name, (lat, lng) in PLACES.items()
+    ])
+    Place.build_derived_fields()
+
+
+@pytest.mark.parametrize('bbox', [
+    (40, -45, 60, 45),
+    (60, 170, 70, -160),
+])
+def test_find_within_uses_index(server_db, bbox):
+    from models import ensure_indexes
+
+    _insert_places(server_db)
+    list(ensure_indexes())
+
+    stages = Place.find_within(bbox).get_plan_stages()
+
+    assert 'IXSCAN' in stages
+    assert 'COLLSCAN' not in stages
+
+
+@pytest.mark.parametrize('with_closure', [True, False])
+def test_hierarchy_stats(db, with_closure):
+    from models import Event, build_place_closure
+
+    # Russia > Moscow > Kremlin
+    db.places.insert_many([
+        {'id': 'P1'},
+        {'id': 'P2', 'placeref': [{'id': 'P1'}]},
+        {'id': 'P3', 'placeref': [{'id': 'P2'}]},
+    ])
+    db.events.insert_many([
+        {'id': 'E1', 'place': {'id': 'P1'}},
+        {'id': 'E2', 'place': {'id': 'P2'}},
+        {'id': 'E3', 'place': {'id': 'P3'}},
+        {'id': 'E4', 'place': {'id': 'P3'}},
+    ])
+    if with_closure:
+        list(build_place_closure())
+
+    stats = Place.get_hierarchy_stats(Place.find())
+
+    assert stats == {
+        'P1': {'events': 1, 'events_recursive': 4, 'places': 1},
+        'P2': {'events': 1, 'events_recursive': 3, 'places': 1},
+        'P3': {'events': 2, 'events_recursive': 2, 'places': 0},
+    }
+
+
+@pytest.fixture
+def place_tree(db):
+    # a place nested in two others (e.g. in a country and a historical
+    # region), and a reference loop which must not hang the import
+    db.places.insert_many([
+        {'id': 'P1'},
+        {'id': 'P2', 'placeref': [{'id': 'P1'}]},
+        {'id': 'P3', 'placeref': [{'id': 'P1'}]},
+        {'id': 'P4', 'placeref': [{'id': 'P2'}, {'id': 'P3'}]},
+        {'id': 'L1', 'placeref': [{'id': 'L2'}]},
+        {'id': 'L2', 'placeref': [{'id': 'L1'}]},
+    ])
+    db.events.insert_many([
+        {'id': 'E1', 'place': {'id': 'P4'}},
+        {'id': 'E2', 'place': {'id': 'P4'}},
+        {'id': 'E3', 'place': {'id': 'P2'}},
+        {'id': 'E4', 'place': {'id': 'L1'}},
+    ])
+    return db
+
+
+def test_build_place_closure(place_tree):
+    from models import build_place_closure
+
+    assert list(build_place_closure()) == ['place_closure: 13 pairs']
+
+    pairs = sorted((x['ancestor'], x['descendant'], x['depth'])
+                   for x in place_tree.place_closure.find())
+    assert pairs == [
+        ('L1', 'L1', 0), ('L1', 'L2', 1), ('L2', 'L1', 1), ('L2', 'L2', 0),
+        ('P1', 'P1', 0), ('P1', 'P2', 1), ('P1', 'P3', 1),
+        # once, at the nearest depth
+        ('P1', 'P4', 2),
+        ('P2', 'P2', 0), ('P2', 'P4', 1),
+        ('P3', 'P3', 0), ('P3', 'P4', 1),
+        ('P4', 'P4', 0),
+    ]
+    # rebuilding replaces the pairs
+    assert list(build_place_closure()) == ['place_closure: 13 pairs']
+
+
+def test_hierarchy_stats_from_closure(place_tree, monkeypatch):
+    import models
+    from models import build_place_closure
+
+    list(build_place_closure())
+    places = list(Place.find())
+    queried = []
+    monkeypatch.setattr(models, '_log_query', lambda model, conditions:
+                        queried.append(model))
+
+    stats = Place.get_hierarchy_stats(places)
+
+    assert stats == {
+        # the events of P4 are counted once
+        'P1': {'events': 0, 'events_recursive': 3, 'places': 2},
+        'P2': {'events': 1, 'events_recursive': 3, 'places': 1},
+        'P3': {'events': 0, 'events_recursive': 2, 'places': 1},
+        'P4': {'events': 2, 'events_recursive': 2, 'places': 0},
+        'L1': {'events': 1, 'events_recursive': 1, 'places': 1},
+        'L2': {'events': 0, 'events_recursive': 1, 'places': 1},
+    }
+    # no tree walking
+    assert queried == []
+    assert sorted(places[0].descendant_ids) == ['P1', 'P2', 'P3', 'P4']
+    assert [x.id for x in places[0].events_recursive] == ['E1', 'E2', 'E3']
@@ -0,0 +1,385 @@
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+import pytest
+
+from models import Citation, Event, Family, Person, Place, QuerySet
+
+
+def test_find_is_lazy(monkeypatch):
+    monkeypatch.setattr(Person, '_get_collection', classmethod(
+        lambda cls: pytest.fail('the query must not run yet')))
+
+    queryset = Person.find({'gender': 'F'}).order_by('-sort_keys.name')
+
+    assert isinstance(queryset, QuerySet)
+
+
+def test_filter():
+    queryset = Event.find({'type': 'Birth'})
+
+    assert queryset.filter(priv=False).conditions == {
+        'type': 'Birth', 'priv': False}
+    assert queryset.filter({'type': 'Death'}).conditions == {
+        '$and': [{'type': 'Birth'}, {'type': 'Death'}]}
+    # the original query set is not modified
+    assert queryset.conditions == {'type': 'Birth'}
+
+
+def test_pipeline():
+    queryset = (Event.find({'type': 'Birth'})
+                .order_by('date_bounds.sortkey', '-id')
+                .skip(20)
+                .limit(10)
+                .only('date')
+                .aggregate(Place))
+
+    pipeline = queryset.get_pipeline()
+
+    assert [list(x)[0] for x in pipeline] == [
+        '$match', '$sort', '$skip', '$limit', '$lookup', '$project']
+    assert list(pipeline[1]['$sort'].items()) == [
+        ('date_bounds.sortkey', 1), ('id', -1)]
+    assert pipeline[4]['$lookup'] == {
+        'from': 'places',
+        'as': 'related_places',
+        'localField': 'place.id',
+        'foreignField': 'id',
+    }
+    assert set(pipeline[5]['$project']) == {'date', 'id', 'related_places'}
+
+
+def test_aggregate_needs_a_reference():
+    with pytest.raises(ValueError):
+        Place.find().aggregate(Person)
+
+
+def test_query_runs_on_server(db):
+    db.events.insert_many([
+        {'id': 'E{}'.format(i), 'type': 'Birth', 'date_bounds':
+         {'earliest': i, 'latest': i, 'sortkey': 10 - i}}
+        for i in range(10)
+    ])
+
+    queryset = Event.find().order_by('date_bounds.sortkey').skip(2).limit(3)
+
+    assert [x.id for x in queryset] == ['E7', 'E6', 'E5']
+    assert queryset.count() == 3
+    assert Event.find({'id': {'$in': ['E1', 'E2']}}).count() == 2
+    assert queryset.only('type').first().is_partial
+
+
+@pytest.fixture
+def partial_event(db):
+    db.events.insert_one({'id': 'E1', 'type': 'Birth', 'description': 'X',
+                          'place': {'id': 'P1'}})
+    return Event.find().only('type', 'description').first()
+
+
+@pytest.mark.parametrize('access', [
+    lambda doc: doc['place'],
+    lambda doc: doc.get('place'),
+    lambda doc: 'place' in doc,
+    lambda doc: list(doc),
+    lambda doc: len(doc),
+    lambda doc: doc.keys(),
+    lambda doc: doc.values(),
+    lambda doc: doc.items(),
+    lambda doc: dict(doc),
+    lambda doc: dict(**doc),
+    lambda doc: doc.copy(),
+])
+def test_strict_partial_document(partial_event, monkeypatch, access):
+    from models import FieldNotLoaded
+
+    monkeypatch.setattr(partial_event._data, '_policy', 'strict')
+
+    # projected fields are fine...
+    assert partial_event._data['type'] == 'Birth'
+    assert partial_event._data.get('description') == 'X'
+    assert sorted(partial_event._data.loaded_keys()) == [
+        '_id', 'description', 'id', 'type']
+    # ...the rest and the whole document are not
+    with pytest.raises(FieldNotLoaded):
+        access(partial_event._data)
+
+
+def test_partial_document_fetches_the_rest(partial_event):
+    data = dict(partial_event._data)
+
+    assert data['place'] == {'id': 'P1'}
+    assert not partial_event.is_partial
+    assert sorted(partial_event._data) == [
+        '_id', 'description', 'id', 'place', 'type']
+
+
+def test_public_data_of_partial_document(db, monkeypatch):
+    monkeypatch.setattr(Event, 'PARTIAL_DOCUMENT_POLICY', 'strict')
+    db.events.insert_one({'id': 'E1', 'type': 'Birth', 'place': {'id': 'P1'},
+                          'citationref': [{'id': 'C1'}]})
+
+    event = Event.find().only(*Event.PUBLIC_DATA_FIELDS).first()
+
+    assert event.get_public_data()['type'] == 'Birth'
+    assert event.is_partial
+
+
+def test_sort_keys(db):
+    names = [('Пётр', 'Сидоров'), ('Иван', 'Петров'), ('Анна', 'Петрова')]
+    for i, (first, surname) in enumerate(names):
+        Person({'id': 'I{}'.format(i), 'gender': 'M',
+                'name': [{'type': 'Birth Name', 'first': first,
+                          'surname': [{'text': surname}]}]}).save()
+    db.namemaps.insert_one({'type': 'group_as', 'key': 'Петрова',
+                            'value': 'Петров'})
+
+    Person.build_sort_keys()
+
+    by_name = Person.find().order_by('sort_keys.name')
+    by_group = Person.find().order_by('sort_keys.group', 'sort_keys.name')
+    assert [x.id for x in by_name] == ['I2', 'I1', 'I0']
+    assert [(x.id, x._data['sort_keys']['group']) for x in by_group] == [
+        ('I2', 'Петров'), ('I1', 'Петров'), ('I0', 'Сидоров')]
+
+
+def test_build_missing_sort_keys(db):
+    from models import build_sort_keys
+
+    # as in a database imported before the sort keys were introduced
+    db.people.insert_many([
+        {'id': 'I1', 'name': [{'first': 'Иван',
+                               'surname': [{'text': 'Петров'}]}]},
+        {'id': 'I2', 'name': [{'first': 'Анна'}],
+         'sort_keys': {'name': 'stale', 'group': 'stale'}},
+    ])
+
+    assert list(build_sort_keys(missing_only=True)) == ['people: 1 documents']
+    assert list(build_sort_keys(missing_only=True)) == []
+    assert db.people.find_one({'id': 'I1'})['sort_keys']['group'] == 'Петров'
+    assert db.people.find_one({'id': 'I2'})['sort_keys']['name'] == 'stale'
+
+
+def test_build_derived_fields(db):
+    from models import build_derived_fields
+
+    # as in a database imported before the fields were introduced
+    db.events.insert_many([
+        {'id': 'E1', 'type': 'Birth', 'date': {'value': '1850-05-01'}},
+        {'id': 'E2', 'type': 'Birth', 'date_bounds': {'earliest': 1}},
+    ])
+    db.places.insert_one({'id': 'P1', 'coord': {'lat': '55.75',
+                                                 'long': '37.62'}})
+
+    lines = list(build_derived_fields())
+
+    assert 'events: 2 documents' in lines
+    assert 'places: 1 documents' in lines
+    assert 'date_bounds' in db.events.find_one({'id': 'E1'})
+    # stale derived fields are removed
+    assert 'date_bounds' not in db.events.find_one({'id': 'E2'})
+    assert db.places.find_one({'id': 'P1'})['location'] == {
+        'type': 'Point', 'coordinates': [37.62, 55.75]}
+    assert db.places.find_one({'id': 'P1'})['latlng'] == {
+        'lat': 55.75, 'lng': 37.62}
+
+
+def test_people_in_date_range(db):
+    from models import build_derived_fields
+
+    # the people are loaded before their events (as on import)
+    db.people.insert_many([
+        {'id': 'I1', 'eventref': [{'id': 'E1'}, {'id': 'E2'}]},
+        {'id': 'I2', 'eventref': [{'id': 'E3'}]},
+        {'id': 'I3'},
+    ])
+    db.events.insert_many([
+        {'id': 'E1', 'type': 'Birth', 'date': {'value': '1800'}},
+        {'id': 'E2', 'type': 'Death', 'date': {'value': '1900'}},
+        {'id': 'E3', 'type': 'Birth'},
+    ])
+
+    lines = list(build_derived_fields(related_only=True))
+
+    assert lines == ['people: 3 documents']
+    assert len(db.people.find_one({'id': 'I1'})['event_date_bounds']) == 2
+    assert 'event_date_bounds' not in db.people.find_one({'id': 'I2'})
+    # the span between two events does not match
+    assert [x.id for x in Person.find_in_date_range(1850, 1860)] == []
+    assert [x.id for x in Person.find_in_date_range(1890, 1910)] == ['I1']
+    assert [x.id for x in Person.find_in_date_range(until=1800)] == ['I1']
+    assert [x.id for x in Person.find_in_date_range()] == ['I1']
+
+
+def test_relation_pipeline():
+    queryset = Person.find({'gender': 'F'}).aggregate('parents.events',
+                                                       'families.people')
+
+    pipeline = queryset.get_pipeline()
+
+    # a single `$match` regardless of the number of lookups
+    assert [list(x)[0] for x in pipeline] == [
+        '$match', '$lookup', '$addFields', '$unset', '$lookup']
+    families = pipeline[1]['$lookup']
+    assert families['localField'] == 'childof.id'
+    assert [(x['$lookup']['as'], x['$lookup']['localField'])
+            for x in families['pipeline']] == [
+        ('prefetched_mother', 'mother.id'),
+        ('prefetched_father', 'father.id'),
+    ]
+    assert [x['$lookup']['as'] for x in
+            families['pipeline'][0]['$lookup']['pipeline']] == [
+        'prefetched_events']
+    assert [x['$lookup']['as'] for x in pipeline[4]['$lookup']['pipeline']] == [
+        'prefetched_father', 'prefetched_mother', 'prefetched_children']
+
+
+def test_unknown_relation():
+    with pytest.raises(ValueError):
+        Person.find().aggregate('cousins')
+
+
+def test_relations_are_prefetched(db):
+    # NOTE: mongomock can't run nested lookups (e.g. kinship relations) and
+    # lookups by keys in lists (e.g. `childref.id`)
+    db.people.insert_many([
+        {'id': 'I1', 'gender': 'F', 'name': [], 'childof': [{'id': 'F1'}]},
+        {'id': 'I2', 'gender': 'F', 'name': [], 'parentin': [{'id': 'F1'}]},
+        {'id': 'I3', 'gender': 'M', 'name': [], 'parentin': [{'id': 'F1'}]},
+        {'id': 'I4', 'gender': 'M', 'name': [], 'childof': [{'id': 'F1'}]},
+    ])
+    db.families.insert_one({
+        'id': 'F1', 'father': {'id': 'I3'}, 'mother': {'id': 'I2'},
+        'childref': [{'id': 'I4'}, {'id': 'I1'}],
+    })
+    db.events.insert_one({'id': 'E1', 'type': 'Birth', 'place': {'id': 'P1'}})
+    db.places.insert_one({'id': 'P1', 'pname': [{'value': 'X'}]})
+
+    event = Event.find().aggregate('place').first()
+    family = Family.find().aggregate('parents').first()
+
+    assert event._prefetched['place'][0].id == 'P1'
+    assert (family.father.id, family.mother.id) == ('I3', 'I2')
+    assert family._prefetched['father'] == [family.father]
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    "(model, conditions) of the queries run by the models"
+    import models
+
+    queries = []
+    monkeypatch.setattr(models, '_log_query', lambda model, conditions:
+                        queries.append((model, conditions)))
+    return queries
+
+
+@pytest.fixture
+def family_db(db):
+    db.people.insert_many([
+        {'id': 'I1', 'gender': 'M', 'name': [], 'parentin': [{'id': 'F1'}],
+         'eventref': [{'id': 'E1'}], 'citationref': [{'id': 'C1'}]},
+        {'id': 'I2', 'gender': 'F', 'name': [], 'parentin': [{'id': 'F1'}],
+         'eventref': [{'id': 'E2'}, {'id': 'E404'}]},
+        {'id': 'I3', 'gender': 'F', 'name': [], 'childof': [{'id': 'F1'}],
+         'eventref': [{'id': 'E3'}, {'id': 'E1'}]},
+    ])
+    db.families.insert_one({
+        'id': 'F1', 'father': {'id': 'I1'}, 'mother': {'id': 'I2'},
+        'childref': [{'id': 'I3'}],
+    })
+    db.events.insert_many([
+        {'id': 'E{}'.format(i), 'type': 'Birth'} for i in (1, 2, 3)])
+    db.citations.insert_one({'id': 'C1', 'sourceref': {'id': 'S1'}})
+    return db
+
+
+def test_prefetch_runs_one_query_per_relation(family_db, queries):
+    people = list(Person.find())
+    del queries[:]
+
+    people = Person.prefetch(people, 'events', 'citations')
+
+    assert [model for model, _ in queries] == [Event, Citation]
+    del queries[:]
+    assert [[e.id for e in p.find_related(Event)] for p in people] == [
+        ['E1'], ['E2'], ['E3', 'E1']]
+    assert [len(p.find_related(Citation)) for p in people] == [1, 0, 0]
+    # shared referents are the same instances
+    assert people[0].find_related(Event)[0] is people[2].find_related(Event)[1]
+    assert queries == []
+
+
+def test_prefetch_skips_missing_referents(family_db, queries):
+    person = Person.prefetch([Person.get('I2')], 'events')[0]
+    del queries[:]
+
+    assert [e.id for e in person.find_related(Event)] == ['E2']
+    assert queries == []
+
+
+def test_prefetch_is_not_repeated(family_db, queries):
+    people = Person.prefetch(Person.find(), 'events')
+    del queries[:]
+
+    Person.prefetch(people, 'events')
+
+    assert queries == []
+
+
+def test_prefetch_kinship_relations(family_db, queries):
+    people = list(Person.find())
+    # the graph is built once per data generation
+    Person._get_kinship_graph()
+    del queries[:]
+
+    people = Person.prefetch(people, 'parents.events', 'partners')
+
+    assert [model for model, _ in queries] == [Person, Event, Person]
+    del queries[:]
+    child = people[2]
+    assert sorted(x.id for x in child.get_parents()) == ['I1', 'I2']
+    assert sorted(e.id for x in child.get_parents()
+                  for e in x.find_related(Event)) == ['E1', 'E2']
+    assert [x.id for x in people[0].get_partners()] == ['I2']
+    assert people[1].get_parents() == []
+    assert queries == []
+
+
+@pytest.mark.parametrize('key', ['id', 'sort_keys.name'])
+def test_pages(db, key):
+    names = ['B', 'A', None, 'B', 'C', 'A', None]
+    for i, name in enumerate(names):
+        doc = {'id': 'I{}'.format(i), 'gender': 'F', 'name': []}
+        if name:
+            doc['sort_keys'] = {'name': name, 'group': name}
+        db.people.insert_one(doc)
+
+    seen = []
+    after = None
+    queryset = Person.find({'gender': 'F'}).only('gender')
+    while True:
+        items, after = queryset.page(2, after, key=key)
+        assert len(items) <= 2
+        seen.extend(x.id for x in items)
+        if after is None:
+            break
+
+    if key == 'id':
+        assert seen == ['I{}'.format(i) for i in range(7)]
+    else:
+        assert seen == ['I2', 'I6', 'I1', 'I5', 'I0', 'I3', 'I4']
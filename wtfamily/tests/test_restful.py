@@ -0,0 +1,114 @@
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+import base64
+import json
+
+from flask import Flask
+import pytest
+from werkzeug.exceptions import BadRequest
+
+from models import Event, Note, Person, build_derived_fields
+from restful import (GenericModelAdapter, PersonModelAdapter, decode_cursor,
+                     encode_cursor)
+
+
+@pytest.mark.parametrize('position', [
+    ['Petrov', 'I0001'],
+    [None, 'I0002'],
+    [1850, 'F0001'],
+])
+def test_cursor_roundtrip(position):
+    assert decode_cursor(encode_cursor(position)) == tuple(position)
+
+
+def _encode(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+
+@pytest.mark.parametrize('cursor', [
+    'not base64!',
+    _encode(5),
+    _encode(None),
+    _encode(['I0001']),
+    _encode(['Petrov', 'I0001', 'extra']),
+    # query operators must not get into the query
+    _encode([{'$ne': None}, 'I0001']),
+    _encode(['Petrov', {'$gt': ''}]),
+    _encode(['Petrov', None]),
+])
+def test_malformed_cursor(cursor):
+    with pytest.raises(BadRequest):
+        decode_cursor(cursor)
+
+
+@pytest.fixture
+def dated_db(db):
+    db.events.insert_many([
+        {'id': 'E1', 'type': 'Birth', 'date': {'value': '1850-05-17'}},
+        {'id': 'E2', 'type': 'Death', 'date': {'value': '1900'}},
+        {'id': 'E3', 'type': 'Death'},
+    ])
+    db.people.insert_many([
+        {'id': 'I1', 'eventref': [{'id': 'E1'}, {'id': 'E2'}]},
+        {'id': 'I2', 'eventref': [{'id': 'E3'}]},
+    ])
+    db.notes.insert_one({'id': 'N1', 'text': 'note'})
+    list(build_derived_fields())
+    return db
+
+
+def _provide_list(adapter, model, query_string):
+    with Flask(__name__).test_request_context('/?' + query_string):
+        return sorted(x.id for x in adapter.provide_list(model))
+
+
+@pytest.mark.parametrize('query_string,expected', [
+    ('', ['E1', 'E2', 'E3']),
+    ('from=1850&to=1850', ['E1']),
+    ('from=1851&to=1899', []),
+    ('from=1900', ['E2']),
+    ('to=1900', ['E1', 'E2']),
+    ('from=1850&to=1900&ids=E2,E3', ['E2']),
+])
+def test_date_range_filter(dated_db, query_string, expected):
+    assert _provide_list(GenericModelAdapter, Event, query_string) == expected
+
+
+@pytest.mark.parametrize('query_string,expected', [
+    ('from=1850&to=1850', ['I1']),
+    ('from=1851&to=1899', []),
+    ('to=1849', []),
+])
+def test_people_date_range_filter(dated_db, query_string, expected):
+    assert _provide_list(PersonModelAdapter, Person, query_string) == expected
+
+
+@pytest.mark.parametrize('adapter,model,query_string', [
+    (GenericModelAdapter, Event, 'from=1850-05'),
+    (GenericModelAdapter, Event, 'to=sometime'),
+    # notes have no dates
+    (GenericModelAdapter, Note, 'from=1850'),
+    (GenericModelAdapter, Note, 'to=1850&ids=N1'),
+    # ...and are not searchable
+    (GenericModelAdapter, Note, 'q=note'),
+    (GenericModelAdapter, Event, 'q=birth&from=1850'),
+])
+def test_bad_list_filter(dated_db, adapter, model, query_string):
+    with pytest.raises(BadRequest):
+        _provide_list(adapter, model, query_string)
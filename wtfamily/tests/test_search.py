@@ -0,0 +1,56 @@
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+import pytest
+
+import search
+
+
+def test_normalize():
+    assert search.normalize('Пётр ÉRARD') == 'петр erard'
+
+
+@pytest.mark.parametrize('query,expected', [
+    ('petr', True),
+    ('PËTR', True),
+    ('ova iva', True),
+    ('v', True),
+    ('petrov sidorov', False),
+    ('vop', False),
+])
+def test_index_finds_every_match(query, expected):
+    texts = ['Ivan Petrov', 'Petrova']
+    doc = search.make_document('people', 'I0001', texts)
+    patterns = search.split_query(query)
+    conditions = search.make_conditions('people', patterns)
+
+    # the index lookup must not lose real matches
+    is_candidate = set(conditions['grams']['$all']) <= set(doc['grams'])
+    is_match = search.matches(doc['tokens'], patterns)
+
+    assert is_match == expected
+    if is_match:
+        assert is_candidate
+
+
+def test_unsearchable_model():
+    from models import Note
+
+    assert not Note.SEARCHABLE
+    with pytest.raises(ValueError):
+        Note.search('note')
@@ -0,0 +1,85 @@
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+import pytest
+from monk import ValidationError, validate
+from monk.errors import AllFailed, InvalidKey, MissingKey
+
+from schema import FAMILY_SCHEMA, PERSON_SCHEMA
+from validation import compile_schema
+
+
+PERSON = {
+    'id': 'I0001',
+    'name': [
+        {
+            'type': 'Birth Name',
+            'first': 'John',
+            'surname': ['Doe', {'text': 'Smith', 'prim': False}],
+            'date': {'modifier': 'span',
+                     'value': {'start': '1800', 'stop': '1900'}},
+        },
+    ],
+    'gender': 'M',
+    'childof': [{'id': 'F0001'}],
+    'parentin': [{'hlink': '_abc'}],
+    'priv': False,
+}
+
+
+def _monk_error(spec, value):
+    try:
+        validate(spec, value)
+    except ValidationError as e:
+        return type(e)
+
+
+@pytest.mark.parametrize('patch,error', [
+    ({}, None),
+    ({'gender': 'X'}, AllFailed),
+    ({'unknown': 1}, InvalidKey),
+    ({'name': []}, ValidationError),
+    ({'childof': [{'id': 1}]}, ValidationError),
+    ({'childof': [{'ref': 'F0001'}]}, ValidationError),
+    ({'name': [{'first': 'John'}]}, ValidationError),
+    ({'name': [dict(PERSON['name'][0], surname=[1])]}, ValidationError),
+])
+def test_compiled_matches_monk(patch, error):
+    value = dict(PERSON, **patch)
+    check = compile_schema(PERSON_SCHEMA)
+
+    assert _monk_error(PERSON_SCHEMA, value) is error
+    if error:
+        with pytest.raises(error) as excinfo:
+            check(value)
+        assert excinfo.type is error
+    else:
+        check(value)
+
+
+def test_missing_required_key():
+    check = compile_schema(PERSON_SCHEMA)
+    value = dict(PERSON)
+    del value['gender']
+
+    with pytest.raises(MissingKey):
+        check(value)
+
+
+def test_compiled_once_per_schema():
+    assert compile_schema(FAMILY_SCHEMA) is compile_schema(FAMILY_SCHEMA)
@@ -0,0 +1,253 @@
+#    WTFamily is a genealogical software.
+#
+#    Copyright © 2014—2018  Andrey Mikhaylenko
+#
+#    This file is part of WTFamily.
+#
+#    WTFamily is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    WTFamily is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
+"""
+Compiled validators for Monk schemata.
+
+`monk.validate()` translates the schema into a tree of validator objects on
+every call and then walks it generically: each dictionary rule is matched
+against each key of the document, combinators wrap every nested call in
+`try/except` and so on.  That is fine for a one-off check but it is the
+dominant cost of instantiating thousands of models.
+
+:func:`compile_schema` translates the schema once and turns it into nested
+closures specialized for the actual rules: type checks become bare
+`isinstance()` calls, literal dictionary keys become a dict lookup and
+choices of literals become a frozenset membership test.  Rules that have no
+specialized form fall back to the Monk validator itself, so the semantics
+(and the exception classes) stay the same as with `monk.validate()`.
+"""
+from monk import ValidationError
+from monk.errors import AllFailed, InvalidKey, MissingKey
+from monk.validators import (
+    All, Any, Anything, DictOf, Equals, IsA, ListOf, NotExists, MISSING,
+    translate,
+)
+
+
+__all__ = ['compile_schema']
+
+
+_compiled = {}
+
+
+def compile_schema(spec):
+    """
+    Returns a function which validates a value against given Monk schema
+    and raises `ValidationError` (or its subclass) on failure.
+
+    Compiled validators are cached by schema identity, so it is cheap to
+    call this for a schema shared by several models.
+    """
+    try:
+        return _compiled[id(spec)][1]
+    except KeyError:
+        pass
+    check = _compile(translate(spec))
+    # keep a reference to the spec so that its id() is not reused
+    _compiled[id(spec)] = spec, check
+    return check
+
+
+def _compile(validator):
+    if isinstance(validator, Anything):
+        return _pass
+    if isinstance(validator, IsA):
+        return _compile_isa(validator.expected_type)
+    if isinstance(validator, Equals):
+        return _compile_equals(validator._expected_value)
+    if isinstance(validator, NotExists):
+        return _compile_not_exists()
+    if isinstance(validator, ListOf):
+        return _compile_list_of(validator._nested_validator)
+    if isinstance(validator, DictOf):
+        return _compile_dict_of(validator._pairs) or validator
+    if isinstance(validator, Any):
+        return _compile_any(validator)
+    if isinstance(validator, All):
+        return _compile_all(validator._specs)
+    # no specialized version, use as is
+    return validator
+
+
+def _pass(value):
+    pass
+
+
+def _compile_isa(expected_type):
+    message = 'must be {}'.format(expected_type.__name__)
+
+    def check(value):
+        if not isinstance(value, expected_type):
+            raise ValidationError(message)
+    return check
+
+
+def _compile_equals(expected_value):
+    message = '!= {!r}'.format(expected_value)
+
+    def check(value):
+        if expected_value != value:
+            raise ValidationError(message)
+    return check
+
+
+def _compile_not_exists():
+    def check(value):
+        if value is not MISSING:
+            raise ValidationError('must not exist')
+    return check
+
+
+def _compile_any(validator):
+    literals = _get_literals(validator)
+    if literals is not None:
+        return _compile_one_of(validator, *literals)
+
+    checks = [_compile(x) for x in validator._specs]
+
+    def check(value):
+        for nested_check in checks:
+            try:
+                nested_check(value)
+            except ValidationError:
+                continue
+            return
+        # all failed; let Monk collect the errors into a proper message
+        validator(value)
+        raise AllFailed(repr(value))
+    return check
+
+
+def _compile_one_of(validator, choices, allows_missing):
+    choices = frozenset(choices)
+
+    def check(value):
+        try:
+            if value in choices:
+                return
+        except TypeError:
+            # unhashable, cannot be equal to a literal anyway
+            pass
+        if allows_missing and value is MISSING:
+            return
+        validator(value)
+    return check
+
+
+def _compile_all(validators):
+    checks = [_compile(x) for x in validators]
+
+    def check(value):
+        for nested_check in checks:
+            nested_check(value)
+    return check
+
+
+def _compile_list_of(nested_validator):
+    check_item = _compile(nested_validator)
+    try:
+        nested_validator(MISSING)
+    except ValidationError as e:
+        empty_error = 'missing element: {}'.format(e)
+    else:
+        empty_error = None
+
+    def check(value):
+        if not isinstance(value, list):
+            raise ValidationError('must be list')
+        if not value and empty_error:
+            raise ValidationError(empty_error)
+        for i, item in enumerate(value):
+            try:
+                check_item(item)
+            except ValidationError as e:
+                raise ValidationError('#{}: {}'.format(i, e))
+    return check
+
+
+def _compile_dict_of(pairs):
+    """
+    Compiles a dictionary with literal keys (`'foo'`, `opt_key('foo')`,
+    `one_of(['foo', 'bar'])`) into a lookup table.  Returns `None` if any
+    of the keys is not a literal so that the generic validator is used.
+
+    As in Monk, a data key is validated by the first rule it matches;
+    invalid values are reported before unknown keys and unknown keys
+    before missing ones.
+    """
+    checks_by_key = {}
+    required_rules = []
+    for k_validator, v_validator in pairs:
+        literals = _get_literals(k_validator)
+        if literals is None:
+            return None
+        keys, allows_missing = literals
+        check_value = _compile(v_validator)
+        # keys already taken by a preceding rule never reach this one
+        own_keys = [k for k in keys if k not in checks_by_key]
+        for key in own_keys:
+            checks_by_key[key] = check_value
+        if not allows_missing:
+            required_rules.append((own_keys, k_validator))
+
+    def check(value):
+        if not isinstance(value, dict):
+            raise ValidationError('must be dict')
+        unknown_keys = []
+        for k, v in value.items():
+            try:
+                check_value = checks_by_key[k]
+            except (KeyError, TypeError):
+                unknown_keys.append(k)
+                continue
+            try:
+                check_value(v)
+            except (ValidationError, TypeError) as e:
+                raise type(e)('{!r}: {}'.format(k, e))
+        if unknown_keys:
+            raise InvalidKey(', '.join(repr(x) for x in set(unknown_keys)))
+        missing = [rule for keys, rule in required_rules
+                   if not any(k in value for k in keys)]
+        if missing:
+            raise MissingKey(', '.join(str(x) for x in missing))
+    return check
+
+
+def _get_literals(validator):
+    """
+    Returns a tuple `(values, allows_missing)` if given validator only
+    accepts a fixed set of values (optionally including `MISSING`),
+    otherwise `None`.
+    """
+    if isinstance(validator, Equals):
+        return [validator._expected_value], False
+    if isinstance(validator, Any):
+        values = []
+        allows_missing = False
+        for nested in validator._specs:
+            if isinstance(nested, NotExists):
+                allows_missing = True
+                continue
+            literals = _get_literals(nested)
+            if literals is None:
+                return None
+            values.extend(literals[0])
+            allows_missing = allows_missing or literals[1]
+        return values, allows_missing
+    return None
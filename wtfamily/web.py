@@ -18,6 +18,7 @@
 #    along with WTFamily.  If not, see <http://gnu.org/licenses/>.
 from collections import OrderedDict
 import json
+import sys
 #import os
 
 import babel.dates
@@ -30,6 +31,8 @@ from pymongo.database import Database
 
 from etl import WTFamilyETL
 from models import (
+    Entity,
+    IdentityMap,
     Person,
     Event,
     Family,
@@ -38,6 +41,7 @@ from models import (
     Citation,
     NameMap,
     MediaObject,
+    build_sort_keys,
 )
 from restful import RESTfulApp
 from restful import RESTfulService
@@ -47,7 +51,10 @@ class WTFamilyWebApp(Configurable):
     needs = {
         'mongo_db': Database,
         'debug': False,
-        'etl': WTFamilyETL
+        'etl': WTFamilyETL,
+        # trust | sample | full (see `Entity.configure_read_validation()`)
+        'read_validation': Entity.READ_VALIDATION,
+        'read_validation_sample_rate': Entity.READ_VALIDATION_SAMPLE_RATE,
     }
 
     @property
@@ -55,11 +62,31 @@ class WTFamilyWebApp(Configurable):
         return [self.run]
 
     def run(self, host=None, port=None):
+        Entity.configure_read_validation(self.read_validation,
+                                         self.read_validation_sample_rate)
+
         self.flask_app = Flask(__name__)
 
+        # The lists are ordered by stored sort keys which databases imported
+        # by older versions lack (the documents would come out unordered).
+        with self.flask_app.app_context():
+            g.mongo_db = self.mongo_db
+            for line in build_sort_keys(missing_only=True):
+                print('Built missing sort keys: {}'.format(line))
+
         @self.flask_app.before_request
         def _init():
             g.mongo_db = self.mongo_db
+            g.identity_map = IdentityMap()
+
+        @self.flask_app.after_request
+        def _report_identity_map_stats(response):
+            identity_map = g.get('identity_map')
+            if identity_map is not None:
+                sys.stderr.write('Identity map for {}: {items} items, '
+                                 '{hits} hits, {misses} misses\n'
+                                 .format(request.path, **identity_map.stats))
+            return response
 
         self.flask_app.route('/')(home)
         self.flask_app.route('/event/')(event_list)
@@ -115,7 +142,7 @@ def home():
 
 #@app.route('/event/')
 def event_list():
-    object_list = Event.find()
+    object_list = Event.prefetch(Event.find(), 'place', 'citations')
     return render_template('event_list.html', object_list=object_list)
 
 
@@ -129,19 +156,9 @@ def event_detail(obj_id):
 
 #@app.route('/family/')
 def family_list():
-    def _sort_key(item):
-        # This is a very naïve sorting method.
-        # We sort families by father's birth year; if it's missing, then
-        # by mother's.  This does not take into account actual marriage dates,
-        # so if the second wife was older than the first one, the second family
-        # goes first.  The general idea is to roughly sort the families and
-        # have older people appear before younger ones.
-        if item.father and item.father.birth:
-            return str(item.father.birth.year)
-        if item.mother and item.mother.birth:
-            return str(item.mother.birth.year)
-        return ''
-    object_list = sorted(Family.find(), key=_sort_key)
+    # see `Family.get_sort_keys()`
+    families = Family.find().order_by('sort_keys.birth_year')
+    object_list = Family.prefetch(families, 'people.events')
     return render_template('family_list.html', object_list=object_list)
 
 
@@ -155,8 +172,8 @@ def family_detail(obj_id):
 
 #@app.route('/person/')
 def person_list():
-    object_list = Person.find()
-    object_list = sorted(object_list, key=lambda x: x.name)
+    object_list = Person.prefetch(Person.find().order_by('sort_keys.name'),
+                                  'events')
     return render_template('person_list.html', object_list=object_list)
 
 
@@ -179,6 +196,7 @@ def place_detail(obj_id):
     obj = Place.get(obj_id)
     if not obj:
         abort(404)
+    Event.prefetch(obj.events_recursive, 'place')
     return render_template('place_detail.html', obj=obj)
 
 
@@ -198,7 +216,7 @@ def source_detail(obj_id):
 
 #@app.route('/citation/')
 def citation_list():
-    object_list = Citation.find()
+    object_list = Citation.prefetch(Citation.find(), 'source')
     by_source = {}
     for citation in object_list:
         by_source.setdefault(citation.source, []).append(citation)
@@ -229,26 +247,64 @@ def media_detail(obj_id):
     return render_template('media_detail.html', obj=obj)
 
 
+def _get_viewport():
+    """
+    Returns the `(south, west, north, east)` bounding box from the `bbox`
+    query argument (as in `LatLngBounds.toUrlValue()`) or `None` if the
+    whole map was requested.
+    """
+    value = request.args.get('bbox')
+    if not value:
+        return None
+    try:
+        south, west, north, east = (float(x) for x in value.split(','))
+    except ValueError:
+        abort(400, 'Expected bbox=south,west,north,east; got "{}"'.format(value))
+    if not (-90 <= south <= north <= 90
+            and -180 <= west <= 180 and -180 <= east <= 180):
+        abort(400, 'Bounding box out of range: "{}"'.format(value))
+    return south, west, north, east
+
+
+def _find_mapped_places(conditions=None):
+    bbox = _get_viewport()
+    if bbox:
+        return Place.find_within(bbox, conditions,
+                                 projection=Place.MAP_DATA_FIELDS)
+    return Place.find(conditions, projection=Place.MAP_DATA_FIELDS)
+
+
+def _find_places_with_events():
+    place_ids = Event._get_collection().distinct('place.id')
+    return list(_find_mapped_places({'id': {'$in': place_ids}}))
+
+
 #@app.route('/map/heat')
 def map_heatmap():
-    events = Event.find()
+    bbox = _get_viewport()
+    if bbox:
+        place_ids = [p.id for p in Place.find_within(bbox, projection=['id'])]
+        events = Event.find({'place.id': {'$in': place_ids}})
+    else:
+        events = Event.find()
+    events = Event.prefetch(events, 'place')
     return render_template('map_heatmap.html', events=events)
 
 
 #@app.route('/map/circles')
 def map_circles():
-    places = [p for p in Place.find() if list(p.events)]
+    places = _find_places_with_events()
     return render_template('map_circles.html', places=places)
 
 
 #@app.route('/map/circles/integrated')
 def map_circles_integrated():
-    places = [p for p in Place.find() if list(p.events)]
+    places = _find_places_with_events()
     return render_template('map_circles_integrated.html', places=places)
 
 
 def map_places():
-    places = [p for p in Place.find()]
+    places = list(_find_mapped_places())
     print('places gathered, rendering template...')
     return render_template('map_places.html', places=places)
 
@@ -328,7 +384,9 @@ def orgchart_data():
             parent_id,
             tooltip,
         ]
-    return json.dumps([_prep_row(p) for p in Person.find()])
+    people = Person.prefetch(Person.find(), 'parent_families.parents',
+                             'families.parents', 'events')
+    return json.dumps([_prep_row(p) for p in people])
 
 
 #@app.route('/familytreejs')
@@ -340,7 +398,8 @@ def familytreejs():
 
 #@app.route('/familytreejs.json')
 def familytreejs_json():
-    people = sorted(Person.find(), key=lambda p: p.group_name)
+    people = Person.prefetch(Person.find().order_by('sort_keys.group'),
+                             'parents', 'families', 'events')
     def _prepare_item(person):
         print(person.group_name, person.name)
         url = url_for('person_detail', obj_id=person.id)
@@ -376,7 +435,7 @@ def familytree_primitives_data():
     if single_person:
         people = [Person.get(single_person)]
     else:
-        people = sorted(Person.find(), key=lambda p: p.group_name)
+        people = Person.find().order_by('sort_keys.group')
 
     relatives_of = request.values.get('relatives_of')
     if relatives_of:
@@ -384,20 +443,24 @@ def familytree_primitives_data():
         people = central_person.related_people
 
     # only find ancestors of given person
+    max_generations = request.values.get('generations', type=int)
     ancestors, descendants = None, None
     ancestors_of = request.values.get('ancestors_of')
     if ancestors_of:
         central_person = Person.get(ancestors_of)
-        ancestors = central_person.find_ancestors()
+        ancestors = central_person.find_ancestors(max_generations)
 
     descendants_of = request.values.get('descendants_of')
     if descendants_of:
         central_person = Person.get(descendants_of)
-        descendants = central_person.find_descendants()
+        descendants = central_person.find_descendants(max_generations)
 
     if ancestors_of or descendants_of:
+        # the central person may be in both
         people = set(list(ancestors or [])) | set(list(descendants or []))
 
+    people = Person.prefetch(people, 'parents', 'partners', 'events')
+
     def _prepare_item(person):
         names_lowercase = (n.lower() for n in person.group_names)
         if filter_surnames: